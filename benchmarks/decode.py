@@ -0,0 +1,70 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import os
+from argparse import ArgumentParser, Namespace
+from statistics import median
+from time import perf_counter
+
+from discordnpc.decoders import PCMDecoder, FFmpegDecoder, MiniaudioDecoder, miniaudio
+
+# Compares the ffmpeg-per-segment path with the in-process decoder.
+# Usage: poetry run python -m benchmarks.decode some_tts_segment.mp3 [-n 50]
+
+
+def bench(decoder: PCMDecoder, source: bytes, iterations: int) -> None:
+    decoder.decode(source)  # warm up
+
+    timings: list[float] = []
+    cpu_before: os.times_result = os.times()
+    for _ in range(iterations):
+        started: float = perf_counter()
+        decoder.decode(source)
+        timings.append(perf_counter() - started)
+    cpu_after: os.times_result = os.times()
+
+    # children_* is where ffmpeg's time goes
+    cpu: float = sum(after - before for before, after in zip(cpu_before[:4], cpu_after[:4]))
+
+    print(
+        f"{decoder.name:>20}: "
+        f"median {median(timings) * 1000:8.2f}ms, "
+        f"max {max(timings) * 1000:8.2f}ms, "
+        f"cpu {cpu / iterations * 1000:8.2f}ms/decode"
+    )
+
+
+def main() -> None:
+    parser: ArgumentParser = ArgumentParser(description="Benchmark MP3 to PCM decoders.")
+    parser.add_argument("file", help="An MP3 file, ideally a single Google TTS segment.")
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    args: Namespace = parser.parse_args()
+
+    with open(args.file, "rb") as fp:
+        source: bytes = fp.read()
+
+    bench(FFmpegDecoder(), source, args.iterations)
+    if miniaudio is not None:
+        bench(MiniaudioDecoder(), source, args.iterations)
+    else:
+        print("miniaudio is not installed, skipping the in-process decoder.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace
+from asyncio import AbstractEventLoop, get_running_loop, run, sleep
+from time import perf_counter
+from types import SimpleNamespace
+
+from discordnpc.peppercord_audio import (
+    CustomVoiceClient, EnhancedOpusAudioBytes, FRAME_SECONDS, OPUS_SILENCE_FRAME
+)
+
+# Measures the dead air between segments of speech that were queued back to back,
+# with a player per segment (the old way) and with one continuous player.
+# Usage: poetry run python -m benchmarks.playback [--segments 20] [--segment-ms 1500]
+
+FAKE_OPUS_FRAME: bytes = b"\xfc" + bytes(59)  # never decoded, it only has to not be silence
+
+
+class OfflineVoiceClient(CustomVoiceClient):
+    """A CustomVoiceClient that isn't connected to anything, and notes when each packet would have been sent."""
+
+    def __init__(self, loop: AbstractEventLoop) -> None:
+        super().__init__(SimpleNamespace(_connection=SimpleNamespace(loop=loop)), SimpleNamespace())
+        self._connected.set()
+
+        async def speak(speaking: bool) -> None:
+            pass
+
+        self.ws = SimpleNamespace(speak=speak)
+        self.sent: list[float] = []  # when each frame of speech went out, silence isn't counted
+
+    def send_audio_packet(self, data: bytes, *, encode: bool = True) -> None:
+        if data != OPUS_SILENCE_FRAME:
+            self.sent.append(perf_counter())
+
+
+async def bench(continuous: bool, segments: int, frames_per_segment: int) -> None:
+    client: OfflineVoiceClient = OfflineVoiceClient(get_running_loop())
+    client.continuous = continuous
+
+    group: object = object()
+    for _ in range(segments):
+        client.queue_for_turn(EnhancedOpusAudioBytes([FAKE_OPUS_FRAME] * frames_per_segment), client.turn, group=group)
+
+    started: float = perf_counter()
+    total_frames: int = segments * frames_per_segment
+    while len(client.sent) < total_frames:
+        await sleep(0.1)
+    elapsed: float = perf_counter() - started
+
+    client.stop()
+    client._connected.clear()  # so the player task doesn't try to disconnect from nothing
+    client._task.cancel()
+
+    # a frame that goes out late is dead air, wherever it is
+    late: list[float] = [
+        max(0.0, after - before - FRAME_SECONDS) for before, after in zip(client.sent, client.sent[1:])
+    ]
+    boundaries: int = segments - 1
+    print(
+        f"{'continuous' if continuous else 'per segment':>12}: "
+        f"{sum(late) / boundaries * 1000:6.1f}ms of dead air per segment boundary, "
+        f"longest {max(late) * 1000:6.1f}ms, "
+        f"{elapsed - total_frames * FRAME_SECONDS:6.2f}s longer than the speech itself"
+    )
+
+
+async def run_benchmarks(args: Namespace) -> None:
+    frames_per_segment: int = max(1, int(args.segment_ms / 1000 / FRAME_SECONDS))
+    await bench(False, args.segments, frames_per_segment)
+    await bench(True, args.segments, frames_per_segment)
+
+
+def main() -> None:
+    parser: ArgumentParser = ArgumentParser(description="Benchmark the gaps between queued segments of speech.")
+    parser.add_argument("--segments", type=int, default=20)
+    parser.add_argument("--segment-ms", type=int, default=1500, help="Length of each segment.")
+    args: Namespace = parser.parse_args()
+
+    run(run_benchmarks(args))
+
+
+if __name__ == "__main__":
+    main()
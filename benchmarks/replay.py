@@ -0,0 +1,229 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import audioop
+import math
+import wave
+from argparse import ArgumentParser, Namespace
+from array import array
+from asyncio import AbstractEventLoop, get_running_loop, run, sleep, to_thread
+from threading import Event
+from time import monotonic, perf_counter, process_time, sleep as blocking_sleep
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+from discordnpc.metrics import Histogram
+from discordnpc.mock_stt import MockTranscriptionServer
+from discordnpc.sinks import AssemblyAITranscriptionSink
+from discordnpc.transcription import (
+    AssemblyAIBackend, TranscriptionBackend, TranscriptionConnection, TranscriptMessage, GLOBAL_SESSION_LIMITER,
+    STT_BYTES_SENT, STT_CHUNKS_SENT, STT_CHUNKS_DROPPED, STT_CHUNKS_COALESCED
+)
+
+# Replays speech through AssemblyAITranscriptionSink.write the way py-cord would (20ms packets of 48kHz stereo,
+# from one thread, in real time), with a fake voice client and the mock STT server standing in for AssemblyAI.
+# Usage: poetry run python -m benchmarks.replay [speaker1.wav speaker2.wav ...] [--streams 1,2,4,8] [--seconds 20]
+# Without any WAVs, every speaker says synthetic "words": voiced bursts with pauses between them.
+
+PACKET_MS: int = 20
+PACKET_BYTES: int = 3840  # 20ms of 48kHz stereo s16le
+BOT_USER_ID: int = 1
+
+
+def load_wav(path: str) -> bytes:
+    """Reads a 16-bit WAV and converts it to what py-cord gives sinks."""
+    with wave.open(path, "rb") as fp:
+        if fp.getsampwidth() != 2:
+            raise ValueError(f"{path} isn't 16-bit")
+        pcm: bytes = fp.readframes(fp.getnframes())
+        channels: int = fp.getnchannels()
+        rate: int = fp.getframerate()
+    if channels == 2:
+        pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+    if rate != 48000:
+        pcm, _ = audioop.ratecv(pcm, 2, 1, rate, 48000, None)
+    return audioop.tostereo(pcm, 2, 1, 1)
+
+
+def synthetic_speech(seconds: int, seed: int) -> bytes:
+    """A couple hundred ms of harmonic-rich tone, a pause, repeat. The VAD treats it like speech."""
+    samples: array = array("h")
+    phase: float = 0.0
+    time_ms: int = 0
+    word: int = seed
+    while time_ms < seconds * 1000:
+        word += 1
+        voiced_ms: int = 200 + (word * 137) % 400
+        pause_ms: int = 80 + (word * 71) % 200 if word % 6 else 900  # every so often, the end of a sentence
+        pitch: float = 110.0 + (word * 23) % 80
+        for _ in range(voiced_ms * 48):
+            phase += 2 * math.pi * pitch / 48000
+            value: float = sum(math.sin(phase * harmonic) / harmonic for harmonic in range(1, 6))
+            samples.append(int(value * 6000))
+        samples.extend([0] * (pause_ms * 48))
+        time_ms += voiced_ms + pause_ms
+    return audioop.tostereo(samples.tobytes(), 2, 1, 1)
+
+
+class InstrumentedConnection(TranscriptionConnection):
+    """Measures the time from the packet that completed a chunk arriving at the sink to the chunk being sent."""
+
+    def __init__(self, inner: TranscriptionConnection, received_at: dict[int, float], latency: Histogram) -> None:
+        self.inner: TranscriptionConnection = inner
+        self.session_id: str = inner.session_id
+        self.received_at: dict[int, float] = received_at
+        self.latency: Histogram = latency
+        self._encoded_at: dict[int, float] = {}
+
+    def encode_audio(self, data: bytes) -> str | bytes:
+        message: str | bytes = self.inner.encode_audio(data)
+        received_at: float | None = self.received_at.pop(id(data), None)  # None if it was coalesced
+        if received_at is not None:
+            self._encoded_at[id(message)] = received_at
+        return message
+
+    async def send(self, message: str | bytes) -> None:
+        await self.inner.send(message)
+        received_at: float | None = self._encoded_at.pop(id(message), None)
+        if received_at is not None:
+            self.latency.observe(monotonic() - received_at)
+
+    async def recv(self) -> TranscriptMessage:
+        return await self.inner.recv()
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+class InstrumentedBackend(TranscriptionBackend):
+    def __init__(self, inner: TranscriptionBackend, received_at: dict[int, float], latency: Histogram) -> None:
+        self.inner: TranscriptionBackend = inner
+        self.received_at: dict[int, float] = received_at
+        self.latency: Histogram = latency
+
+    async def connect(self, sample_rate: int) -> AsyncIterator[TranscriptionConnection]:
+        async for connection in self.inner.connect(sample_rate):
+            yield InstrumentedConnection(connection, self.received_at, self.latency)
+
+
+class InstrumentedSink(AssemblyAITranscriptionSink):
+    """Remembers when the packet behind every chunk arrived, keyed by the chunk, for InstrumentedConnection."""
+
+    def __init__(self, *args, received_at: dict[int, float], **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.received_at: dict[int, float] = received_at
+        self._packet_received_at: float = 0.0
+
+    def process_data(self, data: bytes, user: int, received_at: float | None = None) -> None:
+        self._packet_received_at = monotonic() if received_at is None else received_at
+        super().process_data(data, user, received_at)
+
+    def send_sync(self, data: bytes, user: int) -> None:
+        self.received_at[id(data)] = self._packet_received_at
+        super().send_sync(data, user)
+
+
+def feed(sink: AssemblyAITranscriptionSink, streams: list[bytes], stop: Event) -> None:
+    """Plays the part of py-cord's receive thread: one packet per speaker every 20ms."""
+    started: float = perf_counter()
+    for packet_number, offset in enumerate(range(0, min(map(len, streams)) - PACKET_BYTES + 1, PACKET_BYTES)):
+        if stop.is_set():
+            return
+        for user, stream in enumerate(streams, start=BOT_USER_ID + 1):
+            sink.write(stream[offset:offset + PACKET_BYTES], user)
+        # sleep until the next packet is due, without drifting
+        blocking_sleep(max(0.0, started + (packet_number + 1) * PACKET_MS / 1000 - perf_counter()))
+
+
+async def bench(server: MockTranscriptionServer, streams: list[bytes], seconds: int) -> None:
+    loop: AbstractEventLoop = get_running_loop()
+    received_at: dict[int, float] = {}
+    latency: Histogram = Histogram("packet_to_send_seconds", window=100_000)
+
+    async def ignore_text(text: str, user: int) -> None:
+        pass
+
+    sink: InstrumentedSink = InstrumentedSink(
+        "benchmark",
+        ignore_text,
+        backend=InstrumentedBackend(AssemblyAIBackend("benchmark", endpoint=server.endpoint), received_at, latency),
+        max_sessions=len(streams),
+        received_at=received_at,
+    )
+    GLOBAL_SESSION_LIMITER.limit = max(GLOBAL_SESSION_LIMITER.limit, len(streams))
+    sink.init(SimpleNamespace(loop=loop, user=SimpleNamespace(id=BOT_USER_ID)))  # all the sink needs of a VoiceClient
+
+    before: tuple[float, ...] = (
+        STT_BYTES_SENT.value, STT_CHUNKS_SENT.value, STT_CHUNKS_DROPPED.value, STT_CHUNKS_COALESCED.value
+    )
+    stop: Event = Event()
+    cpu_started: float = process_time()  # every thread in the process: the sink, the sender, and the mock server
+    try:
+        await to_thread(feed, sink, [stream[:seconds * 48000 * 4] for stream in streams], stop)
+        await sleep(1.0)  # let the last chunks go out
+    finally:
+        stop.set()
+        cpu: float = process_time() - cpu_started
+        sink.cleanup()
+
+    bytes_sent, chunks_sent, chunks_dropped, chunks_coalesced = (
+        after - before for before, after in zip(before, (
+            STT_BYTES_SENT.value, STT_CHUNKS_SENT.value, STT_CHUNKS_DROPPED.value, STT_CHUNKS_COALESCED.value
+        ))
+    )
+    stream_seconds: float = len(streams) * seconds
+    p50: float | None = latency.percentile(50)
+    p99: float | None = latency.percentile(99)
+    print(
+        f"{len(streams):>3} streams: "
+        f"{cpu / stream_seconds * 1000:7.2f}ms CPU per stream-second, "
+        f"{bytes_sent / stream_seconds / 1024:6.1f} KiB/s sent per stream, "
+        f"{int(chunks_sent):>5} chunks sent, {int(chunks_dropped):>3} dropped, {int(chunks_coalesced):>3} coalesced, "
+        f"packet-to-send p50 {(p50 or 0) * 1000:7.1f}ms p99 {(p99 or 0) * 1000:7.1f}ms"
+    )
+
+
+async def run_benchmarks(args: Namespace) -> None:
+    server: MockTranscriptionServer = MockTranscriptionServer(port=0, latency=0.0, jitter=0.0)
+    await server.start()
+
+    fixtures: list[bytes] = [load_wav(path) for path in args.wavs]
+    try:
+        for stream_count in (int(count) for count in args.streams.split(",")):
+            streams: list[bytes] = [
+                fixtures[index % len(fixtures)] if fixtures else synthetic_speech(args.seconds, index)
+                for index in range(stream_count)
+            ]
+            await bench(server, streams, args.seconds)
+    finally:
+        await server.stop()
+
+
+def main() -> None:
+    parser: ArgumentParser = ArgumentParser(description="Benchmark the voice receive path against a mock STT server.")
+    parser.add_argument("wavs", nargs="*", help="16-bit WAVs to replay, one per speaker. Reused if there are fewer.")
+    parser.add_argument("--streams", default="1,2,4,8", help="Comma-separated numbers of concurrent speakers.")
+    parser.add_argument("--seconds", type=int, default=20, help="Seconds of audio per speaker.")
+    args: Namespace = parser.parse_args()
+
+    run(run_benchmarks(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import sys
+from argparse import ArgumentParser, Namespace
+from asyncio import Event, get_running_loop, run, sleep
+
+from discordnpc.sinks import ASSEMBLYAI_USABLE_MINIMUM_LENGTH_MS, STT_SAMPLE_RATE
+from discordnpc.transcription import (
+    ASSEMBLYAI_MAXIMUM_LENGTH_MS, AudioSender, OverflowPolicy, TranscriptionConnection, TranscriptMessage,
+    STT_CHUNKS_COALESCED, STT_CHUNKS_DROPPED, STT_SEND_QUEUE_SIZE
+)
+
+# Stalls a session's websocket while full-size chunks pile up behind it, then lets it go and checks what came out.
+# Coalescing exists for exactly this, so with the default policy nothing should be dropped until the queue
+# holds twice its size. Exits non-zero if speech was lost that shouldn't have been.
+# Usage: poetry run python -m benchmarks.send_queue [--chunks 16] [--policy coalesce]
+
+
+class StalledConnection(TranscriptionConnection):
+    """Doesn't send anything until it's released, then records what it sends."""
+
+    session_id = "stalled"
+
+    def __init__(self) -> None:
+        self.released: Event = Event()
+        self.sent: list[bytes] = []
+
+    def encode_audio(self, data: bytes) -> bytes:
+        return data
+
+    async def send(self, message: str | bytes) -> None:
+        await self.released.wait()
+        self.sent.append(message)
+
+    async def recv(self) -> TranscriptMessage:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+async def overflow(chunks: int, policy: OverflowPolicy) -> tuple[int, int, int, int]:
+    """Returns (bytes queued, bytes sent, chunks dropped, chunks coalesced)."""
+    bytes_per_second: int = STT_SAMPLE_RATE * 2
+    # the same sizes the sink and the session use
+    max_chunk_bytes: int = (ASSEMBLYAI_MAXIMUM_LENGTH_MS - 1) * bytes_per_second // 1000
+    max_chunk_bytes -= max_chunk_bytes % 2
+    chunk_bytes: int = min(ASSEMBLYAI_USABLE_MINIMUM_LENGTH_MS * bytes_per_second // 1000, max_chunk_bytes // 2)
+    chunk_bytes -= chunk_bytes % 2
+
+    sender: AudioSender = AudioSender(
+        get_running_loop(), policy=policy, max_chunk_bytes=max_chunk_bytes, bytes_per_second=bytes_per_second
+    )
+    connection: StalledConnection = StalledConnection()
+    sender.connect()
+    task = get_running_loop().create_task(sender.run(connection))
+
+    dropped_before: int = STT_CHUNKS_DROPPED.value
+    coalesced_before: int = STT_CHUNKS_COALESCED.value
+
+    # one more than the queue's size, since the first is taken off it and sits in the stalled send
+    chunks_sent: list[bytes] = [bytes([index % 256]) * chunk_bytes for index in range(chunks + 1)]
+    for chunk in chunks_sent:
+        sender.submit(chunk)
+        await sleep(0)
+
+    await sleep(0.01)
+    connection.released.set()
+    while sender.depth:
+        await sleep(0.01)
+    await sleep(0.01)
+    task.cancel()
+
+    # whatever was dropped, what's left has to be in order
+    remaining: bytes = b"".join(chunks_sent)
+    for message in connection.sent:
+        position: int = remaining.find(message)
+        if position == -1 or position % chunk_bytes:
+            raise AssertionError("The chunks that were sent came out of order")
+        remaining = remaining[position + len(message):]
+
+    return (
+        sum(map(len, chunks_sent)),
+        sum(map(len, connection.sent)),
+        STT_CHUNKS_DROPPED.value - dropped_before,
+        STT_CHUNKS_COALESCED.value - coalesced_before,
+    )
+
+
+def main() -> None:
+    parser: ArgumentParser = ArgumentParser(description="Check how the STT send queue copes with a stalled socket.")
+    parser.add_argument("--chunks", type=int, default=2 * STT_SEND_QUEUE_SIZE, help="Full-size chunks to back up.")
+    parser.add_argument(
+        "--policy", type=OverflowPolicy, default=OverflowPolicy.COALESCE, choices=list(OverflowPolicy)
+    )
+    args: Namespace = parser.parse_args()
+
+    queued, sent, dropped, coalesced = run(overflow(args.chunks, args.policy))
+    print(
+        f"{args.policy.value}: {args.chunks} chunks backed up behind a stalled send, "
+        f"{sent / queued:.0%} of the audio sent, {dropped} chunks dropped, {coalesced} coalesced"
+    )
+
+    if args.policy is OverflowPolicy.COALESCE and args.chunks <= 2 * STT_SEND_QUEUE_SIZE and dropped:
+        sys.exit("Coalescing dropped speech it had room for")
+
+
+if __name__ == "__main__":
+    main()
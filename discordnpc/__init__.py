@@ -17,8 +17,24 @@
 """
 from __future__ import annotations
 
+from .answer_cache import *
 from .async_helpers import *
+from .chatbot_pool import *
 from .chatgpt_types import *
+from .decoders import *
 from .discord_cog import *
+from .executors import *
+from .metrics import *
+from .mock_stt import *
+from .pcm_cache import *
+from .rate_limit import *
+from .resample import *
+from .ring_buffer import *
 from .peppercord_audio import *
 from .sinks import *
+from .speculation import *
+from .tracing import *
+from .transcription import *
+from .utterances import *
+from .vad import *
+from .voice_workers import *
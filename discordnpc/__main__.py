@@ -26,6 +26,11 @@ from dislog import DiscordWebhookHandler
 from revChatGPT.ChatGPT import Chatbot
 
 from . import *
+from .chatbot_pool import CHATBOT_POOL_SIZE
+from .executors import AUDIO_THREADS, TTS_THREADS, SPEECH_THREADS, IO_THREADS
+from .pcm_cache import DEFAULT_DISK_BUDGET_BYTES, DEFAULT_MEMORY_BUDGET_BYTES
+from .sinks import STT_SAMPLE_RATE
+from .voice_workers import VOICE_WORKERS
 
 logger: Logger = getLogger(__name__)
 
@@ -68,17 +73,67 @@ def main() -> None:
         key.removeprefix("CHATGPT_").lower(): value for (key, value) in environ.items() if key.startswith("CHATGPT_")
     }
 
-    make_chatbot: Callable[[], Awaitable[Chatbot]] = make_async(lambda: Chatbot(chatgpt_config))
+    # Everything blocking runs on a few shared thread pools, sized by the kind of work.
+
+    executors: ExecutorManager = ExecutorManager(
+        audio=int(environ.get("DNPC_AUDIO_THREADS", AUDIO_THREADS)),
+        tts=int(environ.get("DNPC_TTS_THREADS", TTS_THREADS)),
+        speech=int(environ.get("DNPC_SPEECH_THREADS", SPEECH_THREADS)),
+        io=int(environ.get("DNPC_IO_THREADS", IO_THREADS)),
+    )
+    set_default_executors(executors)
+
+    make_chatbot: Callable[[], Awaitable[Chatbot]] = make_async(lambda: Chatbot(chatgpt_config), executors.io)
     # runs some big io sync code in __init__, best to do on thread
     # this library is awful and each chatbot instance ALSO holds conversation data.
 
+    # Repeated lines (acknowledgements, rate limit apologies) are cached as decoded audio.
+
+    pcm_cache_directory: str | None = environ.get("DNPC_PCM_CACHE_DIR") or None
+    pcm_cache_bytes: int = int(environ.get("DNPC_PCM_CACHE_BYTES", DEFAULT_MEMORY_BUDGET_BYTES))
+    pcm_cache_disk_bytes: int = int(environ.get("DNPC_PCM_CACHE_DISK_BYTES", DEFAULT_DISK_BUDGET_BYTES))
+
+    set_default_cache(PCMCache(
+        max_bytes=pcm_cache_bytes, directory=pcm_cache_directory, max_disk_bytes=pcm_cache_disk_bytes
+    ))
+
     # We now have the things we need to interact with ChatGPT, lets move onto Discord.
 
     bot: Bot = Bot()
 
     assembly_api_key: str = environ["DNPC_ASSEMBLY_TOKEN"]
 
-    bot.add_cog(ChatGPTCog(bot, make_chatbot, assembly_api_key))
+    if "DNPC_STT_MAX_SESSIONS" in environ:
+        GLOBAL_SESSION_LIMITER.limit = int(environ["DNPC_STT_MAX_SESSIONS"])
+
+    if "DNPC_STT_WARM_SESSIONS" in environ:
+        GLOBAL_WARM_POOLS.size = int(environ["DNPC_STT_WARM_SESSIONS"])
+
+    stt_sample_rate: int = int(environ.get("DNPC_STT_SAMPLE_RATE", STT_SAMPLE_RATE))
+
+    chatbot_pool_size: int = int(environ.get("DNPC_CHATBOT_POOL_SIZE", CHATBOT_POOL_SIZE))
+
+    voice_workers: int = int(environ.get("DNPC_VOICE_WORKERS", VOICE_WORKERS))
+
+    # Point this at `python -m discordnpc.mock_stt` to test the voice pipeline without AssemblyAI.
+    transcription_backend: TranscriptionBackend | None = (
+        AssemblyAIBackend(assembly_api_key, endpoint=environ["DNPC_STT_ENDPOINT"])
+        if "DNPC_STT_ENDPOINT" in environ
+        else None
+    )
+
+    bot.add_cog(
+        ChatGPTCog(
+            bot,
+            make_chatbot,
+            assembly_api_key,
+            stt_sample_rate=stt_sample_rate,
+            transcription_backend=transcription_backend,
+            chatbot_pool_size=chatbot_pool_size,
+            metrics_path=environ.get("DNPC_METRICS_FILE") or None,
+            voice_workers=voice_workers
+        )
+    )
     # note: py-cord is different from discord.py in that it's cog loading functions are sync.
     # because of this, we can let it deal with loop management and just run the bot.
 
@@ -87,6 +142,8 @@ def main() -> None:
     logger.info("Setup complete. Starting bot.")
     bot.run(environ["DNPC_TOKEN"])
 
+    executors.shutdown(wait=False)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,121 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from asyncio import CancelledError, Task, get_running_loop, shield
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, Awaitable
+
+from .chatgpt_types import Answer
+from .metrics import Counter, counter
+
+ASK_CACHE_MAX_ENTRIES: int = 256
+ASK_CACHE_TTL: float = 600.0  # seconds, answers to "what's new" questions go stale
+
+ASK_CACHE_HITS: Counter = counter("ask_cache_hits_total", "/ask prompts answered from the cache.")
+ASK_CACHE_MISSES: Counter = counter("ask_cache_misses_total", "/ask prompts that had to be sent to ChatGPT.")
+ASK_CACHE_COLLAPSED: Counter = counter(
+    "ask_cache_collapsed_total", "/ask prompts that waited on an identical prompt already being answered."
+)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """So "What is Discord?" and "what is discord" are the same question."""
+    return " ".join(prompt.casefold().split()).rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    An LRU cache with a TTL for answers to prompts that don't belong to a conversation.
+    If the same prompt is asked again while the first one is still being answered, it waits for that answer
+    instead of sending a second request. Failures aren't cached, everyone waiting gets the error.
+    Waiters can be cancelled on their own, the request is only cancelled once nobody is waiting on it.
+    Only use from the event loop.
+    """
+
+    def __init__(self, *, max_entries: int = ASK_CACHE_MAX_ENTRIES, ttl: float = ASK_CACHE_TTL) -> None:
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+
+        self._answers: OrderedDict[str, tuple[float, Answer]] = OrderedDict()  # key -> (expires at, answer)
+        self._in_flight: dict[str, Task[Answer]] = {}
+        self._waiters: dict[str, int] = {}  # key -> how many are waiting on the one in flight
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+    def get(self, prompt: str) -> Answer | None:
+        key: str = normalize_prompt(prompt)
+        cached: tuple[float, Answer] | None = self._answers.get(key)
+        if cached is None:
+            return None
+        expires_at, answer = cached
+        if expires_at <= monotonic():
+            del self._answers[key]
+            return None
+        self._answers.move_to_end(key)
+        return answer
+
+    def put(self, prompt: str, answer: Answer) -> None:
+        key: str = normalize_prompt(prompt)
+        self._answers[key] = (monotonic() + self.ttl, answer)
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.max_entries:
+            self._answers.popitem(last=False)
+
+    async def get_or_ask(self, prompt: str, ask: Callable[[], Awaitable[Answer]]) -> Answer:
+        """
+        :param prompt: The prompt, as the user typed it.
+        :param ask: Sends the prompt to ChatGPT. Only called on a miss.
+        :return: The answer, which may be shared with other users who asked the same thing.
+        """
+        cached: Answer | None = self.get(prompt)
+        if cached is not None:
+            ASK_CACHE_HITS.inc()
+            return cached
+
+        key: str = normalize_prompt(prompt)
+        in_flight: Task[Answer] | None = self._in_flight.get(key)
+        if in_flight is not None:
+            ASK_CACHE_COLLAPSED.inc()
+        else:
+            ASK_CACHE_MISSES.inc()
+            # the request runs on its own, so whoever started it can go away without failing everyone else
+            in_flight = self._in_flight[key] = get_running_loop().create_task(ask())
+            in_flight.add_done_callback(lambda task: self._on_answered(prompt, key, task))
+            self._waiters[key] = 0
+
+        self._waiters[key] += 1
+        try:
+            return await shield(in_flight)
+        except CancelledError:
+            if not in_flight.done():
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    in_flight.cancel()  # nobody wants it anymore
+            raise
+
+    def _on_answered(self, prompt: str, key: str, task: Task[Answer]) -> None:
+        del self._in_flight[key], self._waiters[key]
+        # exception() also marks it retrieved, nobody may have been waiting
+        if not task.cancelled() and task.exception() is None:
+            self.put(prompt, task.result())
+
+
+__all__ = ("AnswerCache",)
@@ -17,20 +17,31 @@
 """
 from __future__ import annotations
 
-from asyncio import to_thread
+from asyncio import get_running_loop, to_thread
+from concurrent.futures import Executor
+from contextvars import copy_context
+from functools import partial
 from typing import Callable, Coroutine, ParamSpec, Any
 
 A = ParamSpec("A")
 R = ParamSpec("R")
 
 
-def make_async(to_call: Callable[A, R]) -> Callable[A, Coroutine[Any, Any, R]]:
+def make_async(to_call: Callable[A, R], executor: Executor | None = None) -> Callable[A, Coroutine[Any, Any, R]]:
     """
     Make an async function from a callable.
     :param to_call: The callable to make the async function from.
+    :param executor: Where to run it. None means asyncio's default executor.
     :return: A function that returns a coroutine to call the callable.
     """
-    return lambda *args, **kwargs: to_thread(to_call, *args, **kwargs)  # type: ignore
+    if executor is None:
+        return lambda *args, **kwargs: to_thread(to_call, *args, **kwargs)  # type: ignore
+
+    async def call(*args, **kwargs) -> R:
+        # carry contextvars over like to_thread does
+        return await get_running_loop().run_in_executor(executor, partial(copy_context().run, to_call, *args, **kwargs))
+
+    return call
 
 
 __all__ = ("make_async",)
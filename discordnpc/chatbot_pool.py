@@ -0,0 +1,138 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from asyncio import gather
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Callable, Awaitable, Iterator, Sequence
+
+from revChatGPT.ChatGPT import Chatbot
+
+from .metrics import Gauge, Histogram, gauge, histogram
+
+CHATBOT_POOL_SIZE: int = 2
+CHATBOT_POOL_MAX_PINNED: int = 4096  # conversations remembered, the least recently used are forgotten
+
+CHATBOT_POOL_SESSIONS: Gauge = gauge("chatbot_pool_sessions", "Chatbot sessions in the pool.")
+CHATBOT_POOL_BUSY: Gauge = gauge("chatbot_pool_busy", "Chatbot sessions currently answering a question.")
+CHATBOT_POOL_WAIT: Histogram = histogram(
+    "chatbot_pool_wait_seconds", "Time spent waiting for a conversation's chatbot session to be free."
+)
+
+
+class PooledChatbot:
+    """One chatbot session in a pool. Only one question can be asked of it at a time."""
+
+    def __init__(self, chatbot: Chatbot, index: int) -> None:
+        self.chatbot: Chatbot = chatbot
+        self.index: int = index
+        self.lock: Lock = Lock()
+        self.load: int = 0  # asking or waiting to ask, guarded by the pool's lock
+
+
+class ChatbotPool:
+    """
+    A fixed set of chatbot sessions, so independent conversations can be asked about at the same time.
+    Each revChatGPT Chatbot remembers where its conversations are up to (parent_id), so once a conversation
+    has been asked about on one session it is pinned there, and everything else in it is asked on that session too.
+    New conversations go to whichever session has the least going on.
+    """
+
+    def __init__(self, chatbots: Sequence[Chatbot], *, max_pinned: int = CHATBOT_POOL_MAX_PINNED) -> None:
+        if not chatbots:
+            raise ValueError("A chatbot pool needs at least one chatbot")
+
+        self.sessions: list[PooledChatbot] = [PooledChatbot(chatbot, index) for index, chatbot in enumerate(chatbots)]
+        self.max_pinned: int = max_pinned
+
+        self._pinned: OrderedDict[str, PooledChatbot] = OrderedDict()
+        self._lock: Lock = Lock()
+
+        CHATBOT_POOL_SESSIONS.set(len(self.sessions))
+
+    @classmethod
+    async def create(
+            cls,
+            chatbot_factory: Callable[[], Awaitable[Chatbot]],
+            size: int = CHATBOT_POOL_SIZE
+    ) -> ChatbotPool:
+        """Logs in size chatbots at once."""
+        return cls(await gather(*(chatbot_factory() for _ in range(size))))
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    @property
+    def busy(self) -> int:
+        return sum(session.lock.locked() for session in self.sessions)
+
+    @property
+    def utilisation(self) -> float:
+        """The fraction of sessions that are answering something right now."""
+        return self.busy / len(self.sessions)
+
+    def pin(self, conversation_id: str, session: PooledChatbot) -> None:
+        with self._lock:
+            self._pinned[conversation_id] = session
+            self._pinned.move_to_end(conversation_id)
+            while len(self._pinned) > self.max_pinned:
+                self._pinned.popitem(last=False)
+
+    def _session_for(self, conversation_id: str | None) -> PooledChatbot:
+        """Must be called with the lock held."""
+        if conversation_id is not None:
+            session: PooledChatbot | None = self._pinned.get(conversation_id)
+            if session is not None:
+                self._pinned.move_to_end(conversation_id)
+                return session
+
+        session = min(self.sessions, key=lambda candidate: candidate.load)
+        if conversation_id is not None:
+            # a conversation we haven't seen, i.e. from before a restart. it's on the server, so any session can have it
+            self._pinned[conversation_id] = session
+        return session
+
+    @contextmanager
+    def checkout(self, conversation_id: str | None) -> Iterator[PooledChatbot]:
+        """
+        Waits for the session a conversation belongs to, and holds it for the duration of the with block.
+        :param conversation_id: The conversation that is going to be asked about, or None for a new one.
+                                New conversations should be pinned once their ID is known.
+        """
+        with self._lock:
+            session: PooledChatbot = self._session_for(conversation_id)
+            session.load += 1
+
+        waiting_since: float = monotonic()
+        session.lock.acquire()
+        CHATBOT_POOL_WAIT.observe(monotonic() - waiting_since)
+        CHATBOT_POOL_BUSY.inc()
+
+        try:
+            yield session
+        finally:
+            CHATBOT_POOL_BUSY.dec()
+            session.lock.release()
+            with self._lock:
+                session.load -= 1
+
+
+__all__ = ("PooledChatbot", "ChatbotPool")
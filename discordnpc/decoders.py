@@ -0,0 +1,129 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import shlex
+import subprocess
+from abc import ABC, abstractmethod
+from logging import Logger, getLogger
+
+from discord import ClientException
+from discord.opus import Encoder
+
+try:
+    import miniaudio
+except ImportError:  # optional, we can always fall back to ffmpeg
+    miniaudio = None
+
+logger: Logger = getLogger(__name__)
+
+
+class PCMDecoder(ABC):
+    """Turns compressed audio (the MP3 we get from Google) into 48kHz stereo s16le PCM, which is what discord wants."""
+
+    @abstractmethod
+    def decode(self, source: bytes) -> bytes:
+        raise NotImplementedError
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+
+class FFmpegDecoder(PCMDecoder):
+    """Forks a new ffmpeg for every decode. Works with anything ffmpeg can read, but the process spawn is slow."""
+
+    def __init__(self, *, executable="ffmpeg", pipe=True, stderr=None, before_options=None, options=None) -> None:
+        self.executable = executable
+        self.pipe = pipe
+        self.stderr = stderr
+        self.before_options = before_options
+        self.options = options
+
+    def decode(self, source: bytes) -> bytes:
+        stdin = None if not self.pipe else source
+        args = [self.executable]
+        if isinstance(self.before_options, str):
+            args.extend(shlex.split(self.before_options))
+        args.append("-i")
+        args.append("-" if self.pipe else source)
+        args.extend(
+            ("-f", "s16le", "-ar", str(Encoder.SAMPLING_RATE), "-ac", str(Encoder.CHANNELS), "-loglevel", "warning")
+        )
+        if isinstance(self.options, str):
+            args.extend(shlex.split(self.options))
+        args.append("pipe:1")
+        try:
+            process = subprocess.Popen(
+                args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr
+            )
+            return process.communicate(input=stdin)[0]
+        except FileNotFoundError:
+            raise ClientException(self.executable + " was not found.") from None
+        except subprocess.SubprocessError as exc:
+            raise ClientException(
+                "Popen failed: {0.__class__.__name__}: {0}".format(exc)
+            ) from exc
+
+
+class MiniaudioDecoder(PCMDecoder):
+    """Decodes in-process with miniaudio. No fork, no pipes, and it releases the GIL while decoding."""
+
+    def __init__(self) -> None:
+        if miniaudio is None:
+            raise RuntimeError("miniaudio is not installed! Install it with the fast-decode extra.")
+
+    def decode(self, source: bytes) -> bytes:
+        try:
+            decoded = miniaudio.decode(
+                source,
+                output_format=miniaudio.SampleFormat.SIGNED16,
+                nchannels=Encoder.CHANNELS,
+                sample_rate=Encoder.SAMPLING_RATE,
+            )
+        except miniaudio.DecodeError as exc:
+            raise ClientException(f"miniaudio failed to decode audio: {exc}") from exc
+        return decoded.samples.tobytes()
+
+
+_default_decoder: PCMDecoder | None = None
+
+
+def get_default_decoder() -> PCMDecoder:
+    """
+    Get the decoder used when a source isn't given one explicitly.
+    This is miniaudio if it is installed, otherwise ffmpeg.
+    """
+    global _default_decoder
+    if _default_decoder is None:
+        if miniaudio is not None:
+            _default_decoder = MiniaudioDecoder()
+        else:
+            logger.warning("miniaudio is not installed, falling back to one ffmpeg process per decode.")
+            _default_decoder = FFmpegDecoder()
+    return _default_decoder
+
+
+def set_default_decoder(decoder: PCMDecoder) -> None:
+    global _default_decoder
+    _default_decoder = decoder
+
+
+__all__ = (
+    "PCMDecoder", "FFmpegDecoder", "MiniaudioDecoder", "get_default_decoder", "set_default_decoder"
+)
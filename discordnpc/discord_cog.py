@@ -17,30 +17,70 @@
 """
 # from __future__ import annotations  breaks pycord slash command type inference
 
+from asyncio import Lock as AsyncLock, CancelledError, Task, current_task, gather, wrap_future
+from collections import deque
+from concurrent.futures import Executor, Future
+from contextvars import copy_context
+from functools import partial
 from logging import Logger, getLogger
-from threading import Lock
-from time import sleep as blocking_sleep
-from typing import Callable, Awaitable, cast
+from time import monotonic
+from typing import Callable, Awaitable, Hashable, Iterator, cast
 
 from discord import Bot, Embed, slash_command, ApplicationContext, VoiceState, Member
 from discord.ext.commands import Cog
 from discord.sinks import Sink
-from google_speech import Speech
+from google_speech import Speech, SpeechSegment
 from revChatGPT.ChatGPT import Chatbot
 
+from .answer_cache import AnswerCache
 from .async_helpers import make_async
+from .chatbot_pool import CHATBOT_POOL_SIZE, ChatbotPool
 from .chatgpt_types import Answer
-from .peppercord_audio import CustomVoiceClient, EnhancedFFmpegPCMAudioBytesTransformed, EnhancedSource
-from .sinks import AssemblyAITranscriptionSink
+from .decoders import get_default_decoder
+from .executors import SerialExecutor, get_default_executors
+from .metrics import Histogram, histogram, dump_periodically
+from .pcm_cache import PCMBuffer, PCMCache, get_default_cache
+from .peppercord_audio import (
+    CustomVoiceClient, EnhancedFFmpegPCMAudioBytesTransformed, EnhancedOpusAudioBytes, EnhancedSource, SpeechPriority,
+    encode_opus
+)
+from .rate_limit import LLM_MAX_ATTEMPTS, TokenBucketRateLimiter, describe_wait
+from .speculation import SpeculativeAsker
+from .sinks import AssemblyAITranscriptionSink, STT_SAMPLE_RATE
+from .tracing import Turn, current_turn, mark
+from .utterances import UtteranceAggregator
+from .transcription import TranscriptionBackend
+from .voice_workers import VOICE_WORKERS, VoiceWorkerPool
 
 logger: Logger = getLogger(__name__)
 
 GUILD_IDS: list[int] | None = [919622423677136986, 383003210241277952]  # change these to your guilds
 
 BOT_ACKNOWLEDGE_SPEECH: str = "I heard you say \"{speech}\". Give me a second to think..."
-RATELIMIT_SPEECH: str = "I lost my train of thought. Give me a minute to get back on track..."
+RATELIMIT_SPEECH: str = "I lost my train of thought. Give me {wait} to get back on track..."
+GAVE_UP_SPEECH: str = "I really can't think straight right now. Try asking me again later."
 
+TTS_LANGUAGE: str = "en"
 TTS_SPEEDUP_RATE: float = 2.0
+TTS_TRANSFORM: str = "none"  # part of the PCM cache key, change it whenever modify_text_to_speech_audio changes
+
+TTS_SYNTHESIS_WORKERS: int = 2  # segments of one line synthesized ahead of the one being queued
+TTS_PREENCODE_OPUS: bool = True  # encode on the synthesis threads instead of in the player thread, frame by frame
+
+BARGE_IN: bool = True  # stop talking when someone talks over the bot
+BARGE_IN_MIN_WORDS: int = 1  # heard in a partial transcript before it counts, a cough or a door has none
+NOTICE_GROUP: str = "notice"  # a queued notice (i.e. a rate limit apology) is replaced by the next one
+
+TTS_TIME_TO_FIRST_AUDIO: Histogram = histogram(
+    "tts_time_to_first_audio_seconds",
+    "Time from speak() being called to its first segment being playable on the queue.",
+)
+
+LLM_SPECULATE: bool = False  # ask about partial transcripts before they're final, costs extra requests on a miss
+ANSWER_TIME_TO_FIRST_AUDIO: Histogram = histogram(
+    "answer_time_to_first_audio_seconds",
+    "Time from a transcript being handled to the first audio of the answer to it being playable on the queue.",
+)
 
 
 def modify_text_to_speech_audio(mp3_audio_in: bytes) -> bytes:
@@ -48,39 +88,193 @@ def modify_text_to_speech_audio(mp3_audio_in: bytes) -> bytes:
     return mp3_audio_in
 
 
-def speak(client: CustomVoiceClient, text: str) -> None:
+def synthesize_segment(segment: SpeechSegment) -> PCMBuffer:
+    """
+    Get the decoded PCM for one segment of speech.
+    Lines the bot has said before (acknowledgements, rate limit apologies) come out of the PCM cache,
+    and identical lines being synthesized at the same time for different guilds only get synthesized once.
+    """
+    return get_default_cache().get_or_create(
+        PCMCache.key(segment.text.lower(), segment.lang, TTS_TRANSFORM),  # google reads it lowercased anyway
+        lambda: get_default_decoder().decode(modify_text_to_speech_audio(segment.getAudioData())),
+    )
+
+
+def prepare_segment(text: str, lang: str, segment_num: int, segment_count: int | None) -> PCMBuffer | list[bytes]:
+    """
+    Synthesize one segment of speech, and Opus-encode it if TTS_PREENCODE_OPUS is on.
+    Takes the segment apart because segments can't be pickled, this is what runs on voice workers.
+    """
+    pcm: PCMBuffer = synthesize_segment(SpeechSegment(text, lang, segment_num, segment_count))
+    return encode_opus(pcm) if TTS_PREENCODE_OPUS else bytes(pcm)  # a memoryview can't be sent back either
+
+
+def speak(
+        client: CustomVoiceClient,
+        text: str,
+        on_first_audio: Callable[[], None] | None = None,
+        turn: int | None = None,
+        label: str | None = None,
+        workers: VoiceWorkerPool | None = None,
+        priority: SpeechPriority = SpeechPriority.ANSWER,
+        group: Hashable | None = None,
+        replace: bool = False
+) -> None:
+    """
+    Synthesizes text and queues it on the voice client one segment at a time.
+    Synthesis threads work through the segments in order while this thread queues them,
+    so the first segment can start playing while the rest are still being synthesized.
+    :param client: The voice client to queue audio on.
+    :param text: What to say.
+    :param on_first_audio: Called once the first segment is on the queue.
+    :param turn: The client's turn this speech belongs to. If someone barges in and the turn moves on,
+                 whatever hasn't been queued yet is thrown away. Defaults to the current turn.
+    :param label: What this speech is, i.e. "answer". If given, the current trace is marked with
+                  when it was decoded ({label}_tts_decoded) and when it started playing ({label}_playing).
+    :param workers: If given, segments are synthesized and encoded on the guild's voice worker process.
+    :param priority: Which lane of the voice client's queue this waits in.
+    :param group: The reply this is part of, so it expires (or is replaced) as a whole. Defaults to just this speech.
+    :param replace: Throw away whatever of the group is still queued when the first segment is queued.
+    """
+    if turn is None:
+        turn = client.turn
+    elif turn != client.turn:
+        logger.info(f"Not speaking, the conversation has moved on: {text}")
+        return
+
     logger.info(f"Speaking: {text}")
 
-    speech: Speech = Speech(text, "en")
+    started_at: float = monotonic()
+    trace: Turn | None = current_turn.get()
+
+    speech: Speech = Speech(text, TTS_LANGUAGE)
+    if group is None:
+        group = object()  # so later segments aren't cut off once the first one starts playing
+
+    def prepare(segment: SpeechSegment) -> EnhancedSource:
+        if workers is not None:
+            prepared: PCMBuffer | list[bytes] = workers.run(
+                client.guild.id, prepare_segment, segment.text, segment.lang, segment.segment_num, segment.segment_count
+            )
+        else:
+            pcm: PCMBuffer = synthesize_segment(segment)
+            prepared = encode_opus(pcm) if TTS_PREENCODE_OPUS else pcm
+        return (
+            EnhancedOpusAudioBytes(prepared) if TTS_PREENCODE_OPUS
+            else EnhancedFFmpegPCMAudioBytesTransformed.from_pcm(prepared)
+        )
+
+    synthesizer: Executor = get_default_executors().tts
+    segments: Iterator[SpeechSegment] = iter(speech)
+    pending: deque[Future[EnhancedSource]] = deque()  # in order, at most TTS_SYNTHESIS_WORKERS ahead
+
+    def synthesize_next() -> None:
+        segment: SpeechSegment | None = next(segments, None)
+        if segment is not None:
+            pending.append(synthesizer.submit(prepare, segment))
+
+    for _ in range(TTS_SYNTHESIS_WORKERS):
+        synthesize_next()
+
+    try:
+        segment_number: int = 0
+        while pending:
+            source: EnhancedSource = pending.popleft().result()
+            synthesize_next()
+
+            if client.turn != turn:
+                return  # don't bother synthesizing the rest
 
-    segment_bytes: list[bytes] = [segment.getAudioData() for segment in speech]
+            if segment_number == 0 and trace is not None and label is not None:
+                trace.mark(f"{label}_tts_decoded")
+                source.on_play = lambda: trace.mark(f"{label}_playing")
 
-    transformed_bytes: list[bytes] = [modify_text_to_speech_audio(segment) for segment in segment_bytes]
+            # the queue belongs to the event loop, and we are on a worker thread
+            # the turn is checked again over there, in case someone barged in since we checked it here
+            client.loop.call_soon_threadsafe(partial(
+                client.queue_for_turn,
+                source,
+                turn,
+                priority=priority,
+                group=group,
+                replace=replace and segment_number == 0,
+            ))
 
-    sources: list[EnhancedSource] = [EnhancedFFmpegPCMAudioBytesTransformed.from_bytes(speech_bytes) for speech_bytes in
-                                     transformed_bytes]
+            if segment_number == 0:
+                TTS_TIME_TO_FIRST_AUDIO.observe(monotonic() - started_at)
+                if on_first_audio is not None:
+                    on_first_audio()
 
-    for source in sources:
-        client.queue.put_nowait(source)
+            segment_number += 1
+    finally:
+        for future in pending:
+            future.cancel()
 
 
-def make_talk_callable(client: CustomVoiceClient) -> Callable[[str], None]:
-    return lambda speech: speak(client, speech)
+def make_talk_callable(client: CustomVoiceClient, workers: VoiceWorkerPool | None = None) -> Callable[..., None]:
+    return lambda speech, **kwargs: speak(client, speech, workers=workers, **kwargs)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """revChatGPT raises plain Exceptions, so all we can go on is the message."""
+    message: str = str(error)
+    return message == "Wrong response code! Refreshing session..." or "429" in message
 
 
 class ChatGPTCog(Cog):
-    def __init__(self, bot: Bot, chatbot_factory: Callable[[], Awaitable[Chatbot]], assembly_key: str) -> None:
+    def __init__(
+            self,
+            bot: Bot,
+            chatbot_factory: Callable[[], Awaitable[Chatbot]],
+            assembly_key: str,
+            *,
+            stt_sample_rate: int = STT_SAMPLE_RATE,
+            transcription_backend: TranscriptionBackend | None = None,
+            chatbot_pool_size: int = CHATBOT_POOL_SIZE,
+            rate_limiter: TokenBucketRateLimiter | None = None,
+            answer_cache: AnswerCache | None = None,
+            metrics_path: str | None = None,
+            voice_workers: int = VOICE_WORKERS
+    ) -> None:
         self.bot: Bot = bot
         self.chatbot_factory: Callable[[], Awaitable[Chatbot]] = chatbot_factory
         self.assembly_key: str = assembly_key
-        self.chatbot: Chatbot | None = None
-        self._sync_chatbot_lock: Lock = Lock()
+        self.stt_sample_rate: int = stt_sample_rate
+        self.transcription_backend: TranscriptionBackend | None = transcription_backend  # None is AssemblyAI
+        self.chatbot_pool_size: int = chatbot_pool_size
+        self.chatbots: ChatbotPool | None = None
+        self._chatbots_task: Task[ChatbotPool] | None = None
+        self.rate_limiter: TokenBucketRateLimiter = rate_limiter or TokenBucketRateLimiter()
+        self.answer_cache: AnswerCache = answer_cache or AnswerCache()  # only for /ask without a conversation
+        self.metrics_path: str | None = metrics_path
+        self._metrics_task: Task | None = None
+        self.voice_worker_count: int = voice_workers
+        self.voice_workers: VoiceWorkerPool | None = None  # None does voice work in this process
+        self._voice_worker_monitor: Task | None = None
 
     @Cog.listener()
     async def on_ready(self) -> None:
         # py-cord sucks discord.py does this better
-        self.chatbot: Chatbot = await self.chatbot_factory()
-        logger.info("Chatbot is ready.")
+        # on_ready fires again on reconnect, and logging in again would forget which session has which conversation.
+        # only tried again if it failed last time
+        if self._chatbots_task is None or (self._chatbots_task.done() and self.chatbots is None):
+            self._chatbots_task = self.bot.loop.create_task(
+                ChatbotPool.create(self.chatbot_factory, self.chatbot_pool_size)
+            )
+            self.chatbots = await self._chatbots_task
+            logger.info(f"Chatbot pool of {len(self.chatbots)} is ready.")
+        if self.metrics_path is not None and self._metrics_task is None:  # on_ready fires again on reconnect
+            self._metrics_task = self.bot.loop.create_task(dump_periodically(self.metrics_path))
+        if self.voice_worker_count > 0 and self.voice_workers is None:
+            self.voice_workers = VoiceWorkerPool(self.voice_worker_count)
+            self._voice_worker_monitor = self.bot.loop.create_task(self.voice_workers.monitor())
+            logger.info(f"Voice worker pool of {len(self.voice_workers)} is ready.")
+
+    def cog_unload(self) -> None:
+        if self._voice_worker_monitor is not None:
+            self._voice_worker_monitor.cancel()
+        if self.voice_workers is not None:
+            self.voice_workers.shutdown()
 
     @Cog.listener("on_voice_state_update")  # ported from regulad/PepperCord
     async def on_left_alone(self, member: Member, before: VoiceState, after: VoiceState) -> None:
@@ -91,58 +285,233 @@ class ChatGPTCog(Cog):
             if len(before.channel.members) == 1:
                 await member.guild.voice_client.disconnect(force=False)
 
-    def ask_with_refresh(self, *args, **kwargs) -> Answer | None:
-        args_copy: tuple = args
-        kwargs_copy: dict = kwargs
+    @Cog.listener("on_voice_state_update")
+    async def on_disconnected(self, member: Member, before: VoiceState, after: VoiceState) -> None:
+        if member == self.bot.user and before.channel is not None and after.channel is None:
+            if self.voice_workers is not None:
+                self.voice_workers.release(member.guild.id)  # so the next guild to join is placed fairly
 
-        callback_on_extra_time: Callable[[], None] | None = kwargs.pop("callback_on_extra_time", None)
+    def ask_once(self, prompt: str, **kwargs) -> Answer:
+        """
+        Asks a question on whichever chatbot session the conversation belongs to. Blocks, so run it on a thread.
+        :param prompt: The question.
+        :param kwargs: Passed to Chatbot.ask.
+        """
+        if self.chatbots is None:
+            raise RuntimeError("Chatbot is not ready!")
 
-        with self._sync_chatbot_lock:
-            logger.info(f"Asking the Chatbot a question: {args[0]}")
+        with self.chatbots.checkout(kwargs.get("conversation_id")) as session:
+            logger.info(f"Asking Chatbot #{session.index} a question: {prompt}")
 
-            if self.chatbot is None:
-                raise RuntimeError("Chatbot is not ready!")
+            chatbot: Chatbot = session.chatbot
 
             if "conversation_id" in kwargs and kwargs["conversation_id"] is None:  # poor handling in library
-                self.chatbot.conversation_id = None
+                chatbot.conversation_id = None
 
+            mark("llm_start")
             try:
-                maybe_answer: Answer | None = self.chatbot.ask(*args, **kwargs)
+                maybe_answer: Answer | None = chatbot.ask(prompt, **kwargs)
                 if maybe_answer is None:
                     raise RuntimeError("Chatbot returned None!")
-                else:
-                    logger.info(f"Chatbot answered: {maybe_answer['message']}")
-                return maybe_answer
             except Exception as error:
                 logger.exception(f"Chatbot failed to answer: {error}")
-                if str(error) == "Wrong response code! Refreshing session...":
-                    if callback_on_extra_time is not None:
-                        callback_on_extra_time()
-                    blocking_sleep(60)
-                    return self.ask_with_refresh(*args_copy, **kwargs_copy)  # recurse!!!!! recurse!!!!
-
-    def async_ask_with_refresh(self, *args, **kwargs) -> Awaitable[Answer]:
-        return make_async(self.ask_with_refresh)(*args, **kwargs)
-
-    def make_speech_handler(self, client: CustomVoiceClient, conversation_id: str) -> Callable[[str], None]:
-        talk: Callable[[str], None] = make_talk_callable(client)
-        ratelimited: Callable[[], None] = lambda: talk(RATELIMIT_SPEECH)
-
-        def speech_handler(speech: str) -> None:
-            talk(BOT_ACKNOWLEDGE_SPEECH.format(speech=speech))
-
-            answer: Answer | None = None
-            while answer is None:
-                answer = self.ask_with_refresh(
-                    speech,
-                    conversation_id=conversation_id,
-                    callback_on_extra_time=ratelimited
+                raise
+
+            mark("llm_end")
+            logger.info(f"Chatbot answered: {maybe_answer['message']}")
+            self.chatbots.pin(maybe_answer["conversation_id"], session)
+            return maybe_answer
+
+    async def async_ask_with_refresh(
+            self,
+            prompt: str,
+            *,
+            on_rate_limited: Callable[[float], Awaitable[None]] | None = None,
+            max_attempts: int = LLM_MAX_ATTEMPTS,
+            **kwargs
+    ) -> Answer:
+        """
+        Asks a question, waiting on the rate limiter first and retrying (up to a point) if ChatGPT rejects it.
+        :param prompt: The question.
+        :param on_rate_limited: Awaited with the estimated wait, in seconds, whenever a request is rejected.
+        :param max_attempts: How many times to ask before giving up and raising the last error.
+        :param kwargs: Passed to ask_once.
+        """
+        for attempt in range(1, max_attempts + 1):
+            await self.rate_limiter.acquire()
+
+            try:
+                answer: Answer = await make_async(self.ask_once, get_default_executors().io)(prompt, **kwargs)
+            except Exception as error:
+                if not is_rate_limit_error(error):
+                    raise
+                backoff: float = self.rate_limiter.backoff()  # even on the last attempt, it's for everyone's sake
+                if attempt == max_attempts:
+                    raise
+                logger.warning(f"ChatGPT rejected attempt {attempt} of {max_attempts}, backing off for {backoff:.1f}s.")
+                if on_rate_limited is not None:
+                    await on_rate_limited(self.rate_limiter.estimate_wait())
+            else:
+                self.rate_limiter.succeeded()
+                return answer
+
+        raise AssertionError("unreachable")  # the last attempt either returns or raises
+
+    def make_speech_handlers(
+            self,
+            client: CustomVoiceClient,
+            conversation_id: str,
+            parent_id: str
+    ) -> tuple[Callable[[str, int], Awaitable[None]], Callable[[str, int], None], Callable[[int], None]]:
+        """
+        :param client: The voice client to talk on.
+        :param conversation_id: The conversation everything said in the channel belongs to.
+        :param parent_id: The last message in that conversation.
+        :return: A handler for final transcripts, one for partial transcripts,
+                 and one for someone starting to talk (safe to call from any thread).
+        """
+        talk: Callable[..., None] = make_talk_callable(client, self.voice_workers)
+        async_talk: Callable[..., Awaitable[None]] = make_async(talk, get_default_executors().speech)
+
+        # every question is asked as a reply to the last answer, explicitly, so a speculative question
+        # that gets thrown away doesn't become the parent of the next one
+        last_parent_id: str = parent_id
+        asking: AsyncLock = AsyncLock()  # one question at a time, so they chain instead of forking
+        speculators: dict[int, SpeculativeAsker] = {}
+        aggregators: dict[int, UtteranceAggregator] = {}
+        heard_at: dict[int, float] = {}  # when each user's last final transcript came in
+
+        def ask(prompt: str, reply_to: str, **kwargs) -> Awaitable[Answer]:
+            return self.async_ask_with_refresh(prompt, conversation_id=conversation_id, parent_id=reply_to, **kwargs)
+
+        def speculator_for(user: int) -> SpeculativeAsker:
+            if user not in speculators:
+                speculators[user] = SpeculativeAsker(
+                    lambda prompt, reply_to: ask(prompt, reply_to, max_attempts=1),  # don't spend retries on a guess
+                    lambda: last_parent_id,
+                    client.loop,
+                )
+            return speculators[user]
+
+        def aggregator_for(user: int) -> UtteranceAggregator:
+            if user not in aggregators:
+                aggregators[user] = UtteranceAggregator(speech_handler, user, client.loop)
+            return aggregators[user]
+
+        async def transcript_handler(speech: str, user: int) -> None:
+            heard_at[user] = monotonic()
+            aggregator_for(user).feed(speech)
+
+        def partial_speech_handler(partial_speech: str, user: int) -> None:
+            # only cut in once they've actually said something, not as soon as there's any noise
+            if BARGE_IN and len(partial_speech.split()) >= BARGE_IN_MIN_WORDS:
+                client.barge_in()
+            if partial_speech and user in aggregators:
+                aggregators[user].hold()
+            if LLM_SPECULATE:
+                speculator_for(user).on_partial(partial_speech)
+
+        def speech_start_handler(user: int) -> None:
+            def hold() -> None:
+                if user in aggregators:
+                    aggregators[user].hold()
+
+            client.loop.call_soon_threadsafe(hold)  # the sink calls this from its own thread
+
+        async def speech_handler(speech: str, user: int) -> None:
+            nonlocal last_parent_id
+
+            logger.info(f"{user} said: {speech}")
+
+            turn: int = client.turn  # if someone barges in, everything this says from then on is dropped
+            # run by the user's aggregator, which cancels this if they go on before the answer starts
+            this: Task | None = current_task()
+            aggregator: UtteranceAggregator = aggregator_for(user)
+
+            speech_ended_at: float = heard_at.get(user, monotonic())
+            first_audio_observed: bool = False
+
+            def on_first_audio() -> None:
+                nonlocal first_audio_observed
+                if not first_audio_observed:
+                    first_audio_observed = True
+                    ANSWER_TIME_TO_FIRST_AUDIO.observe(monotonic() - speech_ended_at)
+
+            async def ratelimited(wait: float) -> None:
+                # only the latest estimate is worth hearing
+                await async_talk(
+                    RATELIMIT_SPEECH.format(wait=describe_wait(wait)),
+                    turn=turn,
+                    priority=SpeechPriority.NOTICE,
+                    group=NOTICE_GROUP,
+                    replace=True
                 )
-                if answer is not None:
-                    ratelimited()
-            talk(answer["message"])
 
-        return speech_handler
+            await async_talk(
+                BOT_ACKNOWLEDGE_SPEECH.format(speech=speech),
+                turn=turn,
+                label="acknowledgement",
+                priority=SpeechPriority.ACKNOWLEDGEMENT
+            )
+
+            # spoken on a strand, so the answer queues behind the acknowledgement without holding up the loop
+            speaker: Executor = SerialExecutor(get_default_executors().speech)
+            spoken: list[Future[None]] = []
+            abandoned: bool = False
+
+            def say(text: str, **kwargs) -> None:
+                if abandoned:
+                    return
+                if not spoken:  # it's too late to take this back now
+                    client.loop.call_soon_threadsafe(aggregator.commit, this)
+                spoken.append(speaker.submit(
+                    copy_context().run,  # carry the trace over to the speaker thread
+                    talk,
+                    text,
+                    **({"on_first_audio": on_first_audio, "label": "answer"} | kwargs),
+                    turn=turn
+                ))
+
+            try:
+                async with asking:
+                    answer: Answer | None = await speculator_for(user).take(speech) if LLM_SPECULATE else None
+
+                    if answer is not None:
+                        mark("llm_start")  # as far as this turn is concerned, it took no time at all
+                        mark("llm_end")
+                    else:
+                        try:
+                            answer = await ask(speech, last_parent_id, on_rate_limited=ratelimited)
+                        except Exception:
+                            say(
+                                GAVE_UP_SPEECH,
+                                label=None,
+                                priority=SpeechPriority.NOTICE,
+                                group=NOTICE_GROUP,
+                                replace=True
+                            )
+                            raise
+
+                    last_parent_id = answer["parent_id"]
+
+                say(answer["message"])
+            except CancelledError:
+                # they went on, so this is asked again with the rest of it. the thread asking can't be stopped,
+                # but its answer goes nowhere
+                abandoned = True
+                speaker.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                if not abandoned:
+                    # surface synthesis errors here instead of losing them
+                    await gather(*(wrap_future(future) for future in spoken))
+                    speaker.shutdown(wait=False)
+
+                trace: Turn | None = current_turn.get()
+                if trace is not None:
+                    logger.info(f"Turn {trace.id} for {user}: {trace.elapsed()}")
+
+        return transcript_handler, partial_speech_handler, speech_start_handler
 
     @slash_command(guild_ids=GUILD_IDS)
     async def ask(self, ctx: ApplicationContext, prompt: str, conversation_id: str | None = None) -> None:
@@ -170,7 +539,13 @@ class ChatGPTCog(Cog):
                     ephemeral=True,
                 )
 
-        answer: Answer = await self.async_ask_with_refresh(prompt, conversation_id=conversation_id)
+        if conversation_id is None:
+            # a new conversation doesn't depend on anything but the prompt, so the same prompt gets the same answer
+            answer: Answer = await self.answer_cache.get_or_ask(
+                prompt, lambda: self.async_ask_with_refresh(prompt, conversation_id=None)
+            )
+        else:
+            answer: Answer = await self.async_ask_with_refresh(prompt, conversation_id=conversation_id)
 
         await ctx.interaction.followup.send(
             embed=(
@@ -244,15 +619,25 @@ class ChatGPTCog(Cog):
                                                                    conversation_id=None)  # make new conversation
         conversation_id: str = initial_answer["conversation_id"]
 
-        talk_callable: Callable[[str], None] = make_talk_callable(voice_client)
-        speech_handler: Callable[[str], None] = self.make_speech_handler(voice_client, conversation_id)
+        talk_callable: Callable[[str], None] = make_talk_callable(voice_client, self.voice_workers)
+        async_speech_handler, partial_speech_handler, speech_start_handler = self.make_speech_handlers(
+            voice_client, conversation_id, initial_answer["parent_id"]
+        )
 
-        async_talk_callable: Callable[[str], Awaitable[None]] = make_async(talk_callable)
-        async_speech_handler: Callable[[str], Awaitable[None]] = make_async(speech_handler)
+        async_talk_callable: Callable[[str], Awaitable[None]] = make_async(
+            talk_callable, get_default_executors().speech
+        )
 
         await async_talk_callable(initial_answer["message"])
 
-        sink: Sink = AssemblyAITranscriptionSink(self.assembly_key, async_speech_handler)
+        sink: Sink = AssemblyAITranscriptionSink(
+            self.assembly_key,
+            async_speech_handler,
+            handle_speech_start=speech_start_handler,
+            handle_partial_text=partial_speech_handler,
+            backend=self.transcription_backend,
+            sample_rate=self.stt_sample_rate
+        )
 
         voice_client.start_recording(sink=sink, callback=lambda anonymous_sink, *args: None)
 
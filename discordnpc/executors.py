@@ -0,0 +1,197 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from logging import Logger, getLogger
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable, Any
+
+from .metrics import Gauge, Histogram, gauge, histogram
+
+logger: Logger = getLogger(__name__)
+
+# Threads per workload class, shared by every guild.
+AUDIO_THREADS: int = 4  # receiving: resampling, VAD, chunking and encoding chunks for the STT websocket
+TTS_THREADS: int = 4  # speaking: synthesizing, decoding and Opus-encoding speech (or waiting on a voice worker to)
+SPEECH_THREADS: int = 8  # sequencing speech, i.e. waiting on each line to be synthesized and queued, in order
+IO_THREADS: int = 16  # other blocking calls that mostly wait, i.e. ChatGPT
+
+
+class WorkloadExecutor(ThreadPoolExecutor):
+    """A thread pool for one class of work that reports how much is waiting on it and how much it's doing."""
+
+    def __init__(self, name: str, max_workers: int) -> None:
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"{name.capitalize()}Pool")
+        self.name: str = name
+        self.queue_depth: Gauge = gauge(f"executor_{name}_queue_depth", f"Jobs waiting for a {name} thread.")
+        self.busy_threads: Gauge = gauge(f"executor_{name}_busy_threads", f"{name.capitalize()} threads running a job.")
+        self.wait: Histogram = histogram(
+            f"executor_{name}_wait_seconds", f"Time jobs spent waiting for a {name} thread."
+        )
+        self.queue_depth.set(0)
+        self.busy_threads.set(0)
+
+    def submit(self, fn: Callable[..., Any], /, *args, **kwargs) -> Future:
+        queued_at: float = monotonic()
+
+        def run() -> Any:
+            self.queue_depth.dec()
+            self.busy_threads.inc()
+            self.wait.observe(monotonic() - queued_at)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.busy_threads.dec()
+
+        self.queue_depth.inc()  # before submitting, so a job that starts straight away never takes it below 0
+        try:
+            future: Future = super().submit(run)
+        except BaseException:
+            self.queue_depth.dec()
+            raise
+        # a job cancelled before it started never runs, so it never leaves the queue by itself
+        future.add_done_callback(lambda done: self.queue_depth.dec() if done.cancelled() else None)
+        return future
+
+
+class SerialExecutor(Executor):
+    """
+    Runs what's submitted to it one at a time and in order, on threads borrowed from a shared executor.
+    This is for state that can't be touched from two threads at once, like a speaker's resampler and VAD,
+    without every sink needing its own thread. Each job goes back on the shared executor's queue,
+    so a busy strand takes turns with everything else instead of holding on to a thread.
+    """
+
+    def __init__(self, executor: Executor) -> None:
+        self.executor: Executor = executor
+        self._queue: deque[tuple[Future, Callable[..., Any], tuple, dict]] = deque()
+        self._lock: Lock = Lock()
+        self._scheduled: bool = False
+        self._shutdown: bool = False
+        self._idle: Event = Event()
+        self._idle.set()
+
+    def submit(self, fn: Callable[..., Any], /, *args, **kwargs) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queue.append((future, fn, args, kwargs))
+            if self._scheduled:
+                return future
+            self._scheduled = True
+            self._idle.clear()
+        self._schedule()
+        return future
+
+    def _schedule(self) -> None:
+        try:
+            self.executor.submit(self._run_next)
+        except RuntimeError as error:  # the shared executor was shut down under us
+            with self._lock:
+                abandoned: list[Future] = [future for future, *_ in self._queue]
+                self._queue.clear()
+                self._scheduled = False
+                self._idle.set()
+            for future in abandoned:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+
+    def _run_next(self) -> None:
+        with self._lock:
+            if not self._queue:  # everything was cancelled by shutdown
+                self._scheduled = False
+                self._idle.set()
+                return
+            future, fn, args, kwargs = self._queue.popleft()
+
+        if future.set_running_or_notify_cancel():
+            try:
+                result: Any = fn(*args, **kwargs)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        with self._lock:
+            if not self._queue:
+                self._scheduled = False
+                self._idle.set()
+                return
+        self._schedule()
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        """Stops taking jobs. The shared executor is left alone."""
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                for future, *_ in self._queue:
+                    future.cancel()
+                self._queue.clear()
+        if wait:
+            self._idle.wait()
+
+
+class ExecutorManager:
+    """
+    The thread pools everything blocking runs on, one per class of work, so a pile of slow ChatGPT requests
+    can't hold up speech and speech can't hold up listening.
+    Work that has to happen in order gets a strand of one of these instead of a thread of its own.
+    """
+
+    def __init__(
+            self,
+            *,
+            audio: int = AUDIO_THREADS,
+            tts: int = TTS_THREADS,
+            speech: int = SPEECH_THREADS,
+            io: int = IO_THREADS,
+    ) -> None:
+        self.audio: WorkloadExecutor = WorkloadExecutor("audio", audio)
+        self.tts: WorkloadExecutor = WorkloadExecutor("tts", tts)
+        # not tts: these wait on tts jobs, so sharing it could deadlock. not io: they'd wait behind ChatGPT
+        self.speech: WorkloadExecutor = WorkloadExecutor("speech", speech)
+        self.io: WorkloadExecutor = WorkloadExecutor("io", io)
+
+    def shutdown(self, wait: bool = True) -> None:
+        for executor in (self.audio, self.tts, self.speech, self.io):
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_default_executors: ExecutorManager | None = None
+
+
+def get_default_executors() -> ExecutorManager:
+    """Get the process-wide executors. Default sizes unless set_default_executors was called."""
+    global _default_executors
+    if _default_executors is None:
+        _default_executors = ExecutorManager()
+    return _default_executors
+
+
+def set_default_executors(executors: ExecutorManager) -> None:
+    global _default_executors
+    _default_executors = executors
+
+
+__all__ = (
+    "WorkloadExecutor", "SerialExecutor", "ExecutorManager", "get_default_executors", "set_default_executors"
+)
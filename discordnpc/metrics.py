@@ -0,0 +1,206 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import json
+import os
+from asyncio import sleep
+from collections import deque
+from threading import Lock
+
+# Tiny in-process metrics. Everything in here is touched from the event loop, the sink executors and the player threads,
+# so every mutation happens under a lock.
+
+
+class Counter:
+    def __init__(self, name: str, description: str = "") -> None:
+        self.name: str = name
+        self.description: str = description
+        self._value: float = 0
+        self._lock: Lock = Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Gauge:
+    def __init__(self, name: str, description: str = "") -> None:
+        self.name: str = name
+        self.description: str = description
+        self._value: float = 0
+        self._lock: Lock = Lock()
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class Histogram:
+    """Keeps running totals plus a bounded window of recent observations for percentiles."""
+
+    def __init__(self, name: str, description: str = "", *, window: int = 1024) -> None:
+        self.name: str = name
+        self.description: str = description
+        self.count: int = 0
+        self.total: float = 0.0
+        self.min: float | None = None
+        self.max: float | None = None
+        self._recent: deque[float] = deque(maxlen=window)
+        self._lock: Lock = Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            self._recent.append(value)
+
+    @property
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count > 0 else None
+
+    def percentile(self, percent: float) -> float | None:
+        """
+        Get a percentile over the recent observation window.
+        :param percent: The percentile to get, from 0 to 100.
+        :return: The value, or None if nothing has been observed yet.
+        """
+        with self._lock:
+            recent: list[float] = sorted(self._recent)
+        if len(recent) == 0:
+            return None
+        index: int = min(len(recent) - 1, max(0, round(percent / 100 * (len(recent) - 1))))
+        return recent[index]
+
+
+_registry: dict[str, Counter | Gauge | Histogram] = {}
+_registry_lock: Lock = Lock()
+
+
+def _get_or_create(kind: type, name: str, description: str, **kwargs):
+    with _registry_lock:
+        existing: Counter | Gauge | Histogram | None = _registry.get(name)
+        if existing is None:
+            existing = _registry[name] = kind(name, description, **kwargs)
+        elif not isinstance(existing, kind):
+            raise TypeError(f"Metric {name} is already registered as a {type(existing).__name__}")
+        return existing
+
+
+def counter(name: str, description: str = "") -> Counter:
+    """Get the counter with this name, registering it if it does not exist yet."""
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name: str, description: str = "") -> Gauge:
+    """Get the gauge with this name, registering it if it does not exist yet."""
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name: str, description: str = "", *, window: int = 1024) -> Histogram:
+    """Get the histogram with this name, registering it if it does not exist yet."""
+    return _get_or_create(Histogram, name, description, window=window)
+
+
+def all_metrics() -> list[Counter | Gauge | Histogram]:
+    with _registry_lock:
+        return list(_registry.values())
+
+
+SUMMARY_QUANTILES: tuple[float, ...] = (0.5, 0.9, 0.99)
+
+
+def render_prometheus() -> str:
+    """
+    Dump every metric in the Prometheus text exposition format.
+    Histograms are exposed as summaries, since we keep a window of observations and not buckets.
+    """
+    lines: list[str] = []
+    for metric in sorted(all_metrics(), key=lambda registered: registered.name):
+        if metric.description:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+        if isinstance(metric, Histogram):
+            lines.append(f"# TYPE {metric.name} summary")
+            for quantile in SUMMARY_QUANTILES:
+                value: float | None = metric.percentile(quantile * 100)
+                lines.append(f'{metric.name}{{quantile="{quantile}"}} {"NaN" if value is None else value}')
+            lines.append(f"{metric.name}_sum {metric.total}")
+            lines.append(f"{metric.name}_count {metric.count}")
+        else:
+            lines.append(f"# TYPE {metric.name} {'counter' if isinstance(metric, Counter) else 'gauge'}")
+            lines.append(f"{metric.name} {metric.value}")
+    return "\n".join(lines) + "\n"
+
+
+def render_json() -> str:
+    """Dump every metric as a JSON object keyed by name."""
+    dump: dict[str, dict] = {}
+    for metric in all_metrics():
+        if isinstance(metric, Histogram):
+            dump[metric.name] = {
+                "type": "histogram",
+                "count": metric.count,
+                "sum": metric.total,
+                "min": metric.min,
+                "max": metric.max,
+                "mean": metric.mean,
+                **{f"p{round(quantile * 100)}": metric.percentile(quantile * 100) for quantile in SUMMARY_QUANTILES},
+            }
+        else:
+            dump[metric.name] = {
+                "type": "counter" if isinstance(metric, Counter) else "gauge",
+                "value": metric.value,
+            }
+    return json.dumps(dump, indent=2, sort_keys=True)
+
+
+async def dump_periodically(path: str, *, interval: float = 15.0) -> None:
+    """
+    Write every metric to a file every so often, forever. JSON if the path ends in .json, Prometheus text otherwise,
+    which is what node_exporter's textfile collector reads. The file is replaced atomically.
+    """
+    while True:
+        rendered: str = render_json() if path.endswith(".json") else render_prometheus()
+        with open(f"{path}.tmp", "w") as fp:
+            fp.write(rendered)
+        os.replace(f"{path}.tmp", path)
+        await sleep(interval)
+
+
+__all__ = (
+    "Counter", "Gauge", "Histogram", "counter", "gauge", "histogram", "all_metrics", "render_prometheus", "render_json",
+    "dump_periodically"
+)
@@ -0,0 +1,213 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import json
+from argparse import ArgumentParser, Namespace
+from asyncio import Queue, Future, sleep, run, get_running_loop
+from base64 import b64decode
+from datetime import datetime, timedelta, timezone
+from logging import Logger, getLogger, basicConfig, INFO
+from random import Random
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+
+import websockets
+
+from .transcription import (
+    ASSEMBLYAI_SESSION_BEGINS_MESSAGE, ASSEMBLYAI_SESSION_TERMINATED_MESSAGE, ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE,
+    ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE
+)
+
+# A local stand-in for AssemblyAI's realtime API, so the voice pipeline can be load-tested and profiled offline.
+# Run it with `poetry run python -m discordnpc.mock_stt` and set DNPC_STT_ENDPOINT to the URL it prints.
+
+MOCK_STT_DEFAULT_PORT: int = 8765
+MOCK_STT_DEFAULT_TEXT: str = "this is a transcript from the mock speech to text server"
+MOCK_STT_MS_PER_WORD: int = 300  # how fast the partial transcripts grow
+MOCK_STT_END_OF_UTTERANCE_MS: int = 500  # this much trailing silence in a chunk finalizes the utterance
+
+logger: Logger = getLogger(__name__)
+
+
+class MockTranscriptionServer:
+    """
+    Speaks the same protocol as AssemblyAI's realtime websocket (SessionBegins, PartialTranscript, FinalTranscript,
+    SessionTerminated), answering every chunk with a transcript after a configurable latency and jitter.
+    Replies on a connection always go out in order, jitter never reorders them.
+    """
+
+    def __init__(
+            self,
+            *,
+            host: str = "127.0.0.1",
+            port: int = MOCK_STT_DEFAULT_PORT,
+            latency: float = 0.3,
+            jitter: float = 0.1,
+            text: str = MOCK_STT_DEFAULT_TEXT,
+            seed: int | None = None,
+    ) -> None:
+        """
+        :param host: The host to listen on.
+        :param port: The port to listen on. 0 picks a free one.
+        :param latency: Seconds between a chunk arriving and its transcript being sent.
+        :param jitter: Up to this many seconds are randomly added to the latency.
+        :param text: What everybody says, according to this server.
+        :param seed: Seeds the jitter, for repeatable runs.
+        """
+        self.host: str = host
+        self.port: int = port
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.words: list[str] = text.split()
+        self.random: Random = Random(seed)
+
+        self.sessions: int = 0
+        self.chunks_received: int = 0
+        self.audio_ms_received: int = 0
+        self.transcripts_sent: int = 0
+
+        self._server: websockets.WebSocketServer | None = None
+
+    @property
+    def endpoint(self) -> str:
+        """The URL to give AssemblyAIBackend, with the same {sample_rate} placeholder as the real one."""
+        return f"ws://{self.host}:{self.port}/v2/realtime/ws?sample_rate={{sample_rate}}"
+
+    async def start(self) -> None:
+        self._server = await websockets.serve(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]  # in case it was 0
+        logger.info(f"Mock speech to text server listening on {self.endpoint}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _reply_in_order(self, websocket: websockets.WebSocketServerProtocol, replies: Queue) -> None:
+        loop = get_running_loop()
+        while True:
+            due, message = await replies.get()
+            await sleep(max(0.0, due - loop.time()))
+            if message is None:
+                return
+            try:
+                await websocket.send(json.dumps(message))
+            except websockets.ConnectionClosed:
+                return
+            if message["message_type"] in (ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE, ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE):
+                self.transcripts_sent += 1
+
+    def _transcript(self, message_type: str, utterance_ms: int, audio_start: int, audio_end: int) -> dict:
+        word_count: int = (
+            len(self.words) if message_type == ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE
+            else min(len(self.words), utterance_ms // MOCK_STT_MS_PER_WORD)
+        )
+        return {
+            "message_type": message_type,
+            "text": " ".join(self.words[:word_count]),
+            "audio_start": audio_start,
+            "audio_end": audio_end,
+            "confidence": 1.0,
+            "words": [],
+            "created": datetime.now(timezone.utc).isoformat(),
+        }
+
+    async def _handle(self, websocket: websockets.WebSocketServerProtocol) -> None:
+        loop = get_running_loop()
+        query: dict[str, list[str]] = parse_qs(urlparse(websocket.path).query)
+        sample_rate: int = int(query.get("sample_rate", ["16000"])[0])
+        bytes_per_ms: float = sample_rate * 2 / 1000  # mono s16le
+        end_of_utterance_bytes: int = int(MOCK_STT_END_OF_UTTERANCE_MS * bytes_per_ms)
+
+        self.sessions += 1
+        await websocket.send(json.dumps({
+            "message_type": ASSEMBLYAI_SESSION_BEGINS_MESSAGE,
+            "session_id": str(uuid4()),
+            "expires_at": (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat(),
+        }))
+
+        replies: Queue = Queue()
+        replier: Future = loop.create_task(self._reply_in_order(websocket, replies))
+        last_due: float = 0.0
+        stream_ms: int = 0
+        utterance_start_ms: int = 0
+
+        try:
+            async for raw in websocket:
+                payload: dict = json.loads(raw)
+
+                if payload.get("terminate_session"):
+                    replies.put_nowait((last_due, {"message_type": ASSEMBLYAI_SESSION_TERMINATED_MESSAGE}))
+                    break
+
+                audio: bytes = b64decode(payload["audio_data"])
+                self.chunks_received += 1
+                chunk_ms: int = int(len(audio) / bytes_per_ms)
+                self.audio_ms_received += chunk_ms
+                stream_ms += chunk_ms
+
+                due: float = max(last_due, loop.time() + self.latency + self.random.uniform(0, self.jitter))
+                last_due = due
+
+                tail: bytes = audio[-end_of_utterance_bytes:]
+                final: bool = len(tail) == end_of_utterance_bytes and not any(tail)
+                replies.put_nowait((due, self._transcript(
+                    ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE if final else ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE,
+                    stream_ms - utterance_start_ms,
+                    utterance_start_ms,
+                    stream_ms,
+                )))
+                if final:
+                    utterance_start_ms = stream_ms
+
+            replies.put_nowait((last_due, None))
+            await replier  # let the last replies (i.e. SessionTerminated) go out before the connection closes
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            replier.cancel()
+
+
+def main() -> None:
+    parser: ArgumentParser = ArgumentParser(description="Run a local stand-in for AssemblyAI's realtime API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=MOCK_STT_DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds before each chunk is answered.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Up to this many extra seconds, at random.")
+    parser.add_argument("--text", default=MOCK_STT_DEFAULT_TEXT, help="What the transcripts say.")
+    args: Namespace = parser.parse_args()
+
+    basicConfig(level=INFO)
+
+    async def serve() -> None:
+        server: MockTranscriptionServer = MockTranscriptionServer(
+            host=args.host, port=args.port, latency=args.latency, jitter=args.jitter, text=args.text
+        )
+        await server.start()
+        await Future()  # forever
+
+    run(serve())
+
+
+if __name__ == "__main__":
+    main()
+
+
+__all__ = ("MockTranscriptionServer",)
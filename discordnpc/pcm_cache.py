@@ -0,0 +1,275 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from hashlib import sha256
+from logging import Logger, getLogger
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Callable
+
+from .metrics import Counter, counter
+
+logger: Logger = getLogger(__name__)
+
+PCMBuffer = bytes | mmap.mmap
+
+DEFAULT_MEMORY_BUDGET_BYTES: int = 64 * 1024 * 1024  # ~6 minutes of 48kHz stereo s16le
+DEFAULT_DISK_BUDGET_BYTES: int = 1024 * 1024 * 1024  # ~1.5 hours, every answer is written, so this fills up
+
+PCM_CACHE_HITS: Counter = counter("pcm_cache_hits_total", "Lookups answered from memory or disk.")
+PCM_CACHE_MISSES: Counter = counter("pcm_cache_misses_total", "Lookups that had to synthesize audio.")
+PCM_CACHE_COLLAPSED: Counter = counter(
+    "pcm_cache_collapsed_total", "Lookups that waited on an identical synthesis already in flight."
+)
+PCM_CACHE_DISK_EVICTIONS: Counter = counter(
+    "pcm_cache_disk_evictions_total", "Files deleted from the disk tier to keep it under its budget."
+)
+
+
+class PCMCache:
+    """
+    A content-addressed cache for decoded PCM.
+    The first tier is an in-memory LRU bounded by bytes, the second is an optional directory of raw PCM files,
+    also an LRU bounded by bytes (by modification time, which is bumped on every hit).
+    Disk hits are promoted back into memory.
+    """
+
+    def __init__(
+            self,
+            *,
+            max_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES,
+            directory: str | None = None,
+            max_disk_bytes: int = DEFAULT_DISK_BUDGET_BYTES,
+    ) -> None:
+        """
+        :param max_bytes: How much PCM to keep in memory.
+        :param directory: Where to keep PCM on disk. None keeps it in memory only.
+        :param max_disk_bytes: How much PCM to keep on disk. Processes sharing a directory each enforce it
+                               on what they know about, which is everything that was there when they started
+                               plus what they wrote since.
+        """
+        self.max_bytes: int = max_bytes
+        self.directory: str | None = directory
+        self.max_disk_bytes: int = max_disk_bytes
+
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes: int = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # key to file size, least recently used first
+        self._disk_bytes: int = 0
+        self._in_flight: dict[str, Future[PCMBuffer]] = {}
+        self._lock: Lock = Lock()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._scan_disk()
+
+    @staticmethod
+    def key(*parts: str | bytes) -> str:
+        """
+        Make a cache key out of anything that determines the decoded audio, i.e. (text, language, transform).
+        :param parts: The parts of the key, in order.
+        :return: A hex digest that is safe to use as a filename.
+        """
+        digest = sha256()
+        for part in parts:
+            encoded: bytes = part.encode("utf-8") if isinstance(part, str) else part
+            digest.update(len(encoded).to_bytes(8, "little"))  # length-prefix so ("ab", "c") != ("a", "bc")
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    @property
+    def disk_bytes(self) -> int:
+        return self._disk_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pcm")
+
+    def _scan_disk(self) -> None:
+        """Picks up what's already on disk, oldest first, and trims it to the budget."""
+        entries: list[os.DirEntry] = [
+            entry for entry in os.scandir(self.directory) if entry.is_file() and entry.name.endswith(".pcm")
+        ]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            size: int = entry.stat().st_size
+            self._disk[entry.name.removesuffix(".pcm")] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Deletes the least recently used files until the disk tier fits its budget."""
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            with self._lock:
+                key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+            try:
+                os.unlink(self._path(key))  # an mmap that's still open keeps working
+            except FileNotFoundError:
+                pass  # another process sharing the directory got to it first
+            except OSError:
+                logger.exception(f"Failed to delete {key} from the disk cache")
+            PCM_CACHE_DISK_EVICTIONS.inc()
+
+    def _remember(self, key: str, pcm: bytes) -> None:
+        """Put something in the memory tier. Must be called with the lock held."""
+        if len(pcm) > self.max_bytes:
+            return  # would just evict everything else
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = pcm
+        self._memory_bytes += len(pcm)
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_disk(self, key: str) -> PCMBuffer | None:
+        if self.directory is None:
+            return None
+        path: str = self._path(key)
+        try:
+            with open(path, "rb") as fp:
+                if os.fstat(fp.fileno()).st_size == 0:
+                    pcm: PCMBuffer = b""  # can't mmap an empty file
+                else:
+                    pcm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)  # the mapping outlives the fd
+            os.utime(path)  # the disk tier evicts by modification time
+        except FileNotFoundError:
+            with self._lock:  # evicted by another process
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+        except OSError:
+            logger.exception(f"Failed to read {key} from the disk cache")
+            return None
+        with self._lock:
+            if key not in self._disk:  # written by another process
+                self._disk_bytes += len(pcm)
+            self._disk[key] = len(pcm)
+            self._disk.move_to_end(key)
+        self._evict_disk()
+        return pcm
+
+    def _write_disk(self, key: str, pcm: bytes) -> None:
+        if self.directory is None or len(pcm) > self.max_disk_bytes:
+            return
+        try:
+            with NamedTemporaryFile(dir=self.directory, delete=False) as fp:
+                fp.write(pcm)
+            os.replace(fp.name, self._path(key))  # atomic, readers never see half a file
+        except OSError:
+            logger.exception(f"Failed to write {key} to the disk cache")
+            return
+        with self._lock:
+            self._disk_bytes += len(pcm) - self._disk.pop(key, 0)
+            self._disk[key] = len(pcm)
+        self._evict_disk()
+
+    def _get_memory(self, key: str) -> bytes | None:
+        """Must be called with the lock held."""
+        pcm: bytes | None = self._memory.get(key)
+        if pcm is not None:
+            self._memory.move_to_end(key)
+        return pcm
+
+    def get(self, key: str) -> PCMBuffer | None:
+        with self._lock:
+            pcm: bytes | None = self._get_memory(key)
+        if pcm is not None:
+            return pcm
+        mapped: PCMBuffer | None = self._read_disk(key)
+        if mapped is None or len(mapped) > self.max_bytes:
+            return mapped  # too big for memory, it stays in the page cache
+        pcm = bytes(mapped)
+        with self._lock:
+            self._remember(key, pcm)  # it's wanted again, so keep it close
+        return pcm
+
+    def put(self, key: str, pcm: bytes) -> None:
+        with self._lock:
+            self._remember(key, pcm)
+        self._write_disk(key, pcm)
+
+    def get_or_create(self, key: str, factory: Callable[[], bytes]) -> PCMBuffer:
+        """
+        Get something from the cache, making it with the factory if it isn't there.
+        If another thread is already making the same key, this waits for its result instead of making it again.
+        :param key: The key, probably made with PCMCache.key.
+        :param factory: A blocking callable that returns the decoded PCM.
+        :return: The PCM, as bytes or as a read-only mmap.
+        """
+        cached: PCMBuffer | None = self.get(key)
+        if cached is not None:
+            PCM_CACHE_HITS.inc()
+            return cached
+
+        with self._lock:
+            # another thread may have finished making it since we looked
+            cached = self._get_memory(key)
+            if cached is None:
+                in_flight: Future[PCMBuffer] | None = self._in_flight.get(key)
+                owner: bool = in_flight is None
+                if owner:
+                    in_flight = self._in_flight[key] = Future()
+
+        if cached is not None:
+            PCM_CACHE_HITS.inc()
+            return cached
+
+        if not owner:
+            PCM_CACHE_COLLAPSED.inc()
+            return in_flight.result()
+
+        PCM_CACHE_MISSES.inc()
+        try:
+            pcm: bytes = factory()
+        except BaseException as exc:
+            in_flight.set_exception(exc)
+            raise
+        else:
+            self.put(key, pcm)
+            in_flight.set_result(pcm)
+            return pcm
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+_default_cache: PCMCache | None = None
+
+
+def get_default_cache() -> PCMCache:
+    """Get the process-wide cache. Memory-only unless set_default_cache was called with a directory."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = PCMCache()
+    return _default_cache
+
+
+def set_default_cache(cache: PCMCache) -> None:
+    global _default_cache
+    _default_cache = cache
+
+
+__all__ = ("PCMCache", "get_default_cache", "set_default_cache")
@@ -17,24 +17,47 @@
 """
 from __future__ import annotations
 
-import shlex
-import subprocess
+import audioop
 from abc import ABC
-from asyncio import Queue, Future, Task, wait_for
+from asyncio import AbstractEventLoop, Event as AsyncEvent, Queue, QueueFull, Future, Task, wait_for
 from collections import deque
-from io import BytesIO
-from typing import Optional, cast
+from enum import IntEnum
+from threading import Event as ThreadingEvent, Lock
+from time import monotonic, perf_counter
+from typing import Callable, Hashable, NamedTuple, Optional, cast
 
-from discord import VoiceClient, Client, AudioSource, TextChannel, Thread, ClientException, PCMVolumeTransformer
+from discord import VoiceClient, Client, AudioSource, TextChannel, Thread, PCMVolumeTransformer
 from discord import abc
 from discord.opus import Encoder
 
+from .decoders import PCMDecoder, FFmpegDecoder, get_default_decoder
+from .metrics import Counter, Histogram, counter, histogram
+from .pcm_cache import PCMBuffer, PCMCache, get_default_cache
+
 
 # These features are ported from another project of mine, regulad/PepperCord, which uses a custom Voice Client.
 # It is modified here to work with py-cord.
 
+CONTINUOUS_PLAYBACK: bool = True  # one player for a whole burst of speech, turn off to compare against the old way
+CONTINUOUS_PLAYBACK_IDLE_TIMEOUT: float = 2.0  # seconds of silence before the player stops, and we stop "speaking"
+
+FRAME_SECONDS: float = Encoder.FRAME_LENGTH / 1000
+OPUS_SILENCE_FRAME: bytes = b"\xf8\xff\xfe"
+
+PLAYBACK_GAP: Histogram = histogram(
+    "playback_gap_seconds",
+    "Dead air between one segment of speech ending and the next starting, when the next was already waiting.",
+)
+
+BARGE_INS: Counter = counter("barge_ins_total", "Times the bot was talked over and stopped talking.")
+BARGE_IN_DROPPED_SOURCES: Counter = counter(
+    "barge_in_dropped_sources_total", "Queued segments of speech thrown away because the bot was talked over."
+)
+
 
 class EnhancedSource(AudioSource, ABC):
+    on_play: Optional[Callable[[], None]] = None  # called just before the source starts playing, for tracing
+
     @property
     def duration(self) -> Optional[int]:
         """Get the length of the source. If this is not feasible, you can return None."""
@@ -56,30 +79,370 @@ class EnhancedSource(AudioSource, ABC):
         return self
 
 
+class SpeechPriority(IntEnum):
+    """Which lane of the queue speech waits in. Lower lanes play first, each lane is first in, first out."""
+
+    NOTICE = 0  # short lines about what's going on, i.e. rate limit apologies, they're useless if they're late
+    ACKNOWLEDGEMENT = 1
+    ANSWER = 2
+
+
+# How long speech can wait to start playing before it's stale and thrown away. None waits forever.
+# Once one segment of a group has started playing, the rest of the group is exempt, so long answers aren't cut off.
+AUDIO_QUEUE_MAX_WAIT: dict[SpeechPriority, Optional[float]] = {
+    SpeechPriority.NOTICE: 15.0,
+    SpeechPriority.ACKNOWLEDGEMENT: 10.0,
+    SpeechPriority.ANSWER: 60.0,
+}
+
+AUDIO_QUEUE_WAIT: dict[SpeechPriority, Histogram] = {
+    priority: histogram(
+        f"audio_queue_{priority.name.lower()}_wait_seconds",
+        f"Time {priority.name.lower()} speech spent queued before it started playing.",
+    )
+    for priority in SpeechPriority
+}
+AUDIO_QUEUE_EXPIRED: Counter = counter(
+    "audio_queue_expired_total", "Queued segments of speech thrown away unplayed because they waited too long."
+)
+AUDIO_QUEUE_REPLACED: Counter = counter(
+    "audio_queue_replaced_total", "Queued segments of speech thrown away because newer speech replaced their group."
+)
+AUDIO_QUEUE_REJECTED: Counter = counter(
+    "audio_queue_rejected_total", "Segments of speech thrown away, or refused, because the queue was full."
+)
+
+
+class QueuedSpeech(NamedTuple):
+    source: EnhancedSource
+    priority: SpeechPriority
+    group: Hashable  # segments of one reply share a group, so they can be replaced or expired together
+    queued_at: float
+    deadline: Optional[float]  # monotonic, None never expires
+
+
 class AudioQueue(Queue[EnhancedSource]):
+    """
+    Speech waiting to be played, in priority lanes. Speech that waits too long is thrown away unplayed,
+    and every segment of one reply can be replaced at once by queueing its replacement in the same group.
+    If maxsize is set and the queue is full, the newest, least important speech makes way,
+    or if nothing queued is less important than what's being queued, that is refused with QueueFull.
+    Only use from the event loop.
+    """
+
     def _init(self, maxsize: int) -> None:
-        self._queue: deque[EnhancedSource] = (
-            deque(maxlen=maxsize) if maxsize > 0 else deque()
-        )
+        self._queue: dict[SpeechPriority, deque[QueuedSpeech]] = {priority: deque() for priority in SpeechPriority}
+        self._group_sizes: dict[Hashable, int] = {}
+        self._started_groups: set[Hashable] = set()  # groups that have started playing, and have more queued
+        self.wait_times: Histogram = Histogram("audio_queue_wait_seconds", window=256)  # just this queue's
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self._queue.values())
+
+    def empty(self) -> bool:
+        self._expire()
+        return not any(self._queue.values())
+
+    def _forget(self, item: QueuedSpeech) -> None:
+        self._group_sizes[item.group] -= 1
+        if self._group_sizes[item.group] == 0:
+            del self._group_sizes[item.group]
+            self._started_groups.discard(item.group)
+
+    def _remove(self, condition: Callable[[QueuedSpeech], bool]) -> list[QueuedSpeech]:
+        removed: list[QueuedSpeech] = []
+        for priority, lane in self._queue.items():
+            if any(condition(item) for item in lane):
+                removed.extend(item for item in lane if condition(item))
+                self._queue[priority] = deque(item for item in lane if not condition(item))
+        for item in removed:
+            self._forget(item)
+            item.source.cleanup()  # free the decoded audio now, not whenever it's collected
+        return removed
+
+    def _expire(self) -> None:
+        now: float = monotonic()
+
+        def is_stale(item: QueuedSpeech) -> bool:
+            return item.deadline is not None and item.deadline <= now and item.group not in self._started_groups
+
+        stale_groups: set[Hashable] = {
+            item.group for lane in self._queue.values() for item in lane if is_stale(item)
+        }
+        if stale_groups:
+            # a reply with a hole in it is worse than no reply, so the rest of the group goes too
+            expired: list[QueuedSpeech] = self._remove(lambda item: item.group in stale_groups)
+            AUDIO_QUEUE_EXPIRED.inc(len(expired))
 
     def _get(self) -> EnhancedSource:
-        return self._queue.popleft()
+        lane: deque[QueuedSpeech] = next(lane for lane in self._queue.values() if lane)
+        item: QueuedSpeech = lane.popleft()
+        self._forget(item)
+        if item.group in self._group_sizes:
+            self._started_groups.add(item.group)
+        waited: float = monotonic() - item.queued_at
+        AUDIO_QUEUE_WAIT[item.priority].observe(waited)
+        self.wait_times.observe(waited)
+        return item.source
+
+    def _put(self, item: QueuedSpeech | EnhancedSource) -> None:
+        if not isinstance(item, QueuedSpeech):
+            item = self.make_item(item)
+        self._queue[item.priority].append(item)
+        self._group_sizes[item.group] = self._group_sizes.get(item.group, 0) + 1
 
-    def _put(self, item: EnhancedSource) -> None:
-        self._queue.append(item)
+    @staticmethod
+    def make_item(
+            source: EnhancedSource,
+            *,
+            priority: SpeechPriority = SpeechPriority.ANSWER,
+            group: Hashable | None = None,
+            max_wait: Optional[float] = None,
+    ) -> QueuedSpeech:
+        """
+        :param source: What to play.
+        :param priority: Which lane to wait in.
+        :param group: The reply this is part of. None is a group of its own.
+        :param max_wait: Seconds it can wait to start playing. Defaults to AUDIO_QUEUE_MAX_WAIT for its priority.
+        """
+        now: float = monotonic()
+        max_wait = AUDIO_QUEUE_MAX_WAIT[priority] if max_wait is None else max_wait
+        return QueuedSpeech(
+            source,
+            priority,
+            group if group is not None else object(),
+            now,
+            now + max_wait if max_wait is not None else None,
+        )
+
+    def put_nowait(self, item: QueuedSpeech | EnhancedSource) -> None:
+        if not isinstance(item, QueuedSpeech):
+            item = self.make_item(item)
+        if self.full():
+            self._expire()
+        if self.full():
+            lowest: Optional[SpeechPriority] = max(
+                (priority for priority, lane in self._queue.items() if lane and priority > item.priority),
+                default=None,
+            )
+            if lowest is None:
+                AUDIO_QUEUE_REJECTED.inc()
+                raise QueueFull
+            evicted: QueuedSpeech = self._queue[lowest].pop()
+            self._forget(evicted)
+            evicted.source.cleanup()
+            AUDIO_QUEUE_REJECTED.inc()
+        super().put_nowait(item)
+
+    def replace_group(self, group: Hashable) -> int:
+        """
+        Throws away everything queued in a group, i.e. before queueing what replaces it.
+        :return: How many segments were thrown away.
+        """
+        replaced: int = len(self._remove(lambda item: item.group == group))
+        AUDIO_QUEUE_REPLACED.inc(replaced)
+        return replaced
+
+    def clear(self) -> int:
+        """
+        Throws away everything queued.
+        :return: How many segments were thrown away.
+        """
+        return len(self._remove(lambda item: True))
 
     @property
     def deque(self) -> deque:
-        return self._queue
+        """Everything queued, in the order it would play."""
+        return deque(item.source for lane in self._queue.values() for item in lane)
 
 
 def _maybe_exception(future: Future[None], exception: Optional[Exception]) -> None:
+    if future.done():
+        return  # i.e. the waiter was cancelled
     if exception is not None:
         future.set_exception(exception)
     else:
         future.set_result(None)
 
 
+class _GapMeter:
+    """
+    Works out PLAYBACK_GAP from when frames are read. A new AudioPlayer sleeps an extra frame after its first one,
+    so the gap runs up to the second frame of the next segment, not the first.
+    """
+
+    def __init__(self) -> None:
+        self.last_frame_at: Optional[float] = None
+        self._gap_from: Optional[float] = None
+        self._frames: int = 0
+
+    def segment_started(self, gap_from: Optional[float]) -> None:
+        """:param gap_from: When the last frame of the segment before was read, if this one was waiting on it."""
+        self._gap_from = gap_from
+        self._frames = 0
+
+    def frame(self) -> None:
+        now: float = perf_counter()
+        if self._gap_from is not None:
+            self._frames += 1
+            if self._frames == 2:
+                PLAYBACK_GAP.observe(max(0.0, now - self._gap_from - 2 * FRAME_SECONDS))
+                self._gap_from = None
+        self.last_frame_at = now
+
+
+class _GapTimer(AudioSource):
+    """Wraps a source played on its own AudioPlayer to measure PLAYBACK_GAP."""
+
+    def __init__(self, source: AudioSource, gap_from: Optional[float]) -> None:
+        self.source: AudioSource = source
+        self.meter: _GapMeter = _GapMeter()
+        self.meter.segment_started(gap_from)
+
+    def read(self) -> bytes:
+        frame: bytes = self.source.read()
+        if frame:
+            self.meter.frame()
+        return frame
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        self.source.cleanup()
+
+
+class ContinuousSource(EnhancedSource):
+    """
+    One source that keeps playing for as long as there's speech, so py-cord's AudioPlayer (a new thread,
+    and telling Discord we're speaking) starts once per burst of speech instead of once per segment.
+    The event loop hands it the next segment while the current one plays, and it switches between two frames.
+    With nothing to play it plays silence, until it has been idle for a while and ends.
+    read() is called from the player thread, the rest is safe from any thread.
+    """
+
+    def __init__(self, loop: AbstractEventLoop, *, idle_timeout: float = CONTINUOUS_PLAYBACK_IDLE_TIMEOUT) -> None:
+        self.loop: AbstractEventLoop = loop
+        self.max_idle_frames: int = max(1, int(idle_timeout / FRAME_SECONDS))
+        self.closed: bool = False
+
+        self.current: Optional[EnhancedSource] = None  # only touched on the player thread, except by cleanup
+        self._next: Optional[EnhancedSource] = None  # prefetched, guarded by _lock
+        self._lock: Lock = Lock()
+        self._space: AsyncEvent = AsyncEvent()  # set on the loop when _next is taken, or we close
+        self._skip: ThreadingEvent = ThreadingEvent()
+
+        self._current_is_opus: bool = True
+        self._idle_frames: int = 0
+        self._gap_meter: _GapMeter = _GapMeter()
+
+    @property
+    def duration(self) -> Optional[int]:
+        return None
+
+    @property
+    def busy(self) -> bool:
+        """If it has speech playing or waiting to play, rather than only silence."""
+        with self._lock:
+            return not self.closed and (self.current is not None or self._next is not None)
+
+    def _notify_space(self) -> None:
+        self.loop.call_soon_threadsafe(self._space.set)
+
+    def offer(self, source: EnhancedSource) -> bool:
+        """
+        Gives it the next source to play, if it doesn't already have one waiting.
+        :return: If it was taken. If not, either wait_for_space and try again, or it's closed and won't take any.
+        """
+        with self._lock:
+            if self.closed or self._next is not None:
+                return False
+            self._next = source
+            return True
+
+    async def wait_for_space(self) -> None:
+        """Waits until the source waiting to play starts playing, or this closes. Call on the loop."""
+        self._space.clear()
+        with self._lock:
+            if self.closed or self._next is None:
+                return
+        await self._space.wait()
+
+    def skip(self) -> int:
+        """
+        Throws away what's playing and what's waiting to play. Safe from any thread.
+        :return: How many sources were thrown away.
+        """
+        with self._lock:
+            waiting: Optional[EnhancedSource] = self._next
+            self._next = None
+        if waiting is not None:
+            waiting.cleanup()
+            self._notify_space()
+        self._skip.set()  # the player thread drops the current one before its next frame
+        return (waiting is not None) + (self.current is not None)
+
+    def _take_next(self) -> None:
+        with self._lock:
+            self.current, self._next = self._next, None
+        if self.current is not None:
+            self._notify_space()
+            if self.current.on_play is not None:
+                self.current.on_play()
+
+    def read(self) -> bytes:
+        if self._skip.is_set():
+            self._skip.clear()
+            if self.current is not None:
+                self.current.cleanup()
+                self.current = None
+            self._gap_meter.segment_started(None)
+
+        if self.current is None:
+            self._take_next()
+
+        while self.current is not None:
+            frame: bytes = self.current.read()
+            if frame:
+                self._gap_meter.frame()
+                self._idle_frames = 0
+                self._current_is_opus = self.current.is_opus()
+                return frame
+
+            # that one is done, go straight on to the next one if it's already here
+            self.current.cleanup()
+            with self._lock:
+                waiting: bool = self._next is not None
+            self._gap_meter.segment_started(self._gap_meter.last_frame_at if waiting else None)
+            self._take_next()
+
+        self._idle_frames += 1
+        if self._idle_frames > self.max_idle_frames:
+            with self._lock:
+                if self._next is None:
+                    self.closed = True
+            if self.closed:
+                self._notify_space()
+                return b""  # the player stops, and speaking with it
+
+        self._current_is_opus = True
+        return OPUS_SILENCE_FRAME
+
+    def is_opus(self) -> bool:
+        return self._current_is_opus  # of the frame read last, which is the one being sent
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self.closed = True
+            waiting: Optional[EnhancedSource] = self._next
+            self._next = None
+        for source in (self.current, waiting):
+            if source is not None:
+                source.cleanup()
+        self.current = None
+        self._notify_space()
+
+
 class CustomVoiceClient(VoiceClient):
     @staticmethod
     async def create(connectable: abc.Connectable, **kwargs) -> CustomVoiceClient:
@@ -96,6 +459,13 @@ class CustomVoiceClient(VoiceClient):
 
         self.wait_for: Optional[int] = None
 
+        self.turn: int = 0  # bumped on every barge-in, speech queued for an older turn is stale
+
+        self.continuous: bool = CONTINUOUS_PLAYBACK
+        self._continuous_source: Optional[ContinuousSource] = None
+        self._continuous_done: Optional[Future[None]] = None
+        self._handing_over: Optional[EnhancedSource] = None  # taken off the queue, not yet taken by the player
+
     def __getitem__(self, item):
         return self._custom_state[item]
 
@@ -117,9 +487,84 @@ class CustomVoiceClient(VoiceClient):
 
     def play_future(self, source: AudioSource) -> Future[None]:
         future: Future[None] = self.loop.create_future()
-        self.play(source, after=lambda exception: _maybe_exception(future, exception))
+        # after is called on the player thread, and futures belong to the loop
+        self.play(source, after=lambda exception: self.loop.call_soon_threadsafe(_maybe_exception, future, exception))
         return future
 
+    def queue_for_turn(
+            self,
+            source: EnhancedSource,
+            turn: int,
+            *,
+            priority: SpeechPriority = SpeechPriority.ANSWER,
+            group: Hashable | None = None,
+            replace: bool = False,
+            max_wait: Optional[float] = None,
+    ) -> bool:
+        """
+        Queues a source unless the turn it was made for is over. Must be called from the event loop.
+        :param source: What to play.
+        :param turn: The turn it was made for.
+        :param priority: Which lane of the queue it waits in.
+        :param group: The reply it's part of, see AudioQueue.
+        :param replace: Throw away whatever is still queued in the group first.
+        :param max_wait: Seconds it can wait to start playing. Defaults to AUDIO_QUEUE_MAX_WAIT for its priority.
+        :return: If it was queued.
+        """
+        if turn != self.turn:
+            source.cleanup()
+            BARGE_IN_DROPPED_SOURCES.inc()
+            return False
+        if replace and group is not None:
+            self._audio_queue.replace_group(group)
+        try:
+            self._audio_queue.put_nowait(
+                AudioQueue.make_item(source, priority=priority, group=group, max_wait=max_wait)
+            )
+        except QueueFull:
+            source.cleanup()
+            return False
+        return True
+
+    def is_speaking(self) -> bool:
+        """If any speech is playing or queued, as opposed to nothing or the continuous player's silence."""
+        if self._handing_over is not None or not self._audio_queue.empty():
+            return True
+        if self._continuous_source is not None and not self._continuous_source.closed:
+            return self._continuous_source.busy
+        return self.is_playing() or self.is_paused()
+
+    def barge_in(self) -> int:
+        """
+        Someone started talking over us: stop what's playing and throw away everything that's queued,
+        so whatever we say next is about what they're saying now. Must be called from the event loop.
+        If we aren't saying anything, nothing happens, so answers that are still being worked on aren't thrown away.
+        :return: The current turn. Anything still being synthesized for an older turn shouldn't be queued.
+        """
+        if not self.is_speaking():
+            return self.turn
+
+        self.turn += 1
+
+        dropped: int = self._audio_queue.clear()
+
+        if self._handing_over is not None:
+            self._handing_over.cleanup()
+            self._handing_over = None
+            dropped += 1
+
+        if self._continuous_source is not None and not self._continuous_source.closed:
+            dropped += self._continuous_source.skip()  # it keeps going, there's likely more to say soon
+        elif self.is_playing() or self.is_paused():
+            self.stop()  # the player thread cleans up the current source
+            dropped += 1
+
+        if dropped > 0:
+            BARGE_INS.inc()
+            BARGE_IN_DROPPED_SOURCES.inc(dropped)
+
+        return self.turn
+
     async def _run(self) -> None:
         """
         Plays tracks from the queue while tracks remain on the queue.
@@ -127,17 +572,27 @@ class CustomVoiceClient(VoiceClient):
         If the timeout is reached, a TimeoutError will be thrown.
         """
         try:
+            gap_from: Optional[float] = None
+
             while True:
                 track: EnhancedSource = await wait_for(
                     self._audio_queue.get(), self.wait_for
                 )
 
+                if self.continuous and not self.should_loop:
+                    await self._hand_over(track)
+                    continue
+
                 while True:
                     track: EnhancedSource = await track.refresh(self)
+                    if track.on_play is not None:
+                        track.on_play()
+                    timer: _GapTimer = _GapTimer(track, gap_from)
                     try:
-                        await self.play_future(track)
+                        await self.play_future(timer)
                     except Exception:
                         pass  # We don't care. Go on to the next one!
+                    gap_from = timer.meter.last_frame_at if not self._audio_queue.empty() else None
                     if not self.should_loop:
                         break
         except TimeoutError:
@@ -150,6 +605,38 @@ class CustomVoiceClient(VoiceClient):
             if self.is_connected():
                 await self.disconnect(force=False)
 
+    async def _hand_over(self, track: EnhancedSource) -> None:
+        """Gets a track to the continuous source, starting one if it isn't running. Refreshes it while it waits."""
+        self._handing_over = track
+        track = await track.refresh(self)
+        if self._handing_over is None:
+            track.cleanup()  # someone barged in while it was refreshing
+            return
+        self._handing_over = track
+
+        while self._handing_over is not None:
+            continuous: Optional[ContinuousSource] = self._continuous_source
+
+            if continuous is None or continuous.closed:
+                if self._continuous_done is not None:
+                    try:
+                        await self._continuous_done  # the player thread might still be on its way out
+                    except Exception:
+                        pass
+                    if self._handing_over is None:
+                        return
+                self._continuous_source = ContinuousSource(self.loop)
+                self._continuous_source.offer(self._handing_over)
+                self._handing_over = None
+                self._continuous_done = self.play_future(self._continuous_source)
+                return
+
+            if continuous.offer(self._handing_over):
+                self._handing_over = None
+                return
+
+            await continuous.wait_for_space()
+
     async def disconnect(self, *, force: bool = False) -> None:
         await super().disconnect(force=force)
         if not self._task.done():
@@ -157,7 +644,12 @@ class CustomVoiceClient(VoiceClient):
 
     @property
     def source(self) -> Optional[EnhancedSource]:
-        return cast(EnhancedSource, super().source)
+        source: Optional[AudioSource] = super().source
+        if isinstance(source, ContinuousSource):
+            return source.current
+        if isinstance(source, _GapTimer):
+            return cast(EnhancedSource, source.source)
+        return cast(EnhancedSource, source)
 
     @property
     def ms_read(self) -> Optional[int]:
@@ -178,57 +670,60 @@ class CustomVoiceClient(VoiceClient):
             return self.ms_read / self.source.duration
 
 
-class FFmpegPCMAudioBytes(AudioSource):
-    """A hacky workaround to playing PCM audio with bytes."""
+class PCMAudioBytes(AudioSource):
+    """Plays already-decoded 48kHz stereo s16le PCM, either from bytes or straight out of an mmap."""
+
+    def __init__(self, pcm: PCMBuffer):
+        self._pcm: memoryview = memoryview(pcm)
+        self._position: int = 0
+
+    def read(self):
+        end: int = self._position + Encoder.FRAME_SIZE
+        if end > len(self._pcm):
+            return b""
+        ret = self._pcm[self._position:end].tobytes()
+        self._position = end
+        return ret
+
+    @property
+    def pcm(self) -> memoryview:
+        return self._pcm
+
+    def cleanup(self):
+        self._pcm = memoryview(b"")  # drop the decoded audio
+
+
+class FFmpegPCMAudioBytes(PCMAudioBytes):
+    """
+    A hacky workaround to playing PCM audio with bytes.
+    Despite the name, decoding is done by a PCMDecoder, which is in-process when miniaudio is available.
+    Passing any of the ffmpeg options forces the ffmpeg decoder.
+    Decoded audio is looked up in (and added to) a PCMCache by the hash of the source bytes.
+    """
 
     def __init__(
             self,
             source: bytes,
             *,
+            decoder: Optional[PCMDecoder] = None,
+            cache: Optional[PCMCache] = None,
             executable="ffmpeg",
             pipe=True,
             stderr=None,
             before_options=None,
             options=None
     ):
-        stdin = None if not pipe else source
-        args = [executable]
-        if isinstance(before_options, str):
-            args.extend(shlex.split(before_options))
-        args.append("-i")
-        args.append("-" if pipe else source)
-        args.extend(("-f", "s16le", "-ar", "48000", "-ac", "2", "-loglevel", "warning"))
-        if isinstance(options, str):
-            args.extend(shlex.split(options))
-        args.append("pipe:1")
-        self._process = None
-        try:
-            self._process = subprocess.Popen(
-                args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
-            )
-            self._stdout = BytesIO(self._process.communicate(input=stdin)[0])
-        except FileNotFoundError:
-            raise ClientException(executable + " was not found.") from None
-        except subprocess.SubprocessError as exc:
-            raise ClientException(
-                "Popen failed: {0.__class__.__name__}: {0}".format(exc)
-            ) from exc
-
-    def read(self):
-        ret = self._stdout.read(Encoder.FRAME_SIZE)
-        if len(ret) != Encoder.FRAME_SIZE:
-            return b""
-        return ret
-
-    def cleanup(self):
-        proc = self._process
-        if proc is None:
-            return
-        proc.kill()
-        if proc.poll() is None:
-            proc.communicate()
-
-        self._process = None
+        if decoder is None:
+            if executable != "ffmpeg" or not pipe or stderr is not None or before_options or options:
+                decoder = FFmpegDecoder(
+                    executable=executable, pipe=pipe, stderr=stderr, before_options=before_options, options=options
+                )
+            else:
+                decoder = get_default_decoder()
+        if cache is None:
+            cache = get_default_cache()
+        key: str = PCMCache.key(source, before_options or "", options or "")  # options can change the output
+        super().__init__(cache.get_or_create(key, lambda: decoder.decode(source)))
 
 
 class EnhancedTransformerSource(PCMVolumeTransformer, EnhancedSource, ABC):
@@ -237,7 +732,7 @@ class EnhancedTransformerSource(PCMVolumeTransformer, EnhancedSource, ABC):
 
 
 class EnhancedFFmpegPCMAudioBytesTransformed(EnhancedTransformerSource):
-    def __init__(self, source: FFmpegPCMAudioBytes, *, volume: float = 1.0):
+    def __init__(self, source: PCMAudioBytes, *, volume: float = 1.0):
         super().__init__(source, volume=volume)
 
     async def refresh(self, client: CustomVoiceClient) -> EnhancedSource:
@@ -248,10 +743,73 @@ class EnhancedFFmpegPCMAudioBytesTransformed(EnhancedTransformerSource):
     def from_bytes(cls, source: bytes, *, volume: float = 1.0, **kwargs) -> EnhancedSource:
         return cls(FFmpegPCMAudioBytes(source, **kwargs), volume=volume)
 
+    @classmethod
+    def from_pcm(cls, pcm: PCMBuffer, *, volume: float = 1.0) -> EnhancedSource:
+        return cls(PCMAudioBytes(pcm), volume=volume)
+
+
+def encode_opus(pcm: PCMBuffer, *, volume: float = 1.0) -> list[bytes]:
+    """
+    Encode 48kHz stereo s16le PCM into Opus packets, one per frame.
+    A trailing partial frame is dropped, same as PCMAudioBytes does.
+    """
+    if volume != 1.0:
+        pcm = audioop.mul(pcm, 2, min(max(volume, 0.0), 2.0))  # same clamping as PCMVolumeTransformer
+    encoder: Encoder = Encoder()
+    return [
+        encoder.encode(bytes(pcm[offset:offset + Encoder.FRAME_SIZE]), Encoder.SAMPLES_PER_FRAME)
+        for offset in range(0, len(pcm) - Encoder.FRAME_SIZE + 1, Encoder.FRAME_SIZE)
+    ]
+
+
+class EnhancedOpusAudioBytes(EnhancedSource):
+    """
+    Serves Opus packets that were encoded ahead of time, so the player thread doesn't have to encode every frame.
+    Volume is baked in when the packets are encoded, it can't be changed during playback.
+    """
+
+    def __init__(self, packets: list[bytes]):
+        self._packets: list[bytes] = packets
+        self._index: int = 0
+
+    @property
+    def duration(self) -> Optional[int]:
+        return len(self._packets) * Encoder.FRAME_LENGTH
+
+    def read(self):
+        if self._index >= len(self._packets):
+            return b""
+        ret = self._packets[self._index]
+        self._index += 1
+        return ret
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._packets = []
+
+    async def refresh(self, client: CustomVoiceClient) -> EnhancedSource:
+        # This source does not need to refresh.
+        return self
+
+    @classmethod
+    def from_pcm(cls, pcm: PCMBuffer, *, volume: float = 1.0) -> EnhancedSource:
+        """
+        Encode 48kHz stereo s16le PCM into Opus packets. This is blocking, so don't call it on the event loop.
+        """
+        return cls(encode_opus(pcm, volume=volume))
+
+    @classmethod
+    def from_bytes(cls, source: bytes, *, volume: float = 1.0, **kwargs) -> EnhancedSource:
+        return cls.from_pcm(FFmpegPCMAudioBytes(source, **kwargs).pcm, volume=volume)
+
 
 # welcome to coupling HELL
-# (only two classes AudioQueue and EnhancedFFmpegPCMAudioBytesTransformed are actually useful)
+# (only AudioQueue and the Enhanced*AudioBytes* sources are actually useful)
 __all__ = [
-    "CustomVoiceClient", "EnhancedSource", "AudioQueue", "FFmpegPCMAudioBytes", "EnhancedTransformerSource",
-    "EnhancedFFmpegPCMAudioBytesTransformed"
+    "CustomVoiceClient", "EnhancedSource", "SpeechPriority", "QueuedSpeech", "AudioQueue", "ContinuousSource",
+    "PCMAudioBytes",
+    "FFmpegPCMAudioBytes", "EnhancedTransformerSource", "EnhancedFFmpegPCMAudioBytesTransformed",
+    "EnhancedOpusAudioBytes", "encode_opus"
 ]
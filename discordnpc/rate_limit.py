@@ -0,0 +1,135 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from asyncio import CancelledError, sleep
+from random import Random
+from time import monotonic
+
+from .metrics import Counter, Histogram, counter, histogram
+
+LLM_REQUESTS_PER_MINUTE: float = 12.0
+LLM_BURST: int = 3
+LLM_BACKOFF_BASE: float = 10.0  # seconds, doubled for every rejection in a row
+LLM_BACKOFF_CAP: float = 120.0
+LLM_MAX_ATTEMPTS: int = 5
+
+LLM_RATE_LIMIT_WAIT: Histogram = histogram(
+    "llm_rate_limit_wait_seconds", "Time requests spent waiting on the rate limiter before being sent."
+)
+LLM_BACKOFFS: Counter = counter("llm_backoffs_total", "Requests ChatGPT rejected, each of which started a backoff.")
+
+
+class TokenBucketRateLimiter:
+    """
+    Spaces out requests to ChatGPT with a token bucket, and backs off (exponentially, capped, with jitter)
+    whenever ChatGPT rejects one anyway.
+    Waiting happens with asyncio.sleep, so no thread is tied up, and the wait can be estimated ahead of time
+    so the user can be told how long it will be.
+    acquire() must be called from the event loop. estimate_wait() is safe to call from anywhere.
+    """
+
+    def __init__(
+            self,
+            *,
+            requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+            burst: int = LLM_BURST,
+            backoff_base: float = LLM_BACKOFF_BASE,
+            backoff_cap: float = LLM_BACKOFF_CAP,
+            seed: int | None = None,
+    ) -> None:
+        """
+        :param requests_per_minute: How fast tokens come back.
+        :param burst: How many tokens the bucket holds, i.e. how many requests can go out back to back.
+        :param backoff_base: How long to back off after the first rejection.
+        :param backoff_cap: The longest a single backoff can be.
+        :param seed: Seeds the jitter, for repeatable runs.
+        """
+        self.rate: float = requests_per_minute / 60
+        self.burst: int = burst
+        self.backoff_base: float = backoff_base
+        self.backoff_cap: float = backoff_cap
+        self.random: Random = Random(seed)
+
+        self._tokens: float = burst  # can go negative, that's requests that have reserved a token that's coming
+        self._updated: float = monotonic()
+        self._blocked_until: float = 0.0
+        self._failures: int = 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def estimate_wait(self) -> float:
+        """How long a request made now would have to wait, in seconds."""
+        now: float = monotonic()
+        tokens: float = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        token_wait: float = (1 - tokens) / self.rate if tokens < 1 else 0.0
+        return max(token_wait, self._blocked_until - now, 0.0)
+
+    async def acquire(self) -> None:
+        """Waits until a request can be sent."""
+        started_at: float = monotonic()
+
+        self._refill(started_at)
+        self._tokens -= 1  # reserve one now so requests are served in the order they arrive
+        try:
+            if self._tokens < 0:
+                await sleep(-self._tokens / self.rate)
+
+            while (blocked_for := self._blocked_until - monotonic()) > 0:  # a backoff may have started while we slept
+                await sleep(blocked_for)
+        except CancelledError:
+            # the request was never sent, so give the token back for whoever asks next
+            # (anyone already waiting has worked out their wait and keeps it)
+            self._refill(monotonic())
+            self._tokens = min(self.burst, self._tokens + 1)
+            raise
+
+        LLM_RATE_LIMIT_WAIT.observe(monotonic() - started_at)
+
+    def backoff(self) -> float:
+        """
+        Call when a request is rejected. Blocks everything for a while, longer each time in a row.
+        :return: How long the backoff is.
+        """
+        LLM_BACKOFFS.inc()
+        self._failures += 1
+        ceiling: float = min(self.backoff_cap, self.backoff_base * 2 ** (self._failures - 1))
+        delay: float = self.random.uniform(ceiling / 2, ceiling)  # jitter so retries from every guild don't line up
+        self._blocked_until = max(self._blocked_until, monotonic() + delay)
+        return delay
+
+    def succeeded(self) -> None:
+        """Call when a request gets through, so the next backoff starts small again."""
+        self._failures = 0
+
+
+def describe_wait(seconds: float) -> str:
+    """Turns a wait into something that sounds right coming out of TTS, i.e. "about 2 minutes"."""
+    if seconds < 10:
+        return "a few seconds"
+    elif seconds < 50:
+        return f"about {round(seconds / 5) * 5} seconds"
+    elif seconds < 90:
+        return "about a minute"
+    else:
+        return f"about {round(seconds / 60)} minutes"
+
+
+__all__ = ("TokenBucketRateLimiter", "describe_wait")
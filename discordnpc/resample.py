@@ -0,0 +1,121 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from math import gcd
+
+import numpy as np
+from discord.opus import Decoder
+
+SAMPLE_WIDTH: int = 2  # s16le
+
+RESAMPLE_TAPS: int = 63  # of the low-pass filter per output sample, about 1.3ms at 48kHz
+RESAMPLE_CUTOFF: float = 0.45  # of the lower rate, just under its Nyquist frequency
+
+
+def lowpass_taps(cutoff: float, taps: int) -> np.ndarray:
+    """
+    A windowed-sinc low-pass filter.
+    :param cutoff: The cutoff frequency, as a fraction of the sample rate.
+    :param taps: The length of the filter.
+    :return: The filter's taps, normalized to unity gain at DC.
+    """
+    n: np.ndarray = np.arange(taps) - (taps - 1) / 2
+    h: np.ndarray = np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return h / h.sum()
+
+
+def to_s16(samples: np.ndarray) -> bytes:
+    """Rounds float samples to s16le, clipping the filter's overshoot. Modifies samples."""
+    np.rint(samples, out=samples)
+    np.minimum(samples, 32767, out=samples)  # much cheaper than np.clip on arrays this small
+    np.maximum(samples, -32768, out=samples)
+    return samples.astype(np.int16).tobytes()
+
+
+class MonoResampler:
+    """
+    Downmixes one speaker's 48kHz stereo s16le from py-cord to mono and resamples it for speech-to-text.
+    Resampling is polyphase: the low-pass filter that stops everything above the output rate's Nyquist frequency
+    folding back into the speech band is only ever evaluated for the samples that are kept.
+    48kHz to 16kHz is one phase, every third input sample starts a window.
+    The filter's history and the position between calls are carried over, so packets can be fed in
+    one at a time without clicks.
+    """
+
+    def __init__(self, output_rate: int, *, input_rate: int = Decoder.SAMPLING_RATE) -> None:
+        self.input_rate: int = input_rate
+        self.output_rate: int = output_rate
+
+        # upsample by up, filter, downsample by down, without ever making the upsampled signal
+        divisor: int = gcd(input_rate, output_rate)
+        self.up: int = output_rate // divisor
+        self.down: int = input_rate // divisor
+
+        h: np.ndarray = lowpass_taps(
+            RESAMPLE_CUTOFF * min(input_rate, output_rate) / (input_rate * self.up), RESAMPLE_TAPS * self.up
+        ) * self.up  # upsampling spreads the signal over up times as many samples
+        # phase p's taps are h[p], h[p + up], ..., reversed so they line up with a window of the input
+        self._phases: np.ndarray = h.reshape(RESAMPLE_TAPS, self.up).T[:, ::-1].astype(np.float32)
+
+        self._history: np.ndarray = np.zeros(RESAMPLE_TAPS - 1, dtype=np.float32)
+        self._consumed: int = 0  # input samples so far
+        self._produced: int = 0  # output samples so far
+        self._remainder: bytes = b""  # only whole stereo frames can be downmixed
+
+    def process(self, data: bytes) -> bytes:
+        if self._remainder:
+            data = self._remainder + data
+        frame_bytes: int = SAMPLE_WIDTH * Decoder.CHANNELS
+        whole: int = len(data) - len(data) % frame_bytes
+        self._remainder = data[whole:]
+
+        stereo: np.ndarray = np.frombuffer(data, dtype=np.int16, count=whole // SAMPLE_WIDTH).astype(np.float32)
+        mono: np.ndarray = (stereo[0::2] + stereo[1::2]) * 0.5
+        if self.output_rate == self.input_rate:
+            return to_s16(mono)
+
+        signal: np.ndarray = np.concatenate((self._history, mono))
+        start: int = self._consumed
+        self._consumed += len(mono)
+        self._history = signal[len(signal) - len(self._history):]
+
+        # every output sample whose last input sample is here
+        first: int = self._produced
+        self._produced = -(-self._consumed * self.up // self.down)
+        count: int = self._produced - first
+        if count == 0:
+            return b""
+
+        # a window starting at signal[i] ends on the input sample i counting from the first one of this call.
+        # these are views, nothing is copied
+        stride: int = signal.strides[0]
+        if self.up == 1:
+            # one phase, so the windows are evenly spaced
+            offset: int = (first * self.down - start) * stride
+            windows: np.ndarray = np.ndarray(
+                (count, RESAMPLE_TAPS), np.float32, signal, offset, (self.down * stride, stride)
+            )
+            return to_s16(np.einsum("ij,j->i", windows, self._phases[0]))
+
+        positions: np.ndarray = np.arange(first, self._produced, dtype=np.int64) * self.down
+        windows = np.ndarray((len(signal) - RESAMPLE_TAPS + 1, RESAMPLE_TAPS), np.float32, signal, 0, (stride, stride))
+        return to_s16(np.einsum("ij,ij->i", windows[positions // self.up - start], self._phases[positions % self.up]))
+
+
+__all__ = ("MonoResampler",)
@@ -0,0 +1,101 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from typing import Iterator
+
+
+class ChunkRingBuffer:
+    """
+    Accumulates one speaker's PCM in a preallocated ring and hands it back out in fixed-size, frame-aligned chunks.
+
+    Incoming data is copied exactly once, into the ring, and every chunk is copied exactly once, out of it.
+    The capacity is always a whole number of chunks and chunks are always read from chunk boundaries,
+    so a chunk never straddles the end of the ring and can be sliced straight out of it.
+    If the ring fills up it grows instead of dropping anything.
+    """
+
+    def __init__(self, chunk_bytes: int, *, frame_bytes: int = 4, chunks: int = 4) -> None:
+        """
+        :param chunk_bytes: How big each emitted chunk should be. Rounded down to a whole number of frames.
+        :param frame_bytes: The size of one sample frame, i.e. 4 for stereo s16le.
+        :param chunks: How many chunks to preallocate room for.
+        """
+        self.frame_bytes: int = frame_bytes
+        self.chunk_bytes: int = chunk_bytes - chunk_bytes % frame_bytes
+        if self.chunk_bytes <= 0:
+            raise ValueError("chunk_bytes must be at least one frame")
+
+        self._buffer: bytearray = bytearray(self.chunk_bytes * chunks)
+        self._view: memoryview = memoryview(self._buffer)
+        self._start: int = 0
+        self._size: int = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buffer)
+
+    def _grow(self, needed: int) -> None:
+        chunks: int = max(2 * self.capacity, needed) // self.chunk_bytes + 1
+        buffer: bytearray = bytearray(chunks * self.chunk_bytes)
+        # unroll into the new buffer so the contents start at 0 again
+        first: int = min(self._size, self.capacity - self._start)
+        buffer[:first] = self._view[self._start:self._start + first]
+        buffer[first:self._size] = self._view[:self._size - first]
+        self._view.release()
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start = 0
+
+    def write(self, data: bytes) -> None:
+        if self._size + len(data) > self.capacity:
+            self._grow(self._size + len(data))
+
+        source: memoryview = memoryview(data)
+        end: int = (self._start + self._size) % self.capacity
+        first: int = min(len(data), self.capacity - end)
+        self._view[end:end + first] = source[:first]
+        if first < len(data):
+            self._view[:len(data) - first] = source[first:]  # wraps around
+        self._size += len(data)
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yields every complete chunk currently in the buffer, oldest first."""
+        while self._size >= self.chunk_bytes:
+            chunk: bytes = self._view[self._start:self._start + self.chunk_bytes].tobytes()
+            self._start = (self._start + self.chunk_bytes) % self.capacity
+            self._size -= self.chunk_bytes
+            yield chunk
+
+    def flush(self) -> bytes:
+        """Empties the buffer, returning whatever whole frames were left in it (which is less than a chunk)."""
+        size: int = self._size - self._size % self.frame_bytes
+        first: int = min(size, self.capacity - self._start)
+        tail: bytes = (
+            self._view[self._start:self._start + first].tobytes()
+            + self._view[:size - first].tobytes()
+        )
+        self._start = 0
+        self._size = 0
+        return tail
+
+
+__all__ = ("ChunkRingBuffer",)
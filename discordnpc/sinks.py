@@ -17,44 +17,53 @@
 """
 from __future__ import annotations
 
-import json
-from asyncio import sleep, Task, run_coroutine_threadsafe
-from base64 import b64encode
-from concurrent.futures import ThreadPoolExecutor, Executor
+from collections import deque
+from concurrent.futures import Executor
 from logging import Logger, getLogger
-from typing import Awaitable, Callable, Any, Iterator
+from time import monotonic
+from typing import Callable, Awaitable
 
-import websockets
 from discord import VoiceClient
 from discord.sinks import Filters, PCMSink
 
-ASSEMBLYAI_ENDPOINT = "wss://api.assemblyai.com/v2/realtime/ws?sample_rate={sample_rate}"
-
-ASSEMBLYAI_MINIMUM_LENGTH_MS = 100
-ASSEMBLYAI_MAXIMUM_LENGTH_MS = 2000
+from .executors import SerialExecutor, get_default_executors
+from .metrics import Counter, counter
+from .resample import MonoResampler, SAMPLE_WIDTH
+from .ring_buffer import ChunkRingBuffer
+from .tracing import Turn, active_turn
+from .transcription import (
+    TranscriptionBackend, AssemblyAIBackend, TranscriptionSession, TranscriptionSessionManager, WarmConnectionPool,
+    WarmConnectionPools, GLOBAL_WARM_POOLS, STT_MAX_SESSIONS_PER_GUILD,
+    ASSEMBLYAI_MINIMUM_LENGTH_MS, ASSEMBLYAI_MAXIMUM_LENGTH_MS
+)
+from .vad import VAD_SPEECH_RATIO, VoiceActivityDetector
 
 # ==START HACKY CODE==
 ASSEMBLYAI_USABLE_MINIMUM_LENGTH_MS = 1000
 # AssemblyAI's minimum length is 100ms, but it's not very good at that length.
-# This is just here because I don't want to delete the minimum length code.
-# Plus, I could refactor the code to handle this better anyway.
+# Full chunks are this long, only the tail of a sentence is shorter.
 # ===END HACKY CODE===
 
-ASSEMBLYAI_SESSION_BEGINS_MESSAGE = "SessionBegins"
-ASSEMBLYAI_SESSION_RESUMED_MESSAGE = "SessionResumed"
-ASSEMBLYAI_SESSION_TERMINATED_MESSAGE = "SessionTerminated"
-ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE = "PartialTranscript"
-ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE = "FinalTranscript"
-
-use_accurate = True  # change this to whichever transcript you want to use.
+STT_SAMPLE_RATE = 16000
+# py-cord gives us 48kHz stereo, but speech recognition doesn't need more than 16kHz mono.
+# That's a sixth of the bytes on the wire for every speaker.
 
-transcript_to_use = ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE if use_accurate else ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE
+END_OF_UTTERANCE_SILENCE_MS = 700
+# The VAD doesn't send silence, but AssemblyAI needs to hear some to decide an utterance is over and finalize it.
+# This much is added to the end of the last chunk of every utterance, which is AssemblyAI's default threshold.
 
-logger: Logger = getLogger(__name__)
+STT_TURN_TIMEOUT_SECONDS: float = 10.0
+# A turn that ended this long ago without a transcript never gets one, i.e. it was a cough or a door.
+# Finals usually come a second or so after the speech ends, this leaves room for a session reconnecting.
 
+STT_TURNS_EXPIRED: Counter = counter(
+    "stt_turns_expired_total", "Turns dropped because no transcript came back for them, e.g. a cough."
+)
+STT_CHUNKS_UNROUTED: Counter = counter(
+    "stt_chunks_unrouted_total", "Chunks of speech that were dropped because the speaker had no session."
+)
 
-def split_bytes_into_chunks(iterable: bytes, chunk_size: int) -> Iterator[bytes]:
-    return [iterable[i: i + chunk_size] for i in range(0, len(iterable), chunk_size)]
+logger: Logger = getLogger(__name__)
 
 
 def calculate_length_of_data_ms(bytes_per_second: int, number_of_bytes: int) -> int:
@@ -64,148 +73,212 @@ def calculate_length_of_data_ms(bytes_per_second: int, number_of_bytes: int) ->
 
 
 class AssemblyAITranscriptionSink(PCMSink):
+    """
+    Transcribes everyone in a voice channel, with a separate session for each speaker.
+    Uses AssemblyAI unless it's given another backend.
+    """
+
     def __init__(
             self,
             assembly_ai_key: str,
-            handle_text: Callable[[str], Awaitable[None]],
+            handle_text: Callable[[str, int], Awaitable[None]],
             *,
+            handle_speech_start: Callable[[int], None] | None = None,
+            handle_partial_text: Callable[[str, int], None] | None = None,
+            backend: TranscriptionBackend | None = None,
+            max_sessions: int = STT_MAX_SESSIONS_PER_GUILD,
+            sample_rate: int = STT_SAMPLE_RATE,
+            warm_pools: WarmConnectionPools = GLOBAL_WARM_POOLS,
             filters=None) -> None:
+        """
+        :param assembly_ai_key: The AssemblyAI API key. Unused if a backend is given.
+        :param handle_text: Called with each transcript and the ID of the user who said it.
+        :param handle_speech_start: Called with a user's ID as soon as they start talking, long before there's
+                                    a transcript. Called on the processing thread, so it must not block.
+        :param handle_partial_text: Called with each partial transcript and the ID of the user saying it.
+                                    Called on the event loop, so it must not block.
+        :param backend: The transcription service to use. Defaults to AssemblyAI's realtime API.
+        :param max_sessions: The most speakers in this channel that can be transcribed at once.
+        :param sample_rate: The rate audio is resampled to (as mono) before being sent for transcription.
+        :param warm_pools: Where to get handshaken connections from, so a speaker's first words aren't held up
+                           by connecting. Shared with every other sink in the process.
+        :param filters: py-cord sink filters.
+        """
         super().__init__(filters=filters)
 
         self.assembly_ai_key = assembly_ai_key
         self.handle_text = handle_text
+        self.handle_speech_start: Callable[[int], None] | None = handle_speech_start
+        self.handle_partial_text: Callable[[str, int], None] | None = handle_partial_text
+        self.backend: TranscriptionBackend = backend or AssemblyAIBackend(assembly_ai_key)
+        self.max_sessions = max_sessions
 
         self.vc: VoiceClient | None = None  # py-cord typed this wrong
 
-        self.sample_rate: int = 64000  # discord default
-
-        self.transcription_task: Task | None = None
-        self.websocket: Any | None = None
-
-        self.send_audio: Callable[[bytes], Awaitable[None]] | None = None
-
-        self.last_data: bytes = b""
-
-        self.data_processing_executor: Executor = ThreadPoolExecutor(max_workers=1)
-
-    async def _initialize_and_receive_transcription(self):
-        async for websocket in websockets.connect(
-                ASSEMBLYAI_ENDPOINT.format(sample_rate=self.sample_rate),
-                ping_interval=5,
-                ping_timeout=5,
-                extra_headers={"Authorization": self.assembly_ai_key},
-        ):
-            try:
-                await sleep(0.5)  # wait for connection to be established
-                first_message = await websocket.recv()  # first message from
-                first_message_json = json.loads(first_message)
-
-                if first_message_json["message_type"] != ASSEMBLYAI_SESSION_BEGINS_MESSAGE:
-                    raise RuntimeError(f"Expected SessionBegins message, got {first_message_json['message_type']}")
-
-                session_id: str = first_message_json["session_id"]
-
-                async def send_audio(data: bytes) -> None:
-                    """receives PCM audio data"""
-                    if sum(data) == 0:
-                        return  # do not send silence
-                    data_b64_string: str = str(b64encode(data).decode("utf-8"))
-                    await websocket.send(json.dumps({"audio_data": data_b64_string}))
-
-                self.send_audio = send_audio
-
-                while True:
-                    try:
-                        message: str = await websocket.recv()
-                        message_json: dict = json.loads(message)
-
-                        if "error" in message_json:
-                            raise RuntimeError(f"Error from AssemblyAI: {message_json['error']}")
-                        elif message_json["message_type"] == transcript_to_use:
-                            text: str = message_json["text"]
-                            if len(text) > 0:
-                                logger.info(f"Received text from AssemblyAI: {text}")
-                                await self.handle_text(text)
-                    except Exception as e:
-                        logger.exception(e)
-                        continue
-            except websockets.ConnectionClosed:
-                continue
+        self.sample_rate: int = sample_rate  # of the mono PCM we send, not what discord sends us
+
+        self.sessions: TranscriptionSessionManager | None = None
+        self.warm_pools: WarmConnectionPools = warm_pools
+        self.warm_pool: WarmConnectionPool | None = None
+
+        # these are only touched on the processing thread
+        self.resamplers: dict[int, MonoResampler] = {}
+        self.voice_activity: dict[int, VoiceActivityDetector] = {}
+        self.buffers: dict[int, ChunkRingBuffer] = {}
+
+        # turns that have started (someone started talking) but haven't been transcribed yet, oldest first
+        # appended to on the processing thread, taken from on the event loop
+        self.pending_turns: dict[int, deque[Turn]] = {}
+
+        # packets from one sink are processed in order, on the shared audio threads
+        self.data_processing_executor: Executor = SerialExecutor(get_default_executors().audio)
+
+    def _open_session(self, user: int) -> TranscriptionSession:
+        return TranscriptionSession(
+            self.backend,
+            user,
+            self._handle_text,
+            sample_rate=self.sample_rate,
+            loop=self.vc.loop,
+            handle_partial_text=self.handle_partial_text,
+            warm_pool=self.warm_pool,
+        )
+
+    def _turn_for(self, user: int) -> Turn:
+        """
+        Finds the turn a final transcript belongs to. AssemblyAI finalizes after it hears some silence,
+        so that's the latest one that has ended. Any that ended before it never got a transcript of their own
+        (a cough, or a pause too short for AssemblyAI to split on) and are dropped, so they can't shift
+        every later transcript onto the wrong turn.
+        """
+        pending: deque[Turn] | None = self.pending_turns.get(user)
+        if not pending:
+            return Turn(user)
+
+        now: float = monotonic()
+        turns: list[Turn] = list(pending)  # the processing thread appends to it
+        current: list[Turn] = [
+            turn for turn in turns if now - turn.marks.get("speech_end", now) <= STT_TURN_TIMEOUT_SECONDS
+        ]
+        ended: list[Turn] = [turn for turn in current if "speech_end" in turn.marks]
+        # if nothing has ended, they're still talking and it was finalized early
+        chosen: Turn | None = ended[-1] if ended else (current[0] if current else None)
+
+        while pending:
+            turn: Turn = pending.popleft()
+            if turn is chosen:
+                return turn
+            STT_TURNS_EXPIRED.inc()
+            logger.debug(f"{turn} never got a transcript")
+        return Turn(user)
+
+    async def _handle_text(self, text: str, user: int) -> None:
+        turn: Turn = self._turn_for(user)
+        turn.mark("transcript")
+        with active_turn(turn):  # everything the handler does from here on is traced as part of this turn
+            await self.handle_text(text, user)
 
     def init(self, vc: VoiceClient) -> None:
         super().init(vc)
 
-        self.sample_rate = vc.channel.bitrate  # may need special handling to reopen websocket
+        # keep connections ready for whoever talks first, this runs on the loop when recording starts
+        self.warm_pool = self.warm_pools.get(self.backend, self.sample_rate, vc.loop)
+        self.warm_pool.retain()
 
-        self.transcription_task = vc.loop.create_task(self._initialize_and_receive_transcription())
+        self.sessions = TranscriptionSessionManager(self._open_session, vc.loop, max_sessions=self.max_sessions)
+        self.sessions.start()
 
     def cleanup(self):
         super().cleanup()
 
-        self.transcription_task.cancel()
-
-    def send_sync(self, data: bytes) -> None:
+        self.data_processing_executor.shutdown(wait=False, cancel_futures=True)  # nobody is listening anymore
+        self.sessions.close_all()
+        if self.warm_pool is not None:
+            self.vc.loop.call_soon_threadsafe(self.warm_pool.release)
+
+    @property
+    def speech_ratios(self) -> dict[int, float]:
+        """The fraction of each user's audio that the VAD let through as speech."""
+        return {user: detector.speech_ratio for user, detector in self.voice_activity.items()}
+
+    @property
+    def bytes_per_second(self) -> int:
+        return self.sample_rate * SAMPLE_WIDTH  # mono
+
+    def _buffer_for(self, user: int) -> ChunkRingBuffer:
+        if user not in self.buffers:
+            # AssemblyAI isn't very good with short chunks, so we send ones right at the usable minimum,
+            # but no longer than half the maximum, so the send queue can glue two together when it backs up
+            max_chunk_bytes: int = (ASSEMBLYAI_MAXIMUM_LENGTH_MS - 1) * self.bytes_per_second // 1000
+            chunk_bytes: int = min(
+                ASSEMBLYAI_USABLE_MINIMUM_LENGTH_MS * self.bytes_per_second // 1000, max_chunk_bytes // 2
+            )
+            chunk_bytes -= chunk_bytes % SAMPLE_WIDTH
+            self.buffers[user] = ChunkRingBuffer(chunk_bytes, frame_bytes=SAMPLE_WIDTH)
+        return self.buffers[user]
+
+    def _end_utterance(self, data: bytes) -> bytes:
+        """Pads the last chunk of an utterance with enough silence for AssemblyAI to finalize it."""
+        silence_bytes: int = END_OF_UTTERANCE_SILENCE_MS * self.bytes_per_second // 1000
+        silence_bytes -= silence_bytes % SAMPLE_WIDTH  # keep it frame-aligned
+        return data + bytes(silence_bytes)
+
+    def send_sync(self, data: bytes, user: int) -> None:
         # final sanity check before sending it
-        data_length_ms: int = calculate_length_of_data_ms(self.sample_rate, len(data))
+        data_length_ms: int = calculate_length_of_data_ms(self.bytes_per_second, len(data))
         assert data_length_ms < ASSEMBLYAI_MAXIMUM_LENGTH_MS, "data is too long"
         assert data_length_ms > ASSEMBLYAI_MINIMUM_LENGTH_MS, "data is too short"
 
-        if self.send_audio is not None:
-            send_audio_coro: Awaitable[None] = self.send_audio(data)
-            run_coroutine_threadsafe(send_audio_coro, self.vc.loop)
+        session: TranscriptionSession | None = self.sessions.get(user)
+
+        if session is not None:
+            session.send_sync(data)
         else:
-            logger.warning("have valid audio, but send_audio is None, cannot send audio to AssemblyAI")
+            STT_CHUNKS_UNROUTED.inc()
 
-    def process_data(self, data: bytes, user: int) -> None:
+    def process_data(self, data: bytes, user: int, received_at: float | None = None) -> None:
         if user == self.vc.user.id:
             return  # we don't want to send our own audio
 
-        data_length_ms: int = calculate_length_of_data_ms(self.sample_rate, len(data))
-
-        # hackland incoming
-        # since assembly.ai has a limit on the length of audio it can process, we accumulate audio until we have enough
+        if user not in self.resamplers:
+            self.resamplers[user] = MonoResampler(self.sample_rate)
+            self.voice_activity[user] = VoiceActivityDetector(sample_rate=self.sample_rate, channels=1)
 
-        if data_length_ms < ASSEMBLYAI_USABLE_MINIMUM_LENGTH_MS:  # TODO
-            data = self.last_data + data
+        detector: VoiceActivityDetector = self.voice_activity[user]
 
-            # let's just slap the last one on it yeah?
+        was_speaking: bool = detector.speaking
 
-            new_data_length_ms: int = calculate_length_of_data_ms(self.sample_rate, len(data))
+        data = self.resamplers[user].process(data)  # everything after this is mono at our sample rate
+        data = detector.process(data)  # if nobody is talking, this is empty
 
-            if new_data_length_ms < ASSEMBLYAI_USABLE_MINIMUM_LENGTH_MS:  # TODO
-                self.last_data = data  # literally "double it and give it to the next person"
-                return  # we still don't have enough data
-            elif new_data_length_ms > ASSEMBLYAI_MAXIMUM_LENGTH_MS:
-                self.last_data = b""
-                return  # couldn't fix it 🥲
-            else:
-                self.last_data = b""  # processed the data
-        elif data_length_ms > ASSEMBLYAI_MAXIMUM_LENGTH_MS:
-            self.last_data = b""  # we don't need to accumulate anything
+        if detector.speaking and not was_speaking:
+            self.pending_turns.setdefault(user, deque(maxlen=4)).append(Turn(user, started_at=received_at))
+            if self.handle_speech_start is not None:
+                self.handle_speech_start(user)
 
-            seconds_per_chunk: float = float(ASSEMBLYAI_MAXIMUM_LENGTH_MS) / 1000.0
-            chunk_size: int = int(seconds_per_chunk * self.sample_rate)
+        buffer: ChunkRingBuffer = self._buffer_for(user)
 
-            chunk_size -= 10
-            # I fear that floating point errors will cause this to be off by a few bytes and cause an error
+        if data:
+            # open their session as soon as they start talking, so it's connecting while the first chunk fills
+            self.sessions.get(user)
 
-            # our frame size is 2 bytes since it is PCM mono 16-bit
+            buffer.write(data)
 
-            if chunk_size % 2 != 0:
-                chunk_size -= 1  # make sure it is divisible by 2 to not cut along a chunk
-
-            for chunk in split_bytes_into_chunks(data, chunk_size):
-                self.send_sync(chunk)
-        else:
-            self.last_data = b""  # we have enough data
+            for chunk in buffer.chunks():
+                self.send_sync(chunk, user)
 
-        self.send_sync(data)
+        if not detector.speaking and len(buffer) > 0:
+            # they stopped talking, so send whatever is left over instead of holding it until their next sentence
+            self.send_sync(self._end_utterance(buffer.flush()), user)
+            VAD_SPEECH_RATIO.observe(detector.speech_ratio)
+            if self.pending_turns.get(user):
+                self.pending_turns[user][-1].mark("speech_end")
 
     @Filters.container
     def write(self, data: bytes, user: int) -> None:
         super().write(data, user)
 
-        self.data_processing_executor.submit(self.process_data, data, user)
+        self.data_processing_executor.submit(self.process_data, data, user, monotonic())
 
 
 __all__ = ["AssemblyAITranscriptionSink"]
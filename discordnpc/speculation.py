@@ -0,0 +1,169 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from asyncio import AbstractEventLoop, CancelledError, Task, TimerHandle
+from logging import Logger, getLogger
+from time import monotonic
+from typing import Callable, Awaitable
+
+from .answer_cache import normalize_prompt
+from .chatgpt_types import Answer
+from .metrics import Counter, Histogram, counter, histogram
+
+logger: Logger = getLogger(__name__)
+
+LLM_SPECULATION_STABLE_SECONDS: float = 0.6  # how long a partial transcript has to stop changing before we guess
+
+LLM_SPECULATIONS: Counter = counter("llm_speculations_total", "ChatGPT requests started from a partial transcript.")
+LLM_SPECULATION_HITS: Counter = counter(
+    "llm_speculation_hits_total", "Speculative requests whose prompt matched the final transcript and were used."
+)
+LLM_SPECULATION_MISSES: Counter = counter(
+    "llm_speculation_misses_total", "Speculative requests that were thrown away (each one still cost a request)."
+)
+LLM_SPECULATION_SAVED: Histogram = histogram(
+    "llm_speculation_saved_seconds", "How much sooner the answer was ready because it was asked for early, per hit."
+)
+
+
+class SpeculativeAsker:
+    """
+    Asks ChatGPT about what one speaker is saying before they've finished saying it.
+    Once their partial transcript stops changing for a moment, it's asked about. If the final transcript turns
+    out to say the same thing, the answer is used, otherwise it's thrown away.
+
+    Speculation forks the conversation: the speculative message is a child of the last answer,
+    and if it's thrown away the next real question is asked as another child of the same answer,
+    the same way editing a message in ChatGPT does. So nothing needs to be undone.
+    Only use from the event loop.
+    """
+
+    def __init__(
+            self,
+            ask: Callable[[str, str | None], Awaitable[Answer]],
+            current_parent_id: Callable[[], str | None],
+            loop: AbstractEventLoop,
+            *,
+            stable_for: float = LLM_SPECULATION_STABLE_SECONDS,
+    ) -> None:
+        """
+        :param ask: Asks a prompt as a reply to a parent message.
+        :param current_parent_id: Gets the message a question asked right now would reply to.
+                                  A speculation made against an older parent is never used.
+        :param loop: The event loop.
+        :param stable_for: Seconds a partial transcript has to stay the same before it's asked about.
+        """
+        self.ask: Callable[[str, str | None], Awaitable[Answer]] = ask
+        self.current_parent_id: Callable[[], str | None] = current_parent_id
+        self.loop: AbstractEventLoop = loop
+        self.stable_for: float = stable_for
+
+        self._partial: str = ""
+        self._timer: TimerHandle | None = None
+
+        self._task: Task[Answer] | None = None
+        self._prompt: str = ""  # normalized
+        self._parent_id: str | None = None
+        self._started_at: float = 0.0
+        self._done_at: float | None = None
+
+    def _on_done(self, task: Task[Answer]) -> None:
+        if task is self._task:
+            self._done_at = monotonic()
+        if not task.cancelled():
+            task.exception()  # don't warn about exceptions from speculations nobody took
+
+    def _discard(self) -> None:
+        if self._task is not None:
+            LLM_SPECULATION_MISSES.inc()
+            self._task.cancel()  # the request may already be in flight, but nobody is waiting on it anymore
+            self._task = None
+
+    def _speculate(self) -> None:
+        self._timer = None
+        prompt: str = normalize_prompt(self._partial)
+        parent_id: str | None = self.current_parent_id()
+
+        if self._task is not None and self._prompt == prompt and self._parent_id == parent_id:
+            return  # already asked this
+        self._discard()
+
+        logger.info(f"Speculatively asking: {self._partial}")
+        LLM_SPECULATIONS.inc()
+        self._task = self.loop.create_task(self.ask(self._partial, parent_id))
+        self._task.add_done_callback(self._on_done)
+        self._prompt = prompt
+        self._parent_id = parent_id
+        self._started_at = monotonic()
+        self._done_at = None
+
+    def on_partial(self, text: str) -> None:
+        """Call with every partial transcript. Restarts the stability timer whenever the text changes."""
+        if not text or text == self._partial:
+            return
+        self._partial = text
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(self.stable_for, self._speculate)
+
+    async def take(self, final_text: str) -> Answer | None:
+        """
+        Call with the final transcript, before asking about it.
+        :return: The speculative answer, if there was a speculation for exactly this and it succeeded.
+                 Otherwise None, and the final transcript should be asked about normally.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._partial = ""
+
+        task: Task[Answer] | None = self._task
+        if task is None:
+            return None
+
+        if self._prompt != normalize_prompt(final_text) or self._parent_id != self.current_parent_id():
+            self._discard()
+            return None
+
+        final_at: float = monotonic()
+        try:
+            answer: Answer = await task
+        except CancelledError:
+            raise
+        except Exception:
+            LLM_SPECULATION_MISSES.inc()
+            logger.exception("Speculative request failed, asking again")
+            return None
+        finally:
+            self._task = None
+
+        LLM_SPECULATION_HITS.inc()
+        # it had a head start of (final_at - started_at), but can't have saved more than the request took
+        done_at: float = self._done_at if self._done_at is not None else monotonic()
+        LLM_SPECULATION_SAVED.observe(min(final_at, done_at) - self._started_at)
+        return answer
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._discard()
+
+
+__all__ = ("SpeculativeAsker",)
@@ -0,0 +1,125 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from itertools import count
+from logging import Logger, getLogger
+from threading import Lock
+from time import monotonic
+from typing import Iterator
+
+from .metrics import Histogram, histogram
+
+logger: Logger = getLogger(__name__)
+
+# The marks a voice turn goes through, roughly in order:
+#   audio                  the sink got the first packet of the utterance
+#   speech_end             the VAD decided they stopped talking
+#   transcript             the final transcript came back
+#   llm_start / llm_end    ChatGPT was asked / answered
+#   answer_tts_decoded     the first segment of the answer was synthesized and decoded
+#   answer_playing         the first segment of the answer started playing
+# acknowledgement_tts_decoded and acknowledgement_playing are the same for "I heard you say...".
+
+# (stage, from mark, to mark). A stage is observed when its "to" mark is made, if its "from" mark was made.
+TURN_STAGES: tuple[tuple[str, str, str], ...] = (
+    ("utterance", "audio", "speech_end"),
+    ("stt_finalize", "speech_end", "transcript"),
+    ("llm_queue", "transcript", "llm_start"),
+    ("llm", "llm_start", "llm_end"),
+    ("answer_tts", "llm_start", "answer_tts_decoded"),  # from the start, since streamed answers are spoken early
+    ("answer_playback_queue", "answer_tts_decoded", "answer_playing"),
+    ("acknowledgement", "speech_end", "acknowledgement_playing"),
+    ("response", "speech_end", "answer_playing"),  # what it feels like
+)
+
+TURN_STAGE_HISTOGRAMS: dict[str, Histogram] = {
+    stage: histogram(f"turn_{stage}_seconds", f"Time from {start} to {end} in a voice turn.")
+    for stage, start, end in TURN_STAGES
+}
+
+_turn_ids: Iterator[int] = count(1)
+
+
+class Turn:
+    """
+    One voice turn, from someone starting to talk to the bot starting to answer.
+    Marks are monotonic timestamps. Only the first mark of each name counts, so marking is idempotent.
+    Safe to mark from any thread.
+    """
+
+    def __init__(self, user: int, *, started_at: float | None = None) -> None:
+        self.id: int = next(_turn_ids)
+        self.user: int = user
+        self.marks: dict[str, float] = {}
+        self._lock: Lock = Lock()
+        if started_at is not None:
+            self.mark("audio", at=started_at)
+
+    def __repr__(self) -> str:
+        return f"<Turn {self.id} for {self.user}>"
+
+    def mark(self, name: str, *, at: float | None = None) -> None:
+        at = monotonic() if at is None else at
+        with self._lock:
+            if name in self.marks:
+                return
+            self.marks[name] = at
+            marks: dict[str, float] = dict(self.marks)
+
+        for stage, start, end in TURN_STAGES:
+            if end == name and start in marks:
+                TURN_STAGE_HISTOGRAMS[stage].observe(at - marks[start])
+
+        logger.debug(f"Turn {self.id}: {name}")
+
+    def elapsed(self) -> dict[str, float]:
+        """Every mark, as seconds since the first one."""
+        with self._lock:
+            if not self.marks:
+                return {}
+            first: float = min(self.marks.values())
+            return {name: at - first for name, at in sorted(self.marks.items(), key=lambda item: item[1])}
+
+
+current_turn: ContextVar[Turn | None] = ContextVar("current_turn", default=None)
+
+
+def mark(name: str) -> None:
+    """Mark the current turn, if there is one."""
+    turn: Turn | None = current_turn.get()
+    if turn is not None:
+        turn.mark(name)
+
+
+@contextmanager
+def active_turn(turn: Turn) -> Iterator[Turn]:
+    """
+    Makes a turn current for the duration of the with block.
+    asyncio tasks and asyncio.to_thread inherit it, plain executors need contextvars.copy_context().run.
+    """
+    token: Token = current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        current_turn.reset(token)
+
+
+__all__ = ("Turn", "current_turn", "mark", "active_turn")
@@ -0,0 +1,861 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import json
+from abc import ABC, abstractmethod
+from asyncio import AbstractEventLoop, CancelledError, Event, TimeoutError, sleep, wait_for, Task
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import Executor
+from enum import Enum
+from logging import Logger, getLogger
+from threading import Lock
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple
+
+import websockets
+
+from .executors import get_default_executors
+from .metrics import Counter, Gauge, Histogram, counter, gauge, histogram
+
+ASSEMBLYAI_ENDPOINT = "wss://api.assemblyai.com/v2/realtime/ws?sample_rate={sample_rate}"
+
+ASSEMBLYAI_MINIMUM_LENGTH_MS = 100
+ASSEMBLYAI_MAXIMUM_LENGTH_MS = 2000
+
+ASSEMBLYAI_SESSION_BEGINS_MESSAGE = "SessionBegins"
+ASSEMBLYAI_SESSION_RESUMED_MESSAGE = "SessionResumed"
+ASSEMBLYAI_SESSION_TERMINATED_MESSAGE = "SessionTerminated"
+ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE = "PartialTranscript"
+ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE = "FinalTranscript"
+
+use_accurate = True  # change this to whichever transcript you want to use.
+
+transcript_to_use = ASSEMBLYAI_FINAL_TRANSCRIPT_MESSAGE if use_accurate else ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE
+
+STT_MAX_SESSIONS_PER_GUILD: int = 4
+STT_MAX_SESSIONS: int = 32  # across every guild, each one is a websocket and a billed stream
+STT_SESSION_IDLE_TIMEOUT: float = 30.0  # seconds without audio before a speaker's session is closed
+
+STT_SEND_QUEUE_SIZE: int = 8  # chunks, each is about a second
+STT_REPLAY_BUFFER_MS: int = 10000  # speech held while a session is (re)connecting, sent once it's connected
+
+STT_HANDSHAKE_TIMEOUT: float = 10.0  # seconds to wait for SessionBegins before trying again
+STT_WARM_SESSIONS: int = 1  # handshaken connections kept ready while anyone is listening, each is a billed stream
+STT_WARM_SESSION_MAX_AGE: float = 120.0  # seconds a ready connection is kept before it's swapped for a fresh one
+
+STT_SESSIONS_ACTIVE: Gauge = gauge("stt_sessions_active", "Open per-speaker transcription sessions.")
+STT_SESSIONS_OPENED: Counter = counter("stt_sessions_opened_total", "Per-speaker transcription sessions opened.")
+STT_SESSIONS_REJECTED: Counter = counter(
+    "stt_sessions_rejected_total",
+    "Speakers refused a transcription session because a cap was reached, counted once until a session closes.",
+)
+
+STT_SEND_QUEUE_DEPTH: Gauge = gauge("stt_send_queue_depth", "Chunks waiting to be sent, across every session.")
+STT_SEND_LATENCY: Histogram = histogram(
+    "stt_send_latency_seconds", "Time from a chunk being queued to it being written to the websocket."
+)
+STT_CHUNKS_SENT: Counter = counter("stt_chunks_sent_total", "Chunks written to a transcription websocket.")
+STT_BYTES_SENT: Counter = counter("stt_bytes_sent_total", "PCM bytes written to transcription websockets.")
+STT_CHUNKS_DROPPED: Counter = counter(
+    "stt_chunks_dropped_total", "Chunks thrown away because a send queue was full or the session was disconnected."
+)
+STT_CHUNKS_COALESCED: Counter = counter(
+    "stt_chunks_coalesced_total", "Chunks merged into the chunk queued before them because a send queue was full."
+)
+STT_SEND_ERRORS: Counter = counter("stt_send_errors_total", "Chunks that failed to send.")
+STT_REPLAY_BUFFERED_MS: Counter = counter(
+    "stt_replay_buffered_ms_total", "Milliseconds of speech held to be replayed because a session wasn't connected."
+)
+STT_REPLAY_DROPPED_MS: Counter = counter(
+    "stt_replay_dropped_ms_total", "Milliseconds of held speech thrown away because the replay buffer was full."
+)
+
+STT_CONNECT_SECONDS: Histogram = histogram(
+    "stt_connect_seconds", "Time from a session asking for a connection to it being handshaken and ready for audio."
+)
+STT_WARM_SESSIONS_READY: Gauge = gauge("stt_warm_sessions_ready", "Handshaken connections waiting for a speaker.")
+STT_WARM_SESSIONS_TAKEN: Counter = counter(
+    "stt_warm_sessions_taken_total", "Sessions that started on a connection that was already handshaken."
+)
+STT_WARM_SESSIONS_MISSED: Counter = counter(
+    "stt_warm_sessions_missed_total", "Sessions that had to connect from scratch because no connection was ready."
+)
+
+logger: Logger = getLogger(__name__)
+
+TextHandler = Callable[[str, int], Awaitable[None]]
+PartialTextHandler = Callable[[str, int], None]
+
+
+class SessionLimiter:
+    """A thread-safe counter with a ceiling, used to cap how many sessions are open at once."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit: int = limit
+        self._active: int = 0
+        self._lock: Lock = Lock()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._active >= self.limit:
+                return False
+            self._active += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+
+GLOBAL_SESSION_LIMITER: SessionLimiter = SessionLimiter(STT_MAX_SESSIONS)
+
+
+class TranscriptionConnectionClosed(Exception):
+    """The connection to the transcription service went away. The session will reconnect."""
+
+
+class TranscriptMessage(NamedTuple):
+    message_type: str  # one of the ASSEMBLYAI_*_MESSAGE constants, every backend speaks AssemblyAI's message types
+    text: str = ""
+
+
+class TranscriptionConnection(ABC):
+    """One live, handshaken connection to a realtime transcription service."""
+
+    session_id: str
+
+    @abstractmethod
+    def encode_audio(self, data: bytes) -> str | bytes:
+        """Turns PCM into a message for send. Blocking, and called on an executor."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def send(self, message: str | bytes) -> None:
+        """:raises TranscriptionConnectionClosed: If the connection went away."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def recv(self) -> TranscriptMessage:
+        """:raises TranscriptionConnectionClosed: If the connection went away."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close(self) -> None:
+        """Ends the session for good, so the service stops billing for it."""
+        raise NotImplementedError
+
+    @property
+    def closed(self) -> bool:
+        """Whether the connection is known to have gone away. Checked before a warm connection is handed out."""
+        return False
+
+
+class TranscriptionBackend(ABC):
+    """Something that can transcribe a stream of mono s16le PCM in realtime."""
+
+    @abstractmethod
+    def connect(self, sample_rate: int) -> AsyncIterator[TranscriptionConnection]:
+        """
+        Yields a connection, and then a fresh one every time the caller asks for another because the last one closed.
+        Like websockets.connect, it keeps retrying until it connects.
+        """
+        raise NotImplementedError
+
+
+class OverflowPolicy(Enum):
+    """What an AudioSender does with a new chunk when its queue (or its replay buffer) is full."""
+
+    DROP_OLDEST = "drop_oldest"  # throw away the oldest queued chunk to make room
+    DROP_NEWEST = "drop_newest"  # throw away the new chunk
+    COALESCE = "coalesce"  # glue two neighbouring chunks together (the oldest first, the new one last) where
+    # that stays under the maximum length, otherwise drop the oldest.
+    # not for the replay buffer, which is bounded by time, so gluing makes no room
+
+
+STT_REPLAY_POLICY: OverflowPolicy = OverflowPolicy.DROP_OLDEST  # keep the most recent speech
+
+
+def encode_audio_message(data: bytes) -> str:
+    """Wraps PCM up the way AssemblyAI wants it."""
+    return json.dumps({"audio_data": b64encode(data).decode("ascii")})
+
+
+class AudioSender:
+    """
+    Sends one session's audio to its websocket from a single task, in order.
+    Chunks come in from the processing thread and wait in a bounded queue,
+    and base64/JSON encoding is done on an executor so it doesn't hold up the event loop.
+    While the session isn't connected, chunks (including whatever was queued or being sent when it dropped)
+    are held in a replay buffer bounded by how much speech it holds, and sent first once it connects,
+    so the speaker doesn't have to repeat themselves.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            *,
+            maxsize: int = STT_SEND_QUEUE_SIZE,
+            policy: OverflowPolicy = OverflowPolicy.COALESCE,
+            max_chunk_bytes: int | None = None,
+            executor: Executor | None = None,
+            bytes_per_second: int | None = None,
+            replay_ms: int = STT_REPLAY_BUFFER_MS,
+            replay_policy: OverflowPolicy = STT_REPLAY_POLICY,
+    ) -> None:
+        """
+        :param loop: The event loop the sending task runs on.
+        :param maxsize: How many chunks can be queued before the overflow policy kicks in.
+        :param policy: What to do when the queue is full.
+        :param max_chunk_bytes: The largest chunk coalescing may produce. Required for OverflowPolicy.COALESCE.
+        :param executor: Where to encode chunks. None means the loop's default executor.
+        :param bytes_per_second: Of the PCM being sent. Required to hold any of it while disconnected.
+        :param replay_ms: How much speech to hold while disconnected. 0 drops it like before.
+        :param replay_policy: What to do when the replay buffer is full, drop the oldest speech or the newest.
+        """
+        if policy is OverflowPolicy.COALESCE and max_chunk_bytes is None:
+            raise ValueError("max_chunk_bytes is required to coalesce")
+        if replay_ms > 0 and bytes_per_second is None:
+            raise ValueError("bytes_per_second is required to hold audio while disconnected")
+        if replay_policy is OverflowPolicy.COALESCE:
+            raise ValueError("The replay buffer can't coalesce, it's bounded by time")
+
+        self.loop: AbstractEventLoop = loop
+        self.maxsize: int = maxsize
+        self.policy: OverflowPolicy = policy
+        self.max_chunk_bytes: int | None = max_chunk_bytes
+        self.executor: Executor | None = executor
+        self.bytes_per_second: int | None = bytes_per_second
+        self.replay_policy: OverflowPolicy = replay_policy
+        self.replay_bytes: int = replay_ms * bytes_per_second // 1000 if bytes_per_second is not None else 0
+
+        self.connected: bool = False
+        self.closed: bool = False  # for good, nothing is queued or held after this
+
+        self._queue: deque[tuple[bytes, float]] = deque()  # (chunk, when it was queued), only touched on the loop
+        self._replay: deque[tuple[bytes, float]] = deque()  # same, but held while disconnected, sent first
+        self._replay_held: int = 0  # bytes in _replay
+        self._ready: Event = Event()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def replay_depth_ms(self) -> int:
+        return self._ms(self._replay_held)
+
+    def _ms(self, number_of_bytes: int) -> int:
+        return number_of_bytes * 1000 // self.bytes_per_second if self.bytes_per_second else 0
+
+    def _hold(self, data: bytes, queued_at: float, *, oldest: bool = False) -> None:
+        """Keeps a chunk for the next connection. oldest puts it in front of everything already held."""
+        if len(data) > self.replay_bytes:
+            STT_REPLAY_DROPPED_MS.inc(self._ms(len(data)))
+            return
+
+        while self._replay_held + len(data) > self.replay_bytes:
+            if self.replay_policy is OverflowPolicy.DROP_NEWEST or oldest:
+                STT_REPLAY_DROPPED_MS.inc(self._ms(len(data)))  # the one being held is the one that doesn't fit
+                return
+            dropped, _ = self._replay.popleft()
+            self._replay_held -= len(dropped)
+            STT_REPLAY_DROPPED_MS.inc(self._ms(len(dropped)))
+
+        if oldest:
+            self._replay.appendleft((data, queued_at))
+        else:
+            self._replay.append((data, queued_at))
+        self._replay_held += len(data)
+        STT_REPLAY_BUFFERED_MS.inc(self._ms(len(data)))
+
+    def submit(self, data: bytes) -> None:
+        """Queues a chunk from any thread."""
+        self.loop.call_soon_threadsafe(self._put, data, monotonic())
+
+    def _put(self, data: bytes, queued_at: float) -> None:
+        if self.closed:
+            return
+
+        if not self.connected:
+            if self.replay_bytes > 0:
+                self._hold(data, queued_at)
+            else:
+                STT_CHUNKS_DROPPED.inc()
+                logger.warning("have valid audio, but the session isn't connected, cannot send it")
+            return
+
+        if len(self._queue) >= self.maxsize:
+            if self.policy is OverflowPolicy.DROP_NEWEST:
+                STT_CHUNKS_DROPPED.inc()
+                return
+            elif self.policy is OverflowPolicy.COALESCE and self._coalesce_queued():
+                STT_SEND_QUEUE_DEPTH.dec()  # made room, queue it below
+            elif self.policy is OverflowPolicy.COALESCE and len(self._queue[-1][0]) + len(data) <= self.max_chunk_bytes:
+                last_data, last_queued_at = self._queue.pop()
+                self._queue.append((last_data + data, last_queued_at))
+                STT_CHUNKS_COALESCED.inc()
+                return
+            else:
+                self._queue.popleft()
+                STT_CHUNKS_DROPPED.inc()
+                STT_SEND_QUEUE_DEPTH.dec()
+
+        self._queue.append((data, queued_at))
+        STT_SEND_QUEUE_DEPTH.inc()
+        self._ready.set()
+
+    def _coalesce_queued(self) -> bool:
+        """
+        Glues the oldest pair of neighbouring queued chunks that fits in one message. False if none does.
+        Oldest first, so a queue of full chunks pairs up evenly and holds twice as many.
+        """
+        for index in range(len(self._queue) - 1):
+            (first, first_queued_at), (second, _) = self._queue[index], self._queue[index + 1]
+            if len(first) + len(second) <= self.max_chunk_bytes:
+                self._queue[index] = (first + second, first_queued_at)
+                del self._queue[index + 1]
+                STT_CHUNKS_COALESCED.inc()
+                return True
+        return False
+
+    def connect(self) -> None:
+        """Starts sending again, held audio first. Must be called on the loop."""
+        self.connected = True
+        if self._replay:
+            logger.info(f"Replaying {self.replay_depth_ms}ms of speech held while disconnected")
+            self._ready.set()
+
+    def disconnect(self) -> None:
+        """Holds everything queued until the next connection. Must be called on the loop."""
+        self.connected = False
+        STT_SEND_QUEUE_DEPTH.dec(len(self._queue))
+        while self._queue:
+            self._put(*self._queue.popleft())
+
+    def clear(self) -> None:
+        """Drops everything queued or held. Must be called on the loop."""
+        STT_SEND_QUEUE_DEPTH.dec(len(self._queue))
+        self._queue.clear()
+        self._replay.clear()
+        self._replay_held = 0
+
+    def close(self) -> None:
+        """Drops everything and stops taking chunks, for when the session is over. Must be called on the loop."""
+        self.closed = True
+        self.connected = False
+        self.clear()
+
+    def _requeue(self, data: bytes, queued_at: float) -> None:
+        """Puts back a chunk that didn't make it out, in front of everything else."""
+        if self.closed:
+            return
+        if self.connected:
+            self._queue.appendleft((data, queued_at))
+            STT_SEND_QUEUE_DEPTH.inc()
+        elif self.replay_bytes > 0:
+            self._hold(data, queued_at, oldest=True)
+        else:
+            STT_CHUNKS_DROPPED.inc()
+
+    def _next(self) -> tuple[bytes, float]:
+        if self._replay:
+            data, queued_at = self._replay.popleft()
+            self._replay_held -= len(data)
+            return data, queued_at
+        STT_SEND_QUEUE_DEPTH.dec()
+        return self._queue.popleft()
+
+    async def run(self, connection: TranscriptionConnection) -> None:
+        """
+        Sends queued chunks until cancelled or the connection closes.
+        :param connection: The connection to send on.
+        """
+        while True:
+            while not self._replay and not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+
+            data, queued_at = self._next()
+
+            try:
+                message: str | bytes = await self.loop.run_in_executor(self.executor, connection.encode_audio, data)
+                await connection.send(message)
+            except TranscriptionConnectionClosed:
+                STT_SEND_ERRORS.inc()
+                self._requeue(data, queued_at)
+                raise
+            except CancelledError:
+                # the connection is going away under us, and this may not have made it out.
+                # sending it twice is better than losing it
+                self._requeue(data, queued_at)
+                raise
+            except Exception:
+                STT_SEND_ERRORS.inc()
+                logger.exception("Failed to send audio")
+                continue
+
+            STT_SEND_LATENCY.observe(monotonic() - queued_at)
+            STT_CHUNKS_SENT.inc()
+            STT_BYTES_SENT.inc(len(data))
+
+
+class AssemblyAIConnection(TranscriptionConnection):
+    def __init__(self, websocket: websockets.WebSocketClientProtocol, session_id: str) -> None:
+        self.websocket: websockets.WebSocketClientProtocol = websocket
+        self.session_id: str = session_id
+
+    def encode_audio(self, data: bytes) -> str:
+        return encode_audio_message(data)
+
+    async def send(self, message: str | bytes) -> None:
+        try:
+            await self.websocket.send(message)
+        except websockets.ConnectionClosed as exc:
+            raise TranscriptionConnectionClosed from exc
+
+    async def recv(self) -> TranscriptMessage:
+        try:
+            message: str = await self.websocket.recv()
+        except websockets.ConnectionClosed as exc:
+            raise TranscriptionConnectionClosed from exc
+
+        message_json: dict = json.loads(message)
+
+        if "error" in message_json:
+            raise RuntimeError(f"Error from AssemblyAI: {message_json['error']}")
+
+        return TranscriptMessage(message_json["message_type"], message_json.get("text", ""))
+
+    async def close(self) -> None:
+        try:
+            await self.websocket.send(json.dumps({"terminate_session": True}))
+            await self.websocket.close()
+        except websockets.ConnectionClosed:
+            pass
+
+    @property
+    def closed(self) -> bool:
+        return self.websocket.closed
+
+
+class AssemblyAIBackend(TranscriptionBackend):
+    """
+    AssemblyAI's realtime websocket API.
+    Point the endpoint at discordnpc.mock_stt to run without the real service.
+    """
+
+    def __init__(self, assembly_ai_key: str, *, endpoint: str = ASSEMBLYAI_ENDPOINT) -> None:
+        """
+        :param assembly_ai_key: The AssemblyAI API key.
+        :param endpoint: The websocket URL, with a {sample_rate} placeholder.
+        """
+        self.assembly_ai_key: str = assembly_ai_key
+        self.endpoint: str = endpoint
+
+    # two backends with the same key and endpoint are interchangeable, so they can share warm connections
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, AssemblyAIBackend):
+            return NotImplemented
+        return (self.assembly_ai_key, self.endpoint) == (other.assembly_ai_key, other.endpoint)
+
+    def __hash__(self) -> int:
+        return hash((self.assembly_ai_key, self.endpoint))
+
+    async def connect(self, sample_rate: int) -> AsyncIterator[AssemblyAIConnection]:
+        async for websocket in websockets.connect(
+                self.endpoint.format(sample_rate=sample_rate),
+                ping_interval=5,
+                ping_timeout=5,
+                extra_headers={"Authorization": self.assembly_ai_key},
+        ):
+            try:
+                # the session is ready as soon as AssemblyAI says so
+                first_message = await wait_for(websocket.recv(), STT_HANDSHAKE_TIMEOUT)
+                first_message_json = json.loads(first_message)
+
+                if first_message_json["message_type"] != ASSEMBLYAI_SESSION_BEGINS_MESSAGE:
+                    raise RuntimeError(f"Expected SessionBegins message, got {first_message_json['message_type']}")
+            except websockets.ConnectionClosed:
+                continue
+            except TimeoutError:
+                logger.warning(f"AssemblyAI didn't begin a session within {STT_HANDSHAKE_TIMEOUT}s, reconnecting")
+                continue
+
+            yield AssemblyAIConnection(websocket, first_message_json["session_id"])
+
+
+class WarmConnection(NamedTuple):
+    connections: AsyncIterator[TranscriptionConnection]  # the backend's iterator, parked on its first connection
+    connection: TranscriptionConnection
+    ready_at: float
+
+
+class WarmConnectionPool:
+    """
+    Keeps connections to one backend at one sample rate handshaken ahead of time, so a speaker's session
+    can start sending audio the moment it opens instead of waiting on a websocket and a handshake first.
+    It only keeps connections warm while at least one sink is retaining it, since every one is a billed stream.
+    Only use from the event loop.
+    """
+
+    def __init__(
+            self,
+            backend: TranscriptionBackend,
+            sample_rate: int,
+            loop: AbstractEventLoop,
+            *,
+            size: int = STT_WARM_SESSIONS,
+            max_age: float = STT_WARM_SESSION_MAX_AGE,
+    ) -> None:
+        """
+        :param backend: The transcription service to connect to.
+        :param sample_rate: The sample rate the connections are opened for.
+        :param loop: The event loop to run on.
+        :param size: How many connections to keep ready. 0 keeps none.
+        :param max_age: How many seconds a ready connection is kept before it's swapped for a fresh one.
+        """
+        self.backend: TranscriptionBackend = backend
+        self.sample_rate: int = sample_rate
+        self.loop: AbstractEventLoop = loop
+        self.size: int = size
+        self.max_age: float = max_age
+
+        self._ready: deque[WarmConnection] = deque()
+        self._retained: int = 0
+        self._wanted: Event = Event()  # set when one is taken, so it's replaced straight away
+        self._filler: Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def retain(self) -> None:
+        """Call when a sink starts listening. Starts keeping connections warm, if this is the first."""
+        self._retained += 1
+        if self._filler is None and self.size > 0:
+            self._filler = self.loop.create_task(self._keep_warm())
+
+    def release(self) -> None:
+        """Call when a sink stops listening. Closes the warm connections, if this was the last."""
+        self._retained -= 1
+        if self._retained > 0:
+            return
+        if self._filler is not None:
+            self._filler.cancel()
+            self._filler = None
+        while self._ready:
+            self._discard(self._ready.popleft())
+
+    def take(self) -> AsyncIterator[TranscriptionConnection] | None:
+        """
+        Take a warm connection, if one is ready.
+        :return: An iterator like the backend's connect, whose first connection is already handshaken.
+                 It reconnects from scratch after that. None if nothing is ready.
+        """
+        while self._ready:
+            warm: WarmConnection = self._ready.popleft()
+            if warm.connection.closed or self.loop.time() - warm.ready_at > self.max_age:
+                self._discard(warm)
+                continue
+            STT_WARM_SESSIONS_READY.dec()
+            STT_WARM_SESSIONS_TAKEN.inc()
+            self._wanted.set()
+            return self._resume(warm)
+
+        if self.size > 0:  # with warm connections turned off, there's nothing to miss
+            STT_WARM_SESSIONS_MISSED.inc()
+            self._wanted.set()
+        return None
+
+    @staticmethod
+    async def _resume(warm: WarmConnection) -> AsyncIterator[TranscriptionConnection]:
+        yield warm.connection
+        async for connection in warm.connections:
+            yield connection
+
+    def _discard(self, warm: WarmConnection) -> None:
+        STT_WARM_SESSIONS_READY.dec()
+
+        async def close() -> None:
+            await warm.connection.close()
+            await warm.connections.aclose()
+
+        self.loop.create_task(close())
+
+    async def _keep_warm(self) -> None:
+        while True:
+            # swap out anything that went stale or was closed on the other end
+            now: float = self.loop.time()
+            for warm in [warm for warm in self._ready if warm.connection.closed or now - warm.ready_at > self.max_age]:
+                self._ready.remove(warm)
+                self._discard(warm)
+
+            while len(self._ready) < self.size:
+                # a new iterator for every one, advancing an iterator closes the connection it's parked on
+                connections: AsyncIterator[TranscriptionConnection] = self.backend.connect(self.sample_rate)
+                try:
+                    connection: TranscriptionConnection = await anext(connections)
+                except CancelledError:
+                    await connections.aclose()
+                    raise
+                self._ready.append(WarmConnection(connections, connection, self.loop.time()))
+                STT_WARM_SESSIONS_READY.inc()
+
+            self._wanted.clear()
+            try:
+                await wait_for(self._wanted.wait(), self.max_age / 4)
+            except TimeoutError:
+                pass
+
+
+class WarmConnectionPools:
+    """Every warm connection pool in the process, one per backend and sample rate, so guilds share them."""
+
+    def __init__(self, size: int) -> None:
+        """
+        :param size: How many connections each pool keeps ready.
+        """
+        self.size: int = size
+        self._pools: dict[tuple[TranscriptionBackend, int], WarmConnectionPool] = {}
+
+    def get(self, backend: TranscriptionBackend, sample_rate: int, loop: AbstractEventLoop) -> WarmConnectionPool:
+        """Must be called on the event loop."""
+        key: tuple[TranscriptionBackend, int] = (backend, sample_rate)
+        if key not in self._pools:
+            self._pools[key] = WarmConnectionPool(backend, sample_rate, loop, size=self.size)
+        return self._pools[key]
+
+
+GLOBAL_WARM_POOLS: WarmConnectionPools = WarmConnectionPools(STT_WARM_SESSIONS)
+
+
+class TranscriptionSession:
+    """One realtime transcription stream, transcribing one speaker."""
+
+    def __init__(
+            self,
+            backend: TranscriptionBackend,
+            user: int,
+            handle_text: TextHandler,
+            *,
+            sample_rate: int,
+            loop: AbstractEventLoop,
+            handle_partial_text: PartialTextHandler | None = None,
+            warm_pool: WarmConnectionPool | None = None,
+    ) -> None:
+        """
+        :param backend: The transcription service to use.
+        :param user: The ID of the user being transcribed.
+        :param handle_text: Called with each transcript and the user ID.
+        :param sample_rate: The sample rate of the mono s16le PCM that will be sent.
+        :param loop: The event loop to run on.
+        :param handle_partial_text: Called with each partial transcript and the user ID, if transcript_to_use
+                                    isn't already partial transcripts. Called on the event loop, so it must not block.
+        :param warm_pool: Where to take an already handshaken connection from, if one is ready.
+        """
+        self.backend: TranscriptionBackend = backend
+        self.warm_pool: WarmConnectionPool | None = warm_pool
+        self.user: int = user
+        self.handle_text: TextHandler = handle_text
+        self.handle_partial_text: PartialTextHandler | None = handle_partial_text
+        self.sample_rate: int = sample_rate
+        self.loop: AbstractEventLoop = loop
+
+        max_chunk_bytes: int = (ASSEMBLYAI_MAXIMUM_LENGTH_MS - 1) * sample_rate * 2 // 1000  # mono s16le
+        self.sender: AudioSender = AudioSender(
+            loop,
+            max_chunk_bytes=max_chunk_bytes - max_chunk_bytes % 2,
+            executor=get_default_executors().audio,
+            bytes_per_second=sample_rate * 2,
+        )
+
+        self.task: Task | None = None
+        self.closed: bool = False
+
+        self.last_active: float = monotonic()
+
+    async def _initialize_and_receive_transcription(self) -> None:
+        connections: AsyncIterator[TranscriptionConnection] | None = (
+            self.warm_pool.take() if self.warm_pool is not None else None
+        )
+        if connections is None:
+            connections = self.backend.connect(self.sample_rate)
+
+        asked_at: float = monotonic()
+        async for connection in connections:
+            STT_CONNECT_SECONDS.observe(monotonic() - asked_at)
+            logger.info(f"Transcription session {connection.session_id} started for {self.user}")
+
+            self.sender.connect()  # anything said while it was connecting goes out first
+            sender_task: Task = self.loop.create_task(self.sender.run(connection))
+
+            try:
+                while True:
+                    try:
+                        message: TranscriptMessage = await connection.recv()
+
+                        if message.message_type == transcript_to_use and len(message.text) > 0:
+                            logger.info(f"Received text for {self.user}: {message.text}")
+                            await self.handle_text(message.text, self.user)
+                        elif (
+                                message.message_type == ASSEMBLYAI_PARTIAL_TRANSCRIPT_MESSAGE
+                                and len(message.text) > 0
+                                and self.handle_partial_text is not None
+                        ):
+                            self.handle_partial_text(message.text, self.user)
+                    except TranscriptionConnectionClosed:
+                        raise  # reconnect
+                    except Exception as e:
+                        logger.exception(e)
+                        continue
+            except TranscriptionConnectionClosed:
+                continue
+            finally:
+                sender_task.cancel()
+                if self.closed:
+                    self.sender.close()  # so the send that was just cancelled doesn't queue its chunk again
+                else:
+                    self.sender.disconnect()  # hold on to it for the next connection
+                if self.closed:
+                    await connection.close()  # we're being cancelled, stop being billed for this stream
+                asked_at = monotonic()  # for the reconnect, if there is one
+
+    def start(self) -> None:
+        """Opens the connection. Must be called on the event loop."""
+        if not self.closed and self.task is None:
+            self.task = self.loop.create_task(self._initialize_and_receive_transcription())
+
+    def close(self) -> None:
+        """Closes the connection. Must be called on the event loop."""
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def send_sync(self, data: bytes) -> None:
+        """Queues PCM to be sent, from any thread."""
+        self.last_active = monotonic()
+        self.sender.submit(data)
+
+
+class TranscriptionSessionManager:
+    """
+    Gives every active speaker in a voice channel their own transcription session.
+    Sessions are opened lazily the first time a speaker needs one and closed after they've been quiet for a while.
+    """
+
+    def __init__(
+            self,
+            open_session: Callable[[int], TranscriptionSession],
+            loop: AbstractEventLoop,
+            *,
+            max_sessions: int = STT_MAX_SESSIONS_PER_GUILD,
+            idle_timeout: float = STT_SESSION_IDLE_TIMEOUT,
+            limiter: SessionLimiter = GLOBAL_SESSION_LIMITER,
+    ) -> None:
+        """
+        :param open_session: Makes a (not yet started) session for a user ID.
+        :param loop: The event loop the sessions run on.
+        :param max_sessions: How many sessions this manager may have open at once.
+        :param idle_timeout: How many seconds a session can go without audio before it is closed.
+        :param limiter: The process-wide session cap, shared with every other manager.
+        """
+        self.open_session: Callable[[int], TranscriptionSession] = open_session
+        self.loop: AbstractEventLoop = loop
+        self.max_sessions: int = max_sessions
+        self.idle_timeout: float = idle_timeout
+        self.limiter: SessionLimiter = limiter
+
+        self.sessions: dict[int, TranscriptionSession] = {}
+        self._lock: Lock = Lock()
+        self._reaper: Task | None = None
+        self._rejected: set[int] = set()  # refused since a session last closed, so each is only counted once
+
+    def get(self, user: int) -> TranscriptionSession | None:
+        """
+        Get a user's session, opening one if they don't have one. Safe to call from any thread.
+        :return: The session, or None if a cap is reached and the user can't have one right now.
+        """
+        with self._lock:
+            session: TranscriptionSession | None = self.sessions.get(user)
+            if session is not None:
+                return session
+
+            if len(self.sessions) >= self.max_sessions or not self.limiter.try_acquire():
+                if user not in self._rejected:  # get is called for every packet, not every session
+                    self._rejected.add(user)
+                    STT_SESSIONS_REJECTED.inc()
+                    logger.warning(f"Too many transcription sessions are open, not transcribing {user}")
+                return None
+
+            self._rejected.discard(user)
+            session = self.sessions[user] = self.open_session(user)
+
+        STT_SESSIONS_OPENED.inc()
+        STT_SESSIONS_ACTIVE.inc()
+        self.loop.call_soon_threadsafe(session.start)
+        return session
+
+    def _close(self, user: int) -> None:
+        with self._lock:
+            session: TranscriptionSession | None = self.sessions.pop(user, None)
+            if session is not None:
+                self._rejected.clear()  # there's room now, so being refused again is a new refusal
+        if session is None:
+            return
+        self.limiter.release()
+        STT_SESSIONS_ACTIVE.dec()
+        self.loop.call_soon_threadsafe(session.close)
+
+    async def _reap_idle(self) -> None:
+        while True:
+            await sleep(self.idle_timeout / 4)
+            now: float = monotonic()
+            with self._lock:
+                idle: list[int] = [
+                    user for user, session in self.sessions.items() if now - session.last_active > self.idle_timeout
+                ]
+            for user in idle:
+                logger.info(f"Closing the transcription session for {user}, they've been quiet for a while")
+                self._close(user)
+
+    def start(self) -> None:
+        """Starts closing idle sessions. Must be called on the event loop."""
+        if self._reaper is None:
+            self._reaper = self.loop.create_task(self._reap_idle())
+
+    def close_all(self) -> None:
+        """Closes every session. Safe to call from any thread."""
+        if self._reaper is not None:
+            self.loop.call_soon_threadsafe(self._reaper.cancel)
+        with self._lock:
+            users: list[int] = list(self.sessions)
+        for user in users:
+            self._close(user)
+
+
+__all__ = (
+    "OverflowPolicy", "AudioSender", "SessionLimiter", "TranscriptionConnectionClosed", "TranscriptMessage",
+    "TranscriptionConnection", "TranscriptionBackend", "AssemblyAIConnection", "AssemblyAIBackend",
+    "WarmConnectionPool", "WarmConnectionPools", "TranscriptionSession", "TranscriptionSessionManager",
+    "GLOBAL_SESSION_LIMITER", "GLOBAL_WARM_POOLS"
+)
@@ -0,0 +1,179 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from asyncio import AbstractEventLoop, Task, TimerHandle
+from contextvars import Context, copy_context
+from logging import Logger, getLogger
+from typing import Callable, Awaitable
+
+from .metrics import Counter, Histogram, counter, histogram
+
+logger: Logger = getLogger(__name__)
+
+# How long to wait after a final transcript for more of the same thought before asking about it.
+# It starts at UTTERANCE_WINDOW_SECONDS and adapts to how each speaker pauses.
+UTTERANCE_WINDOW_SECONDS: float = 0.8
+UTTERANCE_MIN_WINDOW_SECONDS: float = 0.3
+UTTERANCE_MAX_WINDOW_SECONDS: float = 2.5
+
+# words people trail off on when they aren't done yet
+UTTERANCE_CONTINUATIONS: frozenset[str] = frozenset((
+    "and", "but", "or", "so", "because", "like", "um", "uh", "the", "a", "to", "of", "with", "if", "then",
+))
+
+UTTERANCE_FRAGMENTS_MERGED: Counter = counter(
+    "utterance_fragments_merged_total", "Final transcripts merged into another one instead of being asked on their own."
+)
+UTTERANCE_REQUESTS_CANCELLED: Counter = counter(
+    "utterance_requests_cancelled_total", "Questions abandoned before they were answered because the speaker went on."
+)
+UTTERANCE_LLM_CALLS_SAVED: Histogram = histogram(
+    "utterance_llm_calls_saved", "ChatGPT requests saved per answered turn by merging its transcripts."
+)
+
+
+class UtteranceAggregator:
+    """
+    Turns the final transcripts of one speaker into whole utterances. AssemblyAI finalizes on every pause,
+    so "what's the capital of" ... "france" would otherwise be two questions, two acknowledgements and
+    two requests against the rate limit. A transcript is held for a short window in case more follows,
+    and if more does follow after it was already handed on, but before it was answered,
+    that is cancelled and everything is handed on again as one.
+    The window adapts: it grows for speakers who pause a lot, shrinks back for ones who don't,
+    and is shorter after a question mark and longer after a trailing "and".
+    Only use from the event loop.
+    """
+
+    def __init__(
+            self,
+            handle_utterance: Callable[[str, int], Awaitable[None]],
+            user: int,
+            loop: AbstractEventLoop,
+            *,
+            window: float = UTTERANCE_WINDOW_SECONDS,
+            min_window: float = UTTERANCE_MIN_WINDOW_SECONDS,
+            max_window: float = UTTERANCE_MAX_WINDOW_SECONDS,
+    ) -> None:
+        """
+        :param handle_utterance: Called with each whole utterance and the user ID. Run as a task, and cancelled
+                                 if the speaker goes on before it calls commit().
+        :param user: The ID of the speaker.
+        :param loop: The event loop.
+        :param window: The window to start with, in seconds.
+        :param min_window: The shortest the window adapts to.
+        :param max_window: The longest the window adapts to, and how long to wait for a transcript
+                           after the speaker starts talking again.
+        """
+        self.handle_utterance: Callable[[str, int], Awaitable[None]] = handle_utterance
+        self.user: int = user
+        self.loop: AbstractEventLoop = loop
+        self.window: float = window
+        self.min_window: float = min_window
+        self.max_window: float = max_window
+
+        self._parts: list[str] = []  # held, not handed on yet
+        self._timer: TimerHandle | None = None
+        self._last_part_at: float = 0.0
+        self._context: Context | None = None  # the latest transcript's, so the utterance is traced as its turn
+
+        self._task: Task[None] | None = None
+        self._task_parts: list[str] = []  # what the task is handling, in case it's cancelled and merged again
+        self._committed: bool = True
+
+    def _clamp(self, window: float) -> float:
+        return min(max(window, self.min_window), self.max_window)
+
+    def _window_for(self, text: str) -> float:
+        stripped: str = text.rstrip()
+        words: list[str] = stripped.rstrip(",.!?").lower().split()
+        if stripped.endswith(",") or (words and words[-1] in UTTERANCE_CONTINUATIONS):
+            return self._clamp(self.window * 1.5)
+        if stripped.endswith("?"):
+            return self._clamp(self.window * 0.5)
+        return self._clamp(self.window)
+
+    def _learn(self, gap: float) -> None:
+        """They went on after a pause this long, so the window should have covered it."""
+        self.window = self._clamp(0.7 * self.window + 0.3 * gap * 1.25)
+
+    def feed(self, text: str) -> None:
+        """Call with every final transcript."""
+        now: float = self.loop.time()
+
+        if self._task is not None and not self._committed:
+            # they went on before we said anything back, so ask about all of it together instead
+            self._task.cancel()
+            self._task = None
+            UTTERANCE_REQUESTS_CANCELLED.inc()
+            self._parts = self._task_parts + self._parts
+            self._task_parts = []
+
+        if self._parts:
+            self._learn(now - self._last_part_at)
+            UTTERANCE_FRAGMENTS_MERGED.inc()
+        if self._timer is not None:
+            self._timer.cancel()
+
+        self._parts.append(text)
+        self._last_part_at = now
+        self._context = copy_context()
+        self._timer = self.loop.call_later(self._window_for(text), self._hand_on, context=self._context)
+
+    def hold(self) -> None:
+        """
+        Call when the speaker is talking again, i.e. they started or there's a partial transcript.
+        Holds what's waiting until their next final transcript.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            # in case it was only a cough
+            self._timer = self.loop.call_later(self.max_window, self._hand_on, context=self._context)
+
+    def _hand_on(self) -> None:
+        self._timer = None
+        if not self._parts:
+            return
+
+        self._task_parts, self._parts = self._parts, []
+        self._committed = False
+        self._task = self.loop.create_task(self.handle_utterance(" ".join(self._task_parts), self.user))
+        self._task.add_done_callback(self._on_done)
+
+    def commit(self, task: Task[None] | None = None) -> None:
+        """
+        Call once handle_utterance starts replying. After this, more speech is a new utterance.
+        :param task: The handle_utterance task replying, if this might run after it was already cancelled.
+        """
+        if self._committed or (task is not None and task is not self._task):
+            return
+        self._committed = True
+        UTTERANCE_LLM_CALLS_SAVED.observe(len(self._task_parts) - 1)
+        self._task_parts = []
+
+    def _on_done(self, task: Task[None]) -> None:
+        if task is self._task:
+            self._task = None
+            if not self._committed:
+                self.commit()  # it finished without replying, i.e. it failed, don't ask it again
+            self.window = self._clamp(0.9 * self.window + 0.1 * self.min_window)  # nobody went on this time
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to handle what {self.user} said", exc_info=task.exception())
+
+
+__all__ = ("UtteranceAggregator",)
@@ -0,0 +1,139 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import audioop
+from collections import deque
+
+from .metrics import Counter, Histogram, counter, histogram
+
+SAMPLE_WIDTH: int = 2  # s16le
+
+VAD_FRAME_MS: int = 20  # same as a discord voice packet
+VAD_RMS_THRESHOLD: int = 400  # int16 RMS, quiet speech through a decent mic is well above this
+VAD_MAX_ZERO_CROSSING_RATE: float = 0.35  # crossings per sample, broadband hiss sits above this and speech doesn't
+VAD_ONSET_FRAMES: int = 2  # a single click or keyboard tap shouldn't count as speech
+VAD_HANGOVER_MS: int = 300  # keep sending for a bit after speech so we don't clip the ends of words
+VAD_PRE_ROLL_MS: int = 200  # and send a bit from before the onset so we don't clip the starts of them
+
+VAD_SPEECH_MS: Counter = counter("vad_speech_ms_total", "Milliseconds of audio the VAD passed through.")
+VAD_DROPPED_MS: Counter = counter("vad_dropped_ms_total", "Milliseconds of audio the VAD dropped as non-speech.")
+VAD_SPEECH_RATIO: Histogram = histogram(
+    "vad_speech_ratio", "The fraction of a speaker's audio so far that the VAD let through, observed as each turn ends."
+)
+
+
+class VoiceActivityDetector:
+    """
+    Energy and zero-crossing voice activity detection for one speaker's PCM.
+    The per-sample work is done by audioop in C, Python only runs once per 20ms frame.
+    """
+
+    def __init__(
+            self,
+            *,
+            sample_rate: int = 48000,
+            channels: int = 2,
+            rms_threshold: int = VAD_RMS_THRESHOLD,
+            max_zero_crossing_rate: float = VAD_MAX_ZERO_CROSSING_RATE,
+            onset_frames: int = VAD_ONSET_FRAMES,
+            hangover_ms: int = VAD_HANGOVER_MS,
+            pre_roll_ms: int = VAD_PRE_ROLL_MS,
+    ) -> None:
+        self.channels: int = channels
+        self.rms_threshold: int = rms_threshold
+        self.max_zero_crossing_rate: float = max_zero_crossing_rate
+        self.onset_frames: int = onset_frames
+        self.hangover_frames: int = hangover_ms // VAD_FRAME_MS
+
+        self.frame_bytes: int = sample_rate * VAD_FRAME_MS // 1000 * channels * SAMPLE_WIDTH
+
+        self._remainder: bytes = b""
+        self._pre_roll: deque[bytes] = deque(maxlen=max(pre_roll_ms // VAD_FRAME_MS, onset_frames))
+        self._voiced_run: int = 0
+        self._hangover_left: int = 0
+
+        self.speaking: bool = False
+        self.speech_ms: int = 0
+        self.non_speech_ms: int = 0
+
+    @property
+    def speech_ratio(self) -> float:
+        """The fraction of this speaker's audio that was passed through as speech."""
+        total_ms: int = self.speech_ms + self.non_speech_ms
+        return self.speech_ms / total_ms if total_ms > 0 else 0.0
+
+    def is_speech_frame(self, frame: bytes) -> bool:
+        if audioop.rms(frame, SAMPLE_WIDTH) < self.rms_threshold:
+            return False
+        mono: bytes = audioop.tomono(frame, SAMPLE_WIDTH, 0.5, 0.5) if self.channels == 2 else frame
+        # interleaved stereo would count L/R flips as crossings, so this has to be on mono
+        zero_crossing_rate: float = audioop.cross(mono, SAMPLE_WIDTH) / (len(mono) // SAMPLE_WIDTH)
+        return zero_crossing_rate <= self.max_zero_crossing_rate
+
+    def process(self, data: bytes) -> bytes:
+        """
+        Feed PCM in, get the parts of it that are (or are near) speech out.
+        Partial frames are held until the rest of the frame arrives.
+        :param data: Any amount of PCM.
+        :return: The PCM to pass on, which may be empty.
+        """
+        if self._remainder:
+            data = self._remainder + data
+
+        voiced: list[bytes] = []
+        dropped_frames: int = 0
+
+        whole_frames_end: int = len(data) - len(data) % self.frame_bytes
+        for offset in range(0, whole_frames_end, self.frame_bytes):
+            frame: bytes = data[offset:offset + self.frame_bytes]
+
+            if self.is_speech_frame(frame):
+                self._voiced_run += 1
+            else:
+                self._voiced_run = 0
+
+            if self._voiced_run >= self.onset_frames:
+                if not self.speaking:
+                    self.speaking = True
+                    voiced.extend(self._pre_roll)  # includes the onset frames before this one
+                    self._pre_roll.clear()
+                self._hangover_left = self.hangover_frames
+                voiced.append(frame)
+            elif self.speaking and self._hangover_left > 0:
+                self._hangover_left -= 1
+                voiced.append(frame)
+            else:
+                self.speaking = False
+                if len(self._pre_roll) == self._pre_roll.maxlen:
+                    dropped_frames += 1  # falls off the back of the pre-roll, so it's never going to be sent
+                self._pre_roll.append(frame)
+
+        self._remainder = data[whole_frames_end:]
+
+        voiced_ms: int = len(voiced) * VAD_FRAME_MS
+        dropped_ms: int = dropped_frames * VAD_FRAME_MS
+        self.speech_ms += voiced_ms
+        self.non_speech_ms += dropped_ms
+        VAD_SPEECH_MS.inc(voiced_ms)
+        VAD_DROPPED_MS.inc(dropped_ms)
+
+        return b"".join(voiced)
+
+
+__all__ = ("VoiceActivityDetector",)
@@ -0,0 +1,216 @@
+"""
+    DiscordNPC lets you interact with ChatGPT through a Discord voice channel.
+    Copyright (C) 2023  Parker Wahle
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import multiprocessing
+import os
+from asyncio import TimeoutError, sleep, wait_for, wrap_future
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging import Logger, getLogger
+from threading import Lock
+from time import monotonic, process_time
+from typing import Callable, NamedTuple, TypeVar
+
+from .metrics import Counter, Gauge, Histogram, counter, gauge, histogram
+from .pcm_cache import PCMCache, get_default_cache, set_default_cache
+
+logger: Logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+VOICE_WORKERS: int = 0  # processes, 0 does all the voice work in the bot's own process like it always has
+VOICE_WORKER_HEALTH_INTERVAL: float = 15.0  # seconds between health checks
+VOICE_WORKER_HEALTH_TIMEOUT: float = 30.0  # checks queue behind real work, so this is generous
+
+VOICE_WORKERS_HEALTHY: Gauge = gauge("voice_workers_healthy", "Voice worker processes that answered their last check.")
+VOICE_WORKER_RESTARTS: Counter = counter(
+    "voice_worker_restarts_total", "Voice worker processes that died and were replaced."
+)
+VOICE_WORKER_JOB_SECONDS: Histogram = histogram(
+    "voice_worker_job_seconds", "Time from a job being handed to a voice worker to its result being back."
+)
+
+
+class VoiceWorkerCrashed(Exception):
+    """The worker a guild was placed on died while doing its work. The worker is replaced, the job is lost."""
+
+
+class WorkerHealth(NamedTuple):
+    pid: int
+    cpu_seconds: float
+    pcm_cache_bytes: int
+
+
+def _initialize_worker(
+        pcm_cache_max_bytes: int, pcm_cache_directory: str | None, pcm_cache_max_disk_bytes: int
+) -> None:
+    # same cache settings as the bot, and if there's a directory the processes share it
+    set_default_cache(PCMCache(
+        max_bytes=pcm_cache_max_bytes, directory=pcm_cache_directory, max_disk_bytes=pcm_cache_max_disk_bytes
+    ))
+
+
+def _report_health() -> WorkerHealth:
+    return WorkerHealth(os.getpid(), process_time(), get_default_cache().memory_bytes)
+
+
+class VoiceWorker:
+    """One worker process. Guilds are placed on it, and everything they submit runs there."""
+
+    def __init__(self, index: int, make_executor: Callable[[], ProcessPoolExecutor]) -> None:
+        self.index: int = index
+        self.make_executor: Callable[[], ProcessPoolExecutor] = make_executor
+        self.executor: ProcessPoolExecutor = make_executor()
+        self.guilds: set[int] = set()
+        self.in_flight: int = 0  # guarded by the pool's lock
+        self.healthy: bool = True
+        self.health: WorkerHealth | None = None  # as of the last check
+
+    def __repr__(self) -> str:
+        return f"<VoiceWorker {self.index} with {len(self.guilds)} guilds and {self.in_flight} jobs>"
+
+    @property
+    def load(self) -> tuple[bool, int, int]:
+        """Sorts least loaded first."""
+        return not self.healthy, len(self.guilds), self.in_flight
+
+
+class VoiceWorkerPool:
+    """
+    Worker processes that the CPU-heavy half of voice (synthesizing, decoding and Opus-encoding speech) runs on,
+    so guilds aren't all fighting over one GIL.
+    Each guild is placed on the least loaded worker when it joins and stays there until it leaves.
+    If a worker dies, only the guilds on it lose what they were doing, and it's replaced for their next job.
+    Jobs must be picklable, so module-level functions and plain arguments only.
+    The voice connection itself can't leave the process that owns the gateway, so it stays here.
+    """
+
+    def __init__(self, size: int) -> None:
+        if size < 1:
+            raise ValueError("A voice worker pool needs at least one worker")
+
+        cache: PCMCache = get_default_cache()
+        # spawn, not fork, the bot process has threads (and a running event loop) that a fork would copy mid-flight
+        context = multiprocessing.get_context("spawn")
+
+        def make_executor() -> ProcessPoolExecutor:
+            return ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=context,
+                initializer=_initialize_worker,
+                initargs=(cache.max_bytes, cache.directory, cache.max_disk_bytes),
+            )
+
+        self.workers: list[VoiceWorker] = [VoiceWorker(index, make_executor) for index in range(size)]
+        self._placements: dict[int, VoiceWorker] = {}
+        self._lock: Lock = Lock()
+        VOICE_WORKERS_HEALTHY.set(size)
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    def place(self, guild: int) -> VoiceWorker:
+        """Get the worker a guild is on, placing it on the least loaded one if it isn't on one yet."""
+        with self._lock:
+            worker: VoiceWorker | None = self._placements.get(guild)
+            if worker is None:
+                worker = self._placements[guild] = min(self.workers, key=lambda candidate: candidate.load)
+                worker.guilds.add(guild)
+                logger.info(f"Placed guild {guild} on voice worker {worker.index}")
+            return worker
+
+    def release(self, guild: int) -> None:
+        with self._lock:
+            worker: VoiceWorker | None = self._placements.pop(guild, None)
+            if worker is not None:
+                worker.guilds.discard(guild)
+
+    def _restart(self, worker: VoiceWorker, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if worker.executor is not broken:
+                return  # another job already noticed and replaced it
+            worker.executor = worker.make_executor()
+            worker.healthy = True
+        broken.shutdown(wait=False, cancel_futures=True)
+        VOICE_WORKER_RESTARTS.inc()
+        logger.error(f"Voice worker {worker.index} died, replaced it. Guilds on it: {sorted(worker.guilds)}")
+
+    def submit(self, guild: int, fn: Callable[..., T], *args) -> Future[T]:
+        """Runs fn(*args) on the guild's worker. Safe to call from any thread."""
+        worker: VoiceWorker = self.place(guild)
+        executor: ProcessPoolExecutor = worker.executor
+        submitted_at: float = monotonic()
+
+        try:
+            future: Future[T] = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._restart(worker, executor)
+            executor = worker.executor
+            future = executor.submit(fn, *args)  # nothing was lost yet, so try once on the replacement
+
+        with self._lock:
+            worker.in_flight += 1
+
+        def done(finished: Future[T]) -> None:
+            with self._lock:
+                worker.in_flight -= 1
+            VOICE_WORKER_JOB_SECONDS.observe(monotonic() - submitted_at)
+            if not finished.cancelled() and isinstance(finished.exception(), BrokenProcessPool):
+                self._restart(worker, executor)
+
+        future.add_done_callback(done)
+        return future
+
+    def run(self, guild: int, fn: Callable[..., T], *args) -> T:
+        """Runs fn(*args) on the guild's worker and waits for the result. Blocks, so don't call it on the loop."""
+        try:
+            return self.submit(guild, fn, *args).result()
+        except BrokenProcessPool as error:
+            raise VoiceWorkerCrashed(f"The voice worker for guild {guild} died") from error
+
+    async def monitor(self, *, interval: float = VOICE_WORKER_HEALTH_INTERVAL) -> None:
+        """Checks on every worker forever, replacing dead ones and keeping new guilds off unresponsive ones."""
+        while True:
+            for worker in self.workers:
+                executor: ProcessPoolExecutor = worker.executor
+                try:
+                    worker.health = await wait_for(
+                        wrap_future(executor.submit(_report_health)), VOICE_WORKER_HEALTH_TIMEOUT
+                    )
+                    worker.healthy = True
+                except BrokenProcessPool:
+                    self._restart(worker, executor)
+                except TimeoutError:
+                    if worker.healthy:
+                        logger.warning(f"Voice worker {worker.index} didn't answer its health check")
+                    worker.healthy = False
+                else:
+                    logger.debug(
+                        f"Voice worker {worker.index} (pid {worker.health.pid}): {len(worker.guilds)} guilds, "
+                        f"{worker.in_flight} jobs, {worker.health.cpu_seconds:.1f}s CPU"
+                    )
+            VOICE_WORKERS_HEALTHY.set(sum(worker.healthy for worker in self.workers))
+            await sleep(interval)
+
+    def shutdown(self) -> None:
+        for worker in self.workers:
+            worker.executor.shutdown(wait=False, cancel_futures=True)
+
+
+__all__ = ("VoiceWorkerCrashed", "VoiceWorkerPool")